@@ -0,0 +1,59 @@
+"""
+Benchmarks de las partes de mkvmrg que más tiempo consumen.
+
+    python -m bench [--filter texto] [--repeat N] [--out fichero.json] [--compare fichero.json]
+
+Cada caso genera sus ficheros con bench.fixtures (siempre los mismos) y
+se mide con time.perf_counter. El resultado se guarda en JSON para poder
+compararlo con el de otra versión
+"""
+import gc
+import statistics
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+
+class Case(NamedTuple):
+    name: str
+    params: dict
+    # setup(tmp) -> run; run() -> prepara lo que no se mide y devuelve la función a medir
+    setup: Callable
+
+
+CASES: List[Case] = []
+
+
+def case(name: str, **params):
+    """
+    Registra un benchmark. La función decorada recibe un directorio temporal
+    y los params y devuelve una función sin argumentos que prepara lo que no
+    se quiere medir y devuelve a su vez la función que se mide
+    """
+    def wrapper(func):
+        CASES.append(Case(name, params, func))
+        return func
+    return wrapper
+
+
+def label(c: Case) -> str:
+    if not c.params:
+        return c.name
+    return "{}[{}]".format(c.name, ",".join("{}={}".format(k, v) for k, v in c.params.items()))
+
+
+def measure(c: Case, tmp: str, repeat: int) -> Dict[str, float]:
+    prepare = c.setup(tmp, **c.params)
+    times = []
+    for _ in range(repeat):
+        func = prepare()
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return dict(
+        name=label(c),
+        min=min(times),
+        median=statistics.median(times),
+        max=max(times),
+        repeat=repeat,
+    )
@@ -0,0 +1,84 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+from os import makedirs
+from os.path import abspath, dirname, getmtime, join
+
+from . import CASES, label, measure
+from . import cases  # noqa: F401 registra los casos
+
+RESULTS = join(dirname(abspath(__file__)), "results")
+# A partir de cuanto más lento se marca como regresión
+THRESHOLD = 1.2
+
+
+def revision() -> str:
+    try:
+        return subprocess.check_output(
+            ("git", "describe", "--always", "--dirty"),
+            cwd=dirname(RESULTS),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime("%Y%m%d%H%M%S")
+
+
+def previous(out: str) -> str:
+    files = [f for f in glob(join(RESULTS, "*.json")) if abspath(f) != abspath(out)]
+    if not files:
+        return None
+    return max(files, key=getmtime)
+
+
+def compare(results: list, old_file: str):
+    with open(old_file, "r") as f:
+        old = {r['name']: r for r in json.load(f)['results']}
+    print("")
+    print("# Comparado con", old_file)
+    for r in results:
+        o = old.get(r['name'])
+        if o is None:
+            continue
+        ratio = r['min'] / o['min'] if o['min'] else float('inf')
+        mark = "¡! " if ratio > THRESHOLD else ""
+        print("{}{:<60} {:>9.4f}s -> {:>9.4f}s  x{:.2f}".format(mark, r['name'], o['min'], r['min'], ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python -m bench", description="Benchmarks de mkvmrg")
+    parser.add_argument('--filter', help='Solo los casos cuyo nombre contenga este texto')
+    parser.add_argument('--repeat', type=int, help='Veces que se mide cada caso', default=5)
+    parser.add_argument('--out', help='Fichero json de resultados (por defecto bench/results/<revisión>.json)')
+    parser.add_argument('--compare', help='Fichero json con el que comparar (por defecto el último de bench/results)')
+    pargs = parser.parse_args()
+
+    out = pargs.out or join(RESULTS, revision() + ".json")
+    old = pargs.compare or previous(out)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="mkvmrg-bench.") as tmp:
+        for c in CASES:
+            if pargs.filter and pargs.filter not in label(c):
+                continue
+            r = measure(c, tmp, pargs.repeat)
+            print("{:<60} min {:>9.4f}s  mediana {:>9.4f}s".format(r['name'], r['min'], r['median']))
+            results.append(r)
+
+    makedirs(dirname(abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(dict(
+            revision=revision(),
+            date=time.strftime("%Y-%m-%d %H:%M:%S"),
+            python=sys.version.split()[0],
+            machine=platform.platform(),
+            results=results
+        ), f, indent=2)
+    print("# Resultados en", out)
+
+    if old:
+        compare(results, old)
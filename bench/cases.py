@@ -0,0 +1,252 @@
+"""
+Casos de benchmark de subtítulos, PGS, VobSub, codificaciones, Matroska
+y del merge completo reproduciendo mkvtoolnix (ver bench.scenarios)
+"""
+import copy
+from contextlib import redirect_stdout
+from os import devnull
+from os.path import join
+from shutil import which
+
+from core import util
+from core.cache import CACHE
+from core.demux import demux
+from core.ebml import identify
+from core.mkv import Mkv, MkvMerge
+from core.mkvutil import MkvInfo, Trim, mkvtoolnix_version
+from core.pgsreader import PGSReader
+from core.replay import ReplayRunner
+from core.shell import Runner, Shell
+from core.sub import Sub, SubAnalysis
+from core.track import SubTrack
+from core.vobsubreader import VobSubReader
+
+from . import case, reference
+from .fixtures import make_ass, make_mkv, make_pgs, make_srt, make_vobsub
+from .scenarios import SCENARIOS, record_identify
+
+# Ni la cache ni el almacén deben evitar el trabajo que se quiere medir
+CACHE.enabled = False
+# Lo que imprime el merge no se mide. Shell.get necesita sys.stdout.encoding
+SINK = open(devnull, "w", encoding="utf-8")
+
+
+@case("Sub.get_collisions", events=2000, overlap=0.1)
+@case("Sub.get_collisions", events=2000, overlap=0.5)
+def collisions(tmp, events, overlap):
+    sub = Sub(make_srt(join(tmp, f"coll_{overlap}.srt"), events, overlap))
+    subs = sub.transform("srt")
+
+    def prepare():
+        return lambda: list(sub.get_collisions(subs=subs))
+    return prepare
+
+
+def groups(collisions) -> list:
+    return [tuple(l.index for l in c.lines) for c in collisions]
+
+
+@case("Sub.get_collisions (anterior)", events=2000, overlap=0.1)
+@case("Sub.get_collisions (anterior)", events=2000, overlap=0.5)
+def collisions_reference(tmp, events, overlap):
+    sub = Sub(make_srt(join(tmp, f"coll_{overlap}.srt"), events, overlap))
+    subs = sub.transform("srt")
+    if groups(sub.get_collisions(subs=subs)) != groups(reference.get_collisions(subs)):
+        raise AssertionError("Sub.get_collisions no coincide con la implementación anterior")
+
+    def prepare():
+        return lambda: list(reference.get_collisions(subs))
+    return prepare
+
+
+@case("SSAFile.improve", events=5000, overlap=0.3)
+def improve(tmp, events, overlap):
+    subs = Sub.read(make_srt(join(tmp, "improve.srt"), events, overlap))
+
+    def prepare():
+        cp = copy.deepcopy(subs)
+        return cp.improve
+    return prepare
+
+
+@case("Sub.transform", events=3000, format="ass")
+@case("Sub.transform", events=3000, format="srt")
+def transform(tmp, events, format):
+    file = join(tmp, f"transform.{format}")
+    if format == "ass":
+        make_ass(file, events, 0.2)
+    else:
+        make_srt(file, events, 0.2)
+    sub = Sub(file)
+    subs = sub.load()
+
+    def prepare():
+        return lambda: sub.transform("srt", subs=subs)
+    return prepare
+
+
+@case("PGSReader", displaysets=1500, method="get_times")
+@case("PGSReader", displaysets=1500, method="count_images")
+def pgs(tmp, displaysets, method):
+    file = make_pgs(join(tmp, "bench.pgs"), displaysets)
+
+    def run():
+        with PGSReader(file) as p:
+            return getattr(p, method)()
+
+    def prepare():
+        return run
+    return prepare
+
+
+@case("SubTrack.lines", events=5000, trim=False)
+@case("SubTrack.lines", events=5000, trim=True)
+def lines(tmp, events, trim):
+    file = make_srt(join(tmp, "lines.srt"), events, 0.2)
+    window = Trim(start=600, end=1800) if trim else None
+
+    def prepare():
+        track = SubTrack(id=0, source=0, type="subtitles", codec="SubRip/SRT", language="spa", source_file=file, trim=window)
+        return lambda: track.lines
+    return prepare
+
+
+@case("SubAnalysis.lines VobSub", subpictures=3000, trim=True)
+def vobsub_lines(tmp, subpictures, trim):
+    file = make_vobsub(join(tmp, "vob.sub"), subpictures, forced=0.5)
+    window = Trim(start=600, end=1800) if trim else None
+
+    def prepare():
+        return lambda: SubAnalysis(file, text_subtitles=False, trim=window).lines
+    return prepare
+
+
+@case("VobSubReader.iter_subpictures", subpictures=3000)
+def vobsub(tmp, subpictures):
+    file = make_vobsub(join(tmp, "vob_iter.sub"), subpictures)
+
+    def run():
+        with VobSubReader(file) as vob:
+            return list(vob.iter_subpictures())
+
+    def prepare():
+        return run
+    return prepare
+
+
+@case("get_encoding_type", events=20000, encoding="utf-8")
+@case("get_encoding_type", events=20000, encoding="cp1252")
+def encoding(tmp, events, encoding):
+    file = make_srt(join(tmp, f"enc_{encoding}.srt"), events, 0.1, encoding=encoding)
+
+    def prepare():
+        util.ENCODINGS.clear()
+        return lambda: util.get_encoding_type(file)
+    return prepare
+
+
+@case("ebml.identify", clusters=300)
+def mkv_identify(tmp, clusters):
+    file = make_mkv(join(tmp, "identify.mkv"), clusters=clusters)
+
+    def prepare():
+        return lambda: identify(file)
+    return prepare
+
+
+# Sin mkvtoolnix mkvmerge -J se reproduce de una grabación, así que no
+# cuenta lanzar el proceso y el nombre del caso lo dice
+@case("MkvInfo.build", backend="mkvmerge" if which("mkvmerge") else "replay", clusters=300)
+@case("MkvInfo.build", backend="native", clusters=300)
+def mkv_info(tmp, backend, clusters):
+    file = make_mkv(join(tmp, "identify.mkv"), clusters=clusters)
+    runner = Runner()
+    if backend == "replay":
+        runner = ReplayRunner(record_identify(join(tmp, "identify"), file, clusters))
+    else:
+        # Es @cache: que el mkvmerge --version no caiga en la medida
+        mkvtoolnix_version()
+
+    def run():
+        with redirect_stdout(SINK):
+            return MkvInfo.build(file)
+
+    def prepare():
+        MkvInfo.native = backend == "native"
+        Shell.runner = runner
+        return run
+    return prepare
+
+
+@case("demux", clusters=300, trim=False)
+@case("demux", clusters=300, trim=True)
+def mkv_demux(tmp, clusters, trim):
+    file = make_mkv(join(tmp, "demux.mkv"), clusters=clusters)
+    outs = {2: join(tmp, "demux_2.srt"), 3: join(tmp, "demux_3.srt")}
+    window = Trim(start=200, end=260) if trim else None
+
+    def prepare():
+        return lambda: demux(file, outs, trim=window)
+    return prepare
+
+
+def replay(tmp: str, scenario: str):
+    """
+    Crea el escenario y hace que Shell lo reproduzca en vez de lanzar
+    mkvmerge y mkvextract
+    """
+    sc = SCENARIOS[scenario](join(tmp, scenario))
+    MkvInfo.native = False
+
+    def install():
+        Shell.runner = ReplayRunner(sc.recording)
+    return sc, install
+
+
+@case("MkvMerge.merge", scenario="remux+3subs")
+@case("MkvMerge.merge", scenario="anime20")
+@case("MkvMerge.merge", scenario="webdl")
+def merge(tmp, scenario):
+    sc, install = replay(tmp, scenario)
+    out = join(tmp, scenario, "out.mkv")
+
+    def run():
+        with redirect_stdout(SINK):
+            MkvMerge(vo=sc.vo, dry=True).merge(out, *sc.files)
+
+    def prepare():
+        install()
+        return run
+    return prepare
+
+
+@case("Mkv.all_tracks", scenario="anime20")
+def all_tracks(tmp, scenario):
+    sc, install = replay(tmp, scenario)
+
+    def prepare():
+        install()
+        mkv = Mkv(sc.files[0], vo=sc.vo)
+
+        def run():
+            with redirect_stdout(SINK):
+                return mkv.all_tracks
+        return run
+    return prepare
+
+
+@case("Mkv.fix_tracks", scenario="anime20")
+def fix_tracks(tmp, scenario):
+    sc, install = replay(tmp, scenario)
+
+    def prepare():
+        install()
+        mkv = Mkv(sc.files[0], vo=sc.vo)
+        with redirect_stdout(SINK):
+            mkv.all_tracks
+
+        def run():
+            with redirect_stdout(SINK):
+                return mkv.fix_tracks(dry=True)
+        return run
+    return prepare
@@ -0,0 +1,215 @@
+"""
+Generadores deterministas de ficheros sintéticos para los benchmarks.
+Con los mismos parámetros y semilla siempre se genera el mismo fichero
+"""
+import random
+import struct
+import zlib
+
+from core.pgsreader import END, ODS, PCS, PDS, WDS
+
+WORDS = (
+    "hola", "qué", "pasó", "señor", "camión", "mañana", "nunca", "siempre",
+    "vamos", "ahora", "dónde", "está", "él", "ella", "nosotros", "ya", "no"
+)
+
+
+def srt_time(ms: int) -> str:
+    return "%02d:%02d:%02d,%03d" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+
+def ass_time(ms: int) -> str:
+    cs = ms // 10
+    return "%d:%02d:%02d.%02d" % (cs // 360000, cs // 6000 % 60, cs // 100 % 60, cs % 100)
+
+
+def events(n: int, overlap: float, seed: int = 0):
+    """
+    n lineas (inicio, fin, texto) donde overlap es la proporción aproximada
+    de lineas que se solapan con la anterior. Se repiten textos y tiempos
+    para que improve tenga lineas que unir
+    """
+    rnd = random.Random(seed)
+    t = 0
+    prev = None
+    for i in range(n):
+        if prev and rnd.random() < overlap:
+            start = rnd.randint(prev[0], prev[1])
+        else:
+            t = t + rnd.randint(200, 3000)
+            start = t
+        end = start + rnd.randint(800, 4000)
+        if prev and rnd.random() < 0.05:
+            text = prev[2]
+        else:
+            text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 8)))
+            if rnd.random() < 0.2:
+                text = text + "\n" + " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 6)))
+        prev = (start, end, text)
+        t = max(t, start)
+        yield prev
+
+
+def make_srt(path: str, n: int, overlap: float = 0.1, seed: int = 0, encoding: str = "utf-8") -> str:
+    with open(path, "w", encoding=encoding) as f:
+        for i, (start, end, text) in enumerate(events(n, overlap, seed), start=1):
+            f.write("{}\n{} --> {}\n{}\n\n".format(i, srt_time(start), srt_time(end), text))
+    return path
+
+
+def make_ass(path: str, n: int, overlap: float = 0.1, seed: int = 0) -> str:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n")
+        f.write("[V4+ Styles]\n")
+        f.write("Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+                "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, "
+                "Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n")
+        for name, font in (("Default", "Arial"), ("Sign", "Open Sans Semibold")):
+            f.write("Style: {},{},60,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,0,2,10,10,10,1\n".format(name, font))
+        f.write("\n[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+        for i, (start, end, text) in enumerate(events(n, overlap, seed)):
+            style = "Sign" if i % 7 == 0 else "Default"
+            f.write("Dialogue: 0,{},{},{},,0,0,0,,{}\n".format(
+                ass_time(start), ass_time(end), style, text.replace("\n", "\\N")
+            ))
+    return path
+
+
+def pgs_segment(type_: int, ms: int, data: bytes) -> bytes:
+    return b"PG" + struct.pack(">IIBH", ms * 90, 0, type_, len(data)) + data
+
+
+def pgs_displayset(ms: int, num: int, image: int) -> bytes:
+    """
+    Display set que muestra una imagen de image bytes en ms
+    seguido del que la borra 2 segundos después
+    """
+    return b"".join((
+        pgs_segment(PCS, ms, struct.pack(">HHBHBBBB", 1920, 1080, 0x10, num, 0x80, 0, 0, 1) + struct.pack(">HBBHH", 0, 0, 0, 100, 900)),
+        pgs_segment(WDS, ms, struct.pack(">BBHHHH", 1, 0, 100, 900, 800, 100)),
+        pgs_segment(PDS, ms, bytes([0, 0, 1, 16, 128, 128, 255])),
+        pgs_segment(ODS, ms, struct.pack(">HBB", 0, 0, 0xC0) + (image + 4).to_bytes(3, 'big') + struct.pack(">HH", 800, 100) + b"\x00" * image),
+        pgs_segment(END, ms, b""),
+        pgs_segment(PCS, ms + 2000, struct.pack(">HHBHBBBB", 1920, 1080, 0x10, num, 0x00, 0, 0, 0)),
+        pgs_segment(WDS, ms + 2000, struct.pack(">BBHHHH", 1, 0, 100, 900, 800, 100)),
+        pgs_segment(END, ms + 2000, b""),
+    ))
+
+
+def make_pgs(path: str, n: int, image: int = 2000) -> str:
+    with open(path, "wb") as f:
+        for i in range(n):
+            f.write(pgs_displayset(i * 3000, i, image))
+    return path
+
+
+def vobsub_spu(forced: bool, duration: int, image: int) -> bytes:
+    ctrl = 4 + image
+    second = ctrl + 9
+    first = struct.pack(">HH", 0, second) + bytes((0x00 if forced else 0x01, 0x03, 0x12, 0x34, 0xFF))
+    last = struct.pack(">HH", duration * 90 // 1024, second) + bytes((0x02, 0xFF))
+    body = b"\x00" * image + first + last
+    return struct.pack(">HH", 4 + len(body), ctrl) + body
+
+
+def vobsub_pack(payload: bytes, index: int = 0) -> bytes:
+    pes = b"\x81\x80\x05\x21\x00\x01\x00\x01" + bytes((0x20 + index, )) + payload
+    pack = b"\x00\x00\x01\xba" + bytes((0x44, 0, 4, 0, 4, 1, 1, 0x89, 0xC3, 0xF8))
+    return pack + b"\x00\x00\x01\xbd" + struct.pack(">H", len(pes)) + pes
+
+
+def make_vobsub(path: str, n: int, forced: float = 0, image: int = 3000, seed: int = 0) -> str:
+    """
+    Genera path.idx y path.sub con n subpictures, cada una repartida en
+    dos paquetes, y devuelve la ruta del .sub
+    """
+    rnd = random.Random(seed)
+    base = path.rsplit(".", 1)[0]
+    with open(base + ".sub", "wb") as sub, open(base + ".idx", "w") as idx:
+        idx.write("# VobSub index file, v7 (do not modify this line!)\nsize: 720x480\n\nid: es, index: 0\n")
+        for i in range(n):
+            spu = vobsub_spu(rnd.random() < forced, rnd.randint(800, 4000), image)
+            half = len(spu) // 2
+            ms = i * 3000
+            idx.write("timestamp: {}:{:03d}, filepos: {:09x}\n".format(srt_time(ms)[:8], ms % 1000, sub.tell()))
+            sub.write(vobsub_pack(spu[:half]) + vobsub_pack(spu[half:]))
+        sub.write(b"\x00\x00\x01\xb9")
+    return base + ".sub"
+
+
+def ebml_id(id_: int) -> bytes:
+    return id_.to_bytes((id_.bit_length() + 7) // 8, 'big')
+
+
+def ebml(id_: int, data: bytes) -> bytes:
+    size = len(data)
+    length = 1
+    while size >= (1 << (7 * length)) - 1:
+        length = length + 1
+    return ebml_id(id_) + (size | (1 << (7 * length))).to_bytes(length, 'big') + data
+
+
+def ebml_uint(id_: int, value: int) -> bytes:
+    return ebml(id_, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+
+def ebml_str(id_: int, value: str) -> bytes:
+    return ebml(id_, value.encode("utf-8"))
+
+
+def make_mkv(path: str, clusters: int = 100, video: int = 48, video_size: int = 20000, subs: int = 2, seed: int = 0) -> str:
+    """
+    Matroska con un vídeo, un audio y subs pistas SRT (la última comprimida
+    con zlib), con SeekHead y Cues. Cada Cluster dura 2 segundos y tiene video
+    bloques de vídeo de video_size bytes, otros tantos de audio y una linea
+    en cada pista de subtítulos
+    """
+    rnd = random.Random(seed)
+    tracks = [
+        ebml(0xAE, ebml_uint(0xD7, 1) + ebml_uint(0x73C5, 1001) + ebml_uint(0x83, 1) + ebml_str(0x86, "V_MPEG4/ISO/AVC") +
+             ebml(0xE0, ebml_uint(0xB0, 1920) + ebml_uint(0xBA, 1080))),
+        ebml(0xAE, ebml_uint(0xD7, 2) + ebml_uint(0x73C5, 1002) + ebml_uint(0x83, 2) + ebml_str(0x86, "A_AC3") +
+             ebml_str(0x22B59C, "spa") + ebml(0xE1, ebml(0xB5, struct.pack(">d", 48000.0)) + ebml_uint(0x9F, 6))),
+    ]
+    for i in range(subs):
+        sub = ebml_uint(0xD7, 3 + i) + ebml_uint(0x73C5, 1003 + i) + ebml_uint(0x83, 0x11) + ebml_str(0x86, "S_TEXT/UTF8")
+        sub = sub + ebml_str(0x22B59C, "spa" if i % 2 == 0 else "eng")
+        if i == subs - 1:
+            sub = sub + ebml(0x6D80, ebml(0x6240, ebml(0x5034, ebml_uint(0x4254, 0))))
+        tracks.append(ebml(0xAE, sub))
+    head = ebml(0x1A45DFA3, ebml_str(0x4282, "matroska"))
+    info = ebml(0x1549A966, ebml_uint(0x2AD7B1, 1000000) + ebml(0x4489, struct.pack(">d", clusters * 2000.0)) +
+                ebml_str(0x7BA9, "bench") + ebml(0x73A4, bytes(rnd.getrandbits(8) for _ in range(16))))
+    tracks = ebml(0x1654AE6B, b"".join(tracks))
+    payload = bytes(rnd.getrandbits(8) for _ in range(video_size))
+    body = []
+    for c in range(clusters):
+        blocks = [ebml_uint(0xE7, c * 2000)]
+        for k in range(video):
+            ts = k * 2000 // video
+            blocks.append(ebml(0xA3, bytes((0x81, )) + struct.pack(">hB", ts, 0x80) + payload))
+            blocks.append(ebml(0xA3, bytes((0x82, )) + struct.pack(">hB", ts, 0x80) + payload[:video_size // 10]))
+        for i in range(subs):
+            text = "Linea {} de la pista {}".format(c, i).encode("utf-8")
+            if i == subs - 1:
+                text = zlib.compress(text)
+            blocks.append(ebml(0xA0, ebml(0xA1, bytes((0x80 | (3 + i), )) + struct.pack(">hB", 500, 0) + text) + ebml_uint(0x9B, 1200)))
+        body.append(ebml(0x1F43B675, b"".join(blocks)))
+
+    def seekhead(positions):
+        return ebml(0x114D9B74, b"".join(
+            ebml(0x4DBB, ebml(0x53AB, ebml_id(i)) + ebml(0x53AC, p.to_bytes(8, 'big')))
+            for i, p in positions
+        ))
+
+    size = len(seekhead([(0x1549A966, 0), (0x1654AE6B, 0), (0x1C53BB6B, 0)]))
+    pos = size + len(info) + len(tracks)
+    cues = []
+    for c, cluster in enumerate(body):
+        cues.append(ebml(0xBB, ebml_uint(0xB3, c * 2000) + ebml(0xB7, ebml_uint(0xF7, 1) + ebml(0xF1, pos.to_bytes(8, 'big')))))
+        pos = pos + len(cluster)
+    segment = seekhead([(0x1549A966, size), (0x1654AE6B, size + len(info)), (0x1C53BB6B, pos)])
+    segment = segment + info + tracks + b"".join(body) + ebml(0x1C53BB6B, b"".join(cues))
+    with open(path, "wb") as f:
+        f.write(head + ebml(0x18538067, segment))
+    return path
@@ -0,0 +1,35 @@
+"""
+Implementaciones anteriores que se conservan para comparar con ellas
+tanto el tiempo como el resultado
+"""
+from core.sub import SSAFile, SubLine, SubLines
+
+
+def get_collisions(subs: SSAFile):
+    """
+    Sub.get_collisions antes del barrido por eventos: un dict con las
+    lineas activas en cada milisegundo
+    """
+    subs.sort()
+    times = {}
+    for indx, s in subs._enum():
+        for i in range(s.start, s.end):
+            if i not in times:
+                times[i] = []
+            times[i].append(indx)
+
+    colls = set()
+    for k in sorted(times.keys()):
+        v = times[k]
+        if len(v) < 2:
+            continue
+        colls.add(tuple(v))
+
+    if len(colls) == 0:
+        return
+
+    for v in sorted(colls):
+        rtn = SubLines()
+        for indx in v:
+            rtn.append(SubLine(indx + 1, subs[indx]))
+        yield rtn
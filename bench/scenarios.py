@@ -0,0 +1,284 @@
+"""
+Escenarios de merge para medir MkvMerge.merge, Mkv.all_tracks y
+Mkv.fix_tracks sin mkvtoolnix. Cada escenario crea sus ficheros de entrada
+(los .mkv vacíos, los subtítulos externos de verdad) y una grabación con
+el mismo formato que la de MKVMRG_RECORD (ver core/replay.py) para
+reproducirla con ReplayRunner
+"""
+import json
+from os import makedirs
+from os.path import join
+from typing import Callable, Dict, List, NamedTuple
+
+from core.replay import Recording
+
+from .fixtures import make_ass, make_pgs, make_srt
+
+# (nombre, ISO 639-3, ISO 639-2, ISO 639-1)
+LANGUAGES = (
+    ("Arabic", "ara", "ara", "ar"),
+    ("Chinese", "zho", "chi", "zh"),
+    ("Dutch", "nld", "dut", "nl"),
+    ("English", "eng", "eng", "en"),
+    ("French", "fra", "fre", "fr"),
+    ("German", "deu", "ger", "de"),
+    ("Italian", "ita", "ita", "it"),
+    ("Japanese", "jpn", "jpn", "ja"),
+    ("Korean", "kor", "kor", "ko"),
+    ("Polish", "pol", "pol", "pl"),
+    ("Portuguese", "por", "por", "pt"),
+    ("Russian", "rus", "rus", "ru"),
+    ("Spanish", "spa", "spa", "es"),
+    ("Turkish", "tur", "tur", "tr"),
+    ("Undetermined", "und", "und", ""),
+)
+ISO_639_1 = {l[2]: l[3] for l in LANGUAGES}
+
+CHAPTERS = '''<?xml version="1.0"?>
+<!-- <!DOCTYPE Chapters SYSTEM "matroskachapters.dtd"> -->
+<Chapters>
+  <EditionEntry>
+{}
+  </EditionEntry>
+</Chapters>
+'''
+CHAPTER = '''    <ChapterAtom>
+      <ChapterTimeStart>00:{:02d}:00.000000000</ChapterTimeStart>
+      <ChapterDisplay>
+        <ChapterString>Capítulo {:02d}</ChapterString>
+      </ChapterDisplay>
+    </ChapterAtom>'''
+TAGS = '''<?xml version="1.0"?>
+<!-- <!DOCTYPE Tags SYSTEM "matroskatags.dtd"> -->
+<Tags>
+  <Tag>
+    <Simple>
+      <Name>COMMENT</Name>
+      <String>{}</String>
+    </Simple>
+  </Tag>
+</Tags>
+'''
+
+
+class Scenario(NamedTuple):
+    files: List[str]
+    recording: str
+    vo: str
+
+
+SCENARIOS: Dict[str, Callable[[str], Scenario]] = {}
+
+
+def scenario(name: str):
+    def wrapper(func):
+        SCENARIOS[name] = func
+        return func
+    return wrapper
+
+
+def list_languages() -> str:
+    lines = [
+        "{:<20} | {:<14} | {:<14} | {}".format("English language name", "ISO 639-3 code", "ISO 639-2 code", "ISO 639-1 code"),
+        "{}+{}+{}+{}".format("-" * 21, "-" * 16, "-" * 16, "-" * 15),
+    ]
+    for label, *cods in LANGUAGES:
+        lines.append("{:<20} | {:<14} | {:<14} | {}".format(label, *cods))
+    return "\n".join(lines) + "\n"
+
+
+def track(id: int, type: str, codec: str, codec_id: str, language: str, **properties) -> dict:
+    """
+    Pista con el formato de mkvmerge -J
+    """
+    props = dict(
+        number=id + 1,
+        uid=1000 + id,
+        codec_id=codec_id,
+        language=language,
+        language_ietf=ISO_639_1.get(language) or language,
+        default_track=id == 0,
+        forced_track=False,
+        enabled_track=True,
+    )
+    props.update(properties)
+    return dict(id=id, type=type, codec=codec, properties=props)
+
+
+def sub_track(id: int, codec: str, language: str, **properties) -> dict:
+    codec_id = {"SubStationAlpha": "S_TEXT/ASS", "SubRip/SRT": "S_TEXT/UTF8", "HDMV PGS": "S_HDMV/PGS"}[codec]
+    return track(id, "subtitles", codec, codec_id, language, text_subtitles=codec != "HDMV PGS", **properties)
+
+
+def identification(file: str, tracks: list, type: str = "Matroska", duration: int = None, title: str = None,
+                   attachments: tuple = (), chapters: int = 0) -> dict:
+    """
+    Salida de mkvmerge -J
+    """
+    properties = {}
+    if duration is not None:
+        properties.update(duration=duration, segment_uid="5f" * 16, is_providing_timestamps=True)
+    if title is not None:
+        properties['title'] = title
+    return dict(
+        attachments=[
+            dict(id=i, file_name=name, content_type=content_type, size=50000, properties=dict(uid=2000 + i))
+            for i, (name, content_type) in enumerate(attachments, start=1)
+        ],
+        chapters=[dict(num_entries=chapters)] if chapters else [],
+        container=dict(properties=properties, recognized=True, supported=True, type=type),
+        errors=[],
+        file_name=file,
+        global_tags=[],
+        identification_format_version=14,
+        track_tags=[],
+        tracks=tracks,
+        warnings=[],
+    )
+
+
+def empty(file: str) -> str:
+    with open(file, "wb"):
+        pass
+    return file
+
+
+def record_mkv(rec: Recording, file: str, js: dict, contents: Dict[int, Callable[[str], str]], tags: bool = True):
+    """
+    Graba mkvmerge -J de file y lo que extraería mkvextract: cada pista de
+    contents (id -> función que escribe la pista) y tags y capítulos.
+    Sin tags, como mkvextract no escribiría tags.xml, se graba que falta
+    """
+    rec.set_get(("mkvmerge", "-J", file), json.dumps(js, indent=2))
+    makedirs(join(rec.root, "files"), exist_ok=True)
+    for id, make in contents.items():
+        make(rec.file(file, "tracks", id))
+    if not tags:
+        rec.set_missing(file, "tags", None)
+    else:
+        with open(rec.file(file, "tags", None), "w", encoding="utf-8") as f:
+            f.write(TAGS.format("bench"))
+    if js['chapters']:
+        with open(rec.file(file, "chapters", None), "w", encoding="utf-8") as f:
+            f.write(CHAPTERS.format("\n".join(CHAPTER.format(i * 5, i + 1) for i in range(js['chapters'][0]['num_entries']))))
+
+
+def record_srt(rec: Recording, file: str, *tmp: str):
+    """
+    Graba mkvmerge -J de un srt externo, también para su copia en UTF-8
+    dentro de TMP si no lo está
+    """
+    for f in (file, ) + tmp:
+        js = identification(f, [sub_track(0, "SubRip/SRT", "und", encoding="UTF-8")], type="SRT subtitles")
+        rec.set_get(("mkvmerge", "-J", f), json.dumps(js, indent=2))
+
+
+def record_identify(root: str, file: str, clusters: int) -> str:
+    """
+    Grabación de mkvmerge -J de un Matroska de bench.fixtures.make_mkv con
+    2 subtítulos, para medir MkvInfo.build donde no hay mkvtoolnix
+    """
+    rec = Recording(root)
+    rec.set_get(("mkvmerge", "-J", file), json.dumps(identification(file, [
+        track(0, "video", "AVC/H.264/MPEG-4p10", "V_MPEG4/ISO/AVC", "und", pixel_dimensions="1920x1080"),
+        track(1, "audio", "AC-3", "A_AC3", "spa", audio_channels=6, audio_sampling_frequency=48000),
+        sub_track(2, "SubRip/SRT", "spa"),
+        sub_track(3, "SubRip/SRT", "eng"),
+    ], duration=clusters * 2 * 10**9, title="bench"), indent=2))
+    return rec.root
+
+
+def new_recording(root: str) -> Recording:
+    makedirs(root, exist_ok=True)
+    rec = Recording(join(root, "recording"))
+    rec.set_get(("mkvmerge", "--list-languages"), list_languages())
+    return rec
+
+
+@scenario("remux+3subs")
+def remux(root: str) -> Scenario:
+    """
+    Remux de una película con vídeo, 3 audios, 4 subtítulos (uno PGS) y
+    capítulos, más 3 subtítulos srt externos (uno en cp1252)
+    """
+    rec = new_recording(root)
+    mkv = empty(join(root, "2020 - Película.mkv"))
+    record_mkv(rec, mkv, identification(mkv, [
+        track(0, "video", "AVC/H.264/MPEG-4p10", "V_MPEG4/ISO/AVC", "eng", pixel_dimensions="1920x1080"),
+        track(1, "audio", "E-AC-3", "A_EAC3", "spa", audio_channels=6, track_name="Castellano"),
+        track(2, "audio", "DTS-HD Master Audio", "A_DTS", "eng", audio_channels=8),
+        track(3, "audio", "AC-3", "A_AC3", "eng", audio_channels=2, track_name="Commentary"),
+        sub_track(4, "SubRip/SRT", "spa", track_name="Forzados", forced_track=True),
+        sub_track(5, "SubRip/SRT", "spa"),
+        sub_track(6, "SubRip/SRT", "eng", track_name="SDH"),
+        sub_track(7, "HDMV PGS", "eng"),
+    ], duration=7200 * 10**9, title="Película", chapters=24), {
+        4: lambda f: make_srt(f, 40, 0.05, seed=4),
+        5: lambda f: make_srt(f, 1500, 0.1, seed=5),
+        6: lambda f: make_srt(f, 1700, 0.1, seed=6),
+        7: lambda f: make_pgs(f, 1500, image=500),
+    })
+    srts = [
+        make_srt(join(root, "2020 - Película.es.srt"), 1500, 0.1, seed=10, encoding="cp1252"),
+        make_srt(join(root, "2020 - Película.forzados.es.srt"), 35, 0.05, seed=11),
+        make_srt(join(root, "2020 - Película.en.srt"), 1600, 0.1, seed=12),
+    ]
+    record_srt(rec, srts[0], "{TMP}/2020 - Película.es.srt")
+    record_srt(rec, srts[1])
+    record_srt(rec, srts[2])
+    return Scenario([mkv] + srts, rec.root, "eng")
+
+
+@scenario("anime20")
+def anime(root: str) -> Scenario:
+    """
+    Capítulo de anime con 20 pistas: vídeo, 3 audios y 16 subtítulos ASS
+    en varios idiomas, fuentes adjuntas y capítulos
+    """
+    rec = new_recording(root)
+    mkv = empty(join(root, "[Fansub] Serie - 01 [1080p].mkv"))
+    langs = ("spa", "spa", "spa", "eng", "eng", "fre", "ger", "ita", "por", "rus", "ara", "pol", "dut", "tur", "kor", "chi")
+    names = {0: "Castellano", 1: "Carteles", 2: "Latino", 3: "English", 4: "Signs"}
+    tracks = [
+        track(0, "video", "HEVC/H.265/MPEG-H", "V_MPEGH/ISO/HEVC", "jpn", pixel_dimensions="1920x1080"),
+        track(1, "audio", "FLAC", "A_FLAC", "jpn", audio_channels=2),
+        track(2, "audio", "AAC", "A_AAC", "spa", audio_channels=2, track_name="Castellano"),
+        track(3, "audio", "AAC", "A_AAC", "eng", audio_channels=2),
+    ]
+    contents = {}
+    for i, lang in enumerate(langs):
+        id = len(tracks)
+        props = dict(track_name=names[i]) if i in names else {}
+        if i == 2:
+            props['language_ietf'] = "es-419"
+        tracks.append(sub_track(id, "SubStationAlpha", lang, **props))
+        signs = i in (1, 4)
+        contents[id] = (lambda n, seed: lambda f: make_ass(f, n, 0.3, seed=seed))(60 if signs else 450, id)
+    fonts = [("Font{:02d}.ttf".format(i), "font/ttf") for i in range(8)] + [("cover.jpg", "image/jpeg")]
+    record_mkv(rec, mkv, identification(
+        mkv, tracks, duration=1440 * 10**9, title="Serie - 01", attachments=fonts, chapters=6
+    ), contents)
+    return Scenario([mkv], rec.root, "jpn")
+
+
+@scenario("webdl")
+def webdl(root: str) -> Scenario:
+    """
+    Capítulo de una serie sin tags ni capítulos (mkvextract no escribe
+    tags.xml): vídeo, 2 audios y 2 subtítulos SRT, más un srt externo
+    """
+    rec = new_recording(root)
+    mkv = empty(join(root, "Serie - 1x01.mkv"))
+    record_mkv(rec, mkv, identification(mkv, [
+        track(0, "video", "AVC/H.264/MPEG-4p10", "V_MPEG4/ISO/AVC", "eng", pixel_dimensions="1920x1080"),
+        track(1, "audio", "E-AC-3", "A_EAC3", "eng", audio_channels=6),
+        track(2, "audio", "AAC", "A_AAC", "spa", audio_channels=2),
+        sub_track(3, "SubRip/SRT", "eng"),
+        sub_track(4, "SubRip/SRT", "spa", track_name="Forzados", forced_track=True),
+    ], duration=2700 * 10**9), {
+        3: lambda f: make_srt(f, 600, 0.1, seed=3),
+        4: lambda f: make_srt(f, 20, 0.05, seed=4),
+    }, tags=False)
+    srt = make_srt(join(root, "Serie - 1x01.es.srt"), 580, 0.1, seed=5)
+    record_srt(rec, srt)
+    return Scenario([mkv, srt], rec.root, "eng")
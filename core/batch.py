@@ -0,0 +1,74 @@
+import time
+from glob import glob, has_magic
+from os import access, R_OK, walk
+from os.path import isdir, isfile, join, getsize
+from typing import Callable, List, Dict
+
+from .trace import TRACE
+from .util import TMP, pmap
+
+
+def expand_files(paths: List[str], exts=("mkv", )) -> List[str]:
+    """
+    Expande directorios (recursivamente) y globs a la lista de ficheros
+    con alguna de las extensiones dadas, sin repetidos y en orden
+    """
+    files = []
+    for path in paths:
+        if isdir(path):
+            for root, dirs, names in walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.rsplit(".", 1)[-1].lower() in exts:
+                        files.append(join(root, name))
+        elif has_magic(path):
+            files.extend(f for f in sorted(glob(path, recursive=True)) if isfile(f))
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+
+class Batch:
+    """
+    Aplica func a una lista de ficheros con un pool de jobs hilos.
+    func devuelve una etiqueta con el resultado de cada fichero, que se
+    usa para el resumen final. Los errores de un fichero no detienen el lote
+    """
+
+    def __init__(self, func: Callable[[str], str], jobs: int = 1):
+        self.func = func
+        self.jobs = jobs
+        self.results: Dict[str, str] = {}
+
+    def do(self, file: str) -> str:
+        print("#", file)
+        if not (isfile(file) and access(file, R_OK)):
+            print("# SKIP no se puede leer")
+            return "ilegible"
+        with TRACE.span("Batch.do", file=file) as span, TMP.job():
+            try:
+                span['result'] = self.func(file)
+            except (Exception, SystemExit) as e:
+                print("# ERROR", e)
+                span['result'] = "error"
+        return span['result']
+
+    def run(self, files: List[str]) -> Dict[str, str]:
+        start = time.time()
+        results = pmap(self.do, files, jobs=self.jobs)
+        self.results = dict(zip(files, results))
+        self.summary(time.time() - start)
+        return self.results
+
+    def summary(self, seconds: float):
+        total: Dict[str, int] = {}
+        for r in self.results.values():
+            total[r] = total.get(r, 0) + 1
+        size = sum(getsize(f) for f, r in self.results.items() if r != "ilegible")
+        speed = len(self.results) / seconds if seconds > 0 else 0
+        print("")
+        print("# {} ficheros en {:.1f}s ({:.2f} ficheros/s, {:.1f} MB/s)".format(
+            len(self.results), seconds, speed, (size / seconds / 1024 / 1024) if seconds > 0 else 0
+        ))
+        for label, count in sorted(total.items()):
+            print("#   {}: {}".format(label, count))
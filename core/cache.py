@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import threading
+from os import environ, makedirs, stat
+from os.path import dirname, expanduser, join, realpath
+
+CACHE_DIR = environ.get(
+    "MKVMRG_CACHE",
+    join(environ.get("XDG_CACHE_HOME", expanduser("~/.cache")), "mkvmrg")
+)
+
+
+class FileCache:
+    """
+    Cache en sqlite de resultados calculados a partir de un fichero.
+    Cada entrada se guarda por (tabla, ruta) junto con la firma del fichero
+    (inode, tamaño, mtime, ctime) y una versión. Si al leer la firma o la
+    versión no coinciden la entrada se considera obsoleta.
+    Se usa una conexión por hilo y el modo WAL de sqlite para que varios
+    procesos puedan leer y escribir a la vez.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.enabled = environ.get("MKVMRG_NO_CACHE") is None
+        self.__local = threading.local()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self.__local, "db", None)
+        if db is None:
+            makedirs(dirname(self.file), exist_ok=True)
+            db = sqlite3.connect(self.file, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.__local.db = db
+            self.__local.tables = set()
+        return db
+
+    def __table(self, table: str) -> str:
+        db = self.db
+        if table in self.__local.tables:
+            return table
+        db.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                path TEXT PRIMARY KEY,
+                firm TEXT NOT NULL,
+                version TEXT,
+                data TEXT NOT NULL
+            )
+        ''')
+        self.__local.tables.add(table)
+        return table
+
+    @staticmethod
+    def firm(file: str) -> str:
+        st = stat(file)
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{st.st_ctime_ns}"
+
+    def get(self, table: str, file: str, version: str = None):
+        if not self.enabled:
+            return None
+        try:
+            path = realpath(file)
+            firm = FileCache.firm(path)
+            row = self.db.execute(
+                f"SELECT firm, version, data FROM {self.__table(table)} WHERE path = ?",
+                (path, )
+            ).fetchone()
+        except (OSError, sqlite3.Error):
+            return None
+        if row is None or row[:2] != (firm, version):
+            return None
+        return json.loads(row[2])
+
+    def set(self, table: str, file: str, data, version: str = None):
+        if not self.enabled:
+            return
+        try:
+            path = realpath(file)
+            self.db.execute(
+                f"INSERT OR REPLACE INTO {self.__table(table)} (path, firm, version, data) VALUES (?, ?, ?, ?)",
+                (path, FileCache.firm(path), version, json.dumps(data))
+            )
+        except (OSError, sqlite3.Error):
+            pass
+
+
+CACHE = FileCache(join(CACHE_DIR, "cache.sqlite"))
@@ -0,0 +1,300 @@
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from os import remove
+from typing import Dict, List, Tuple
+
+from .ebml import (BLOCK, BLOCKDURATION, BLOCKGROUP, CLUSTER,
+                   CLUSTERTIMESTAMP, SIMPLEBLOCK, EbmlError, MatroskaInfo)
+
+#########
+### https://www.matroska.org/technical/subtitles.html
+### https://www.matroska.org/technical/notes.html#block-structure
+#########
+
+PG_HEADER = struct.Struct(">2sII")
+
+# Segundos que se empieza a leer antes del inicio del recorte para no
+# perder los subtítulos que empiezan antes y siguen en pantalla
+TRIM_MARGIN = 30
+
+ASS_FORMAT = "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text"
+SSA_FORMAT = "Format: Marked, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text"
+
+
+class SubWriter(ABC):
+    """
+    Escribe en out los bloques de una pista de subtítulos según se leen,
+    con el mismo formato que mkvextract
+    """
+    binary = False
+
+    def __init__(self, out: str, private: bytes):
+        self.out = out
+        self.private = private
+        if self.binary:
+            self.file = open(out, "wb")
+        else:
+            self.file = open(out, "w", encoding="utf-8", newline="\n")
+
+    @abstractmethod
+    def add(self, start: int, duration: int, data: bytes):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class SrtWriter(SubWriter):
+
+    def __init__(self, out: str, private: bytes):
+        super().__init__(out, private)
+        self.count = 0
+
+    @staticmethod
+    def time(ns: int) -> str:
+        ms = ns // 1000000
+        return "%02d:%02d:%02d,%03d" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+    def add(self, start: int, duration: int, data: bytes):
+        self.count = self.count + 1
+        text = data.decode("utf-8", errors="replace").replace("\r\n", "\n")
+        self.file.write("{}\n{} --> {}\n{}\n\n".format(
+            self.count, SrtWriter.time(start), SrtWriter.time(start + duration), text
+        ))
+
+
+class AssWriter(SubWriter):
+
+    def __init__(self, out: str, private: bytes, ssa: bool = False):
+        super().__init__(out, private)
+        self.ssa = ssa
+        # Las lineas se escriben al final ordenadas por ReadOrder
+        self.lines: List[Tuple[int, str]] = []
+        header = self.private.decode("utf-8", errors="replace").replace("\r\n", "\n").rstrip()
+        if "[Events]" not in header:
+            header = header + "\n\n[Events]\n" + (SSA_FORMAT if self.ssa else ASS_FORMAT)
+        self.file.write(header + "\n")
+
+    @staticmethod
+    def time(ns: int) -> str:
+        cs = ns // 10000000
+        return "%d:%02d:%02d.%02d" % (cs // 360000, cs // 6000 % 60, cs // 100 % 60, cs % 100)
+
+    def add(self, start: int, duration: int, data: bytes):
+        # ReadOrder, Layer, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+        order, layer, rest = data.decode("utf-8", errors="replace").split(",", 2)
+        if self.ssa and not layer.startswith("Marked"):
+            layer = "Marked=" + layer
+        line = "Dialogue: {},{},{},{}".format(
+            layer, AssWriter.time(start), AssWriter.time(start + duration), rest
+        )
+        self.lines.append((int(order or 0), line))
+
+    def close(self):
+        self.lines.sort(key=lambda x: x[0])
+        for _, line in self.lines:
+            self.file.write(line + "\n")
+        super().close()
+
+
+class PgsWriter(SubWriter):
+    binary = True
+
+    def add(self, start: int, duration: int, data: bytes):
+        pts = (start * 9 // 100000) & 0xFFFFFFFF
+        pos = 0
+        while pos + 3 <= len(data):
+            end = pos + 3 + int.from_bytes(data[pos + 1:pos + 3], 'big')
+            self.file.write(PG_HEADER.pack(b"PG", pts, 0))
+            self.file.write(data[pos:end])
+            pos = end
+
+
+WRITERS = {
+    "S_TEXT/UTF8": SrtWriter,
+    "S_TEXT/ASS": AssWriter,
+    "S_ASS": AssWriter,
+    "S_TEXT/SSA": lambda o, p: AssWriter(o, p, ssa=True),
+    "S_SSA": lambda o, p: AssWriter(o, p, ssa=True),
+    "S_HDMV/PGS": PgsWriter,
+}
+
+
+class Decoder:
+    """
+    Deshace la compresión de los bloques de una pista (ContentEncoding)
+    """
+
+    def __init__(self, encodings: List[dict]):
+        self.encodings = encodings or []
+        for enc in self.encodings:
+            if enc.get('encrypted'):
+                raise EbmlError("pista cifrada")
+            if enc.get('algo') not in (None, 0, 3):
+                raise EbmlError("compresión no soportada: {}".format(enc.get('algo')))
+
+    def __call__(self, data: bytes) -> bytes:
+        # Se aplican en orden inverso al que se usaron al escribir
+        for enc in reversed(self.encodings):
+            if enc.get('algo') == 0:
+                data = zlib.decompress(data)
+            elif enc.get('algo') == 3:
+                data = bytes.fromhex(enc.get('settings', '')) + data
+        return data
+
+
+class SubDemuxer:
+    """
+    Extracción de pistas de subtítulos sin mkvextract.
+    Se recorren las cabeceras de los Cluster y sus bloques, y del contenido
+    solo se lee el de los bloques de las pistas pedidas; el de vídeo y audio
+    se salta usando el tamaño de los elementos EBML
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.info = MatroskaInfo(file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.info.reader.close()
+
+    def prepare(self, outs: Dict[int, str]) -> Dict[int, Tuple[int, SubWriter, Decoder, int]]:
+        """
+        Devuelve {TrackNumber: (id, writer, decoder, default_duration)}
+        para las pistas que se pueden extraer de forma nativa
+        """
+        self.info.parse_header()
+        self.info.parse_info()
+        found = {}
+        for track in self.info.parse_tracks():
+            prop = track['properties']
+            if track['id'] not in outs:
+                continue
+            build = WRITERS.get(prop.get('codec_id'))
+            if build is None:
+                continue
+            try:
+                decoder = Decoder(prop.get('content_encoding'))
+            except EbmlError:
+                continue
+            private = bytes.fromhex(prop.get('codec_private_data', ''))
+            found[prop['number']] = (track['id'], build, private, decoder, prop.get('default_duration', 0))
+        # Los ficheros de salida se abren cuando ya se sabe que hay que escribirlos
+        return {
+            num: (id_, build(outs[id_], private), decoder, default_duration)
+            for num, (id_, build, private, decoder, default_duration) in found.items()
+        }
+
+    def window(self, trim) -> Tuple[int, int]:
+        """
+        Posición del Cluster desde el que hay que leer y tiempo en ns a partir
+        del cual se puede dejar de leer para cubrir el recorte trim.
+        La posición sale del índice Cues, si no lo hay se lee desde el principio
+        """
+        if trim is None:
+            return self.info.first_cluster, None
+        start = int((trim.start - TRIM_MARGIN) * 1000000000)
+        end = int(trim.end * 1000000000)
+        cues = self.info.parse_cues()
+        i = bisect_right(cues, (start, float('inf'))) - 1
+        if i < 0:
+            return self.info.first_cluster, end
+        return cues[i][1], end
+
+    def blocks(self, numbers: set, trim=None):
+        """
+        Genera (TrackNumber, inicio en ns, duración en ns o None, datos)
+        de los bloques de las pistas indicadas. Con trim solo se recorren
+        los Cluster que lo cubren
+        """
+        rd = self.info.reader
+        rd.advise_random()
+        scale = self.info.timestamp_scale
+        end = self.info.segment_end
+        pos, stop = self.window(trim)
+        cluster_ts = 0
+        while pos is not None and pos < end:
+            id_, data, size = rd.element(pos)
+            if id_ == CLUSTER:
+                # Se entra en el Cluster, sus hijos se recorren en este mismo bucle
+                pos = data
+                continue
+            if size is None:
+                raise EbmlError("{} elemento {:X} de tamaño desconocido".format(self.file, id_))
+            if id_ == CLUSTERTIMESTAMP:
+                cluster_ts = rd.uint(data, size)
+                if stop is not None and cluster_ts * scale > stop:
+                    return
+            elif id_ == SIMPLEBLOCK:
+                block = self.block(data, size, numbers)
+                if block is not None:
+                    num, ts, payload = block
+                    yield num, (cluster_ts + ts) * scale, None, payload
+            elif id_ == BLOCKGROUP:
+                block = duration = None
+                for cid, cdata, csize in rd.children(data, data + size):
+                    if cid == BLOCK:
+                        block = self.block(cdata, csize, numbers)
+                        if block is None:
+                            break
+                    elif cid == BLOCKDURATION:
+                        duration = rd.uint(cdata, csize) * scale
+                if block is not None:
+                    num, ts, payload = block
+                    yield num, (cluster_ts + ts) * scale, duration, payload
+            pos = data + size
+
+    def block(self, data: int, size: int, numbers: set) -> Tuple[int, int, bytes]:
+        rd = self.info.reader
+        num, ln, _ = rd.vint(data)
+        if num not in numbers:
+            return None
+        ts, flags = struct.unpack_from(">hB", rd._mmap, data + ln)
+        if flags & 0x06:
+            raise EbmlError("{} pista {} con lacing".format(self.file, num))
+        head = ln + 3
+        return num, ts, rd.binary(data + head, size - head)
+
+    def demux(self, outs: Dict[int, str], trim=None) -> Dict[int, str]:
+        """
+        Guarda en outs[id] las pistas que se pueden extraer de forma nativa
+        y devuelve el subconjunto de outs que se ha escrito.
+        Con trim solo se extrae lo que cae en ese recorte (más TRIM_MARGIN).
+        Lanza EbmlError si el fichero no se puede recorrer
+        """
+        wanted = self.prepare(outs)
+        if not wanted:
+            return {}
+        try:
+            for num, start, duration, payload in self.blocks(set(wanted.keys()), trim=trim):
+                _, writer, decoder, default_duration = wanted[num]
+                writer.add(start, default_duration if duration is None else duration, decoder(payload))
+        except BaseException:
+            # Que no quede nada a medias: esas pistas irán por mkvextract
+            for _, writer, _, _ in wanted.values():
+                writer.close()
+                remove(writer.out)
+            raise
+        done = {}
+        for id_, writer, _, _ in wanted.values():
+            writer.close()
+            done[id_] = outs[id_]
+        return done
+
+
+def demux(file: str, outs: Dict[int, str], trim=None) -> Dict[int, str]:
+    """
+    Extrae de forma nativa las pistas de subtítulos {id: salida} que se
+    puedan (texto y PGS sin lacing) y devuelve las que se han escrito.
+    Las que falten se tienen que extraer con mkvextract
+    """
+    with SubDemuxer(file) as dmx:
+        try:
+            return dmx.demux(outs, trim=trim)
+        except (IndexError, ValueError, struct.error, zlib.error) as e:
+            raise EbmlError("{} {}".format(file, e))
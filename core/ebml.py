@@ -0,0 +1,505 @@
+import mmap
+import struct
+from os import fstat
+from os.path import basename
+from typing import Dict, Iterator, List, Tuple
+
+#########
+### https://www.matroska.org/technical/elements.html
+### https://github.com/ietf-wg-cellar/ebml-specification
+#########
+
+# Versión del json que devuelve identify, para invalidar lo guardado en cache
+IDENTIFY_VERSION = "native-1"
+
+EBML = 0x1A45DFA3
+DOCTYPE = 0x4282
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEKID = 0x53AB
+SEEKPOSITION = 0x53AC
+INFO = 0x1549A966
+SEGMENTUID = 0x73A4
+TIMESTAMPSCALE = 0x2AD7B1
+DURATION = 0x4489
+TITLE = 0x7BA9
+TRACKS = 0x1654AE6B
+TRACKENTRY = 0xAE
+TRACKNUMBER = 0xD7
+TRACKUID = 0x73C5
+TRACKTYPE = 0x83
+FLAGENABLED = 0xB9
+FLAGDEFAULT = 0x88
+FLAGFORCED = 0x55AA
+DEFAULTDURATION = 0x23E383
+NAME = 0x536E
+LANGUAGE = 0x22B59C
+LANGUAGEIETF = 0x22B59D
+CODECID = 0x86
+CODECPRIVATE = 0x63A2
+VIDEO = 0xE0
+PIXELWIDTH = 0xB0
+PIXELHEIGHT = 0xBA
+DISPLAYWIDTH = 0x54B0
+DISPLAYHEIGHT = 0x54BA
+AUDIO = 0xE1
+SAMPLINGFREQUENCY = 0xB5
+CHANNELS = 0x9F
+BITDEPTH = 0x6264
+CONTENTENCODINGS = 0x6D80
+CONTENTENCODING = 0x6240
+CONTENTCOMPRESSION = 0x5034
+CONTENTCOMPALGO = 0x4254
+CONTENTCOMPSETTINGS = 0x4255
+CONTENTENCRYPTION = 0x5035
+ATTACHMENTS = 0x1941A469
+ATTACHEDFILE = 0x61A7
+FILEDESCRIPTION = 0x467E
+FILENAME = 0x466E
+FILEMIMETYPE = 0x4660
+FILEDATA = 0x465C
+FILEUID = 0x46AE
+CHAPTERS = 0x1043A770
+EDITIONENTRY = 0x45B9
+CHAPTERATOM = 0xB6
+CLUSTER = 0x1F43B675
+CLUSTERTIMESTAMP = 0xE7
+SIMPLEBLOCK = 0xA3
+BLOCKGROUP = 0xA0
+BLOCK = 0xA1
+BLOCKDURATION = 0x9B
+CUES = 0x1C53BB6B
+CUEPOINT = 0xBB
+CUETIME = 0xB3
+CUETRACKPOSITIONS = 0xB7
+CUECLUSTERPOSITION = 0xF1
+TAGS = 0x1254C367
+
+TRACK_TYPE = {
+    1: "video",
+    2: "audio",
+    17: "subtitles",
+}
+
+# Nombres de codec tal y como los muestra mkvmerge -J.
+# Los que mkvmerge deduce leyendo los datos (DTS-HD, TrueHD Atmos, VC-1...)
+# no están y hacen que se use mkvmerge
+CODEC = {
+    "V_MPEG4/ISO/AVC": "AVC/H.264/MPEG-4p10",
+    "V_MPEGH/ISO/HEVC": "HEVC/H.265/MPEG-H",
+    "V_MPEG4/ISO/ASP": "MPEG-4p2",
+    "V_MPEG4/ISO/SP": "MPEG-4p2",
+    "V_MPEG4/ISO/AP": "MPEG-4p2",
+    "V_AV1": "AV1",
+    "V_VP9": "VP9",
+    "V_VP8": "VP8",
+    "A_AAC": "AAC",
+    "A_AAC/MPEG4/LC": "AAC",
+    "A_AAC/MPEG4/LC/SBR": "AAC",
+    "A_AAC/MPEG2/LC": "AAC",
+    "A_AC3": "AC-3",
+    "A_EAC3": "E-AC-3",
+    "A_MPEG/L3": "MP3",
+    "A_FLAC": "FLAC",
+    "A_OPUS": "Opus",
+    "A_VORBIS": "Vorbis",
+    "A_PCM/INT/LIT": "PCM",
+    "S_TEXT/UTF8": "SubRip/SRT",
+    "S_TEXT/ASS": "SubStationAlpha",
+    "S_TEXT/SSA": "SubStationAlpha",
+    "S_ASS": "SubStationAlpha",
+    "S_SSA": "SubStationAlpha",
+    "S_HDMV/PGS": "HDMV PGS",
+    "S_VOBSUB": "VobSub",
+}
+
+
+class EbmlError(Exception):
+    '''Raised when the file can not be read as Matroska'''
+
+
+class EbmlReader:
+    """
+    Lector de elementos EBML sobre un mmap del fichero. Solo se leen las
+    cabeceras de los elementos que se recorren, el contenido de los que
+    se saltan no se llega a tocar
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self._mmap = None
+        with open(file, 'rb') as f:
+            if fstat(f.fileno()).st_size == 0:
+                raise EbmlError("{} está vacío".format(file))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self._mmap)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def vint(self, pos: int, mask: bool = True) -> Tuple[int, int, int]:
+        """
+        Lee un entero de longitud variable y devuelve (valor, longitud, todo_unos)
+        """
+        if pos >= self.size:
+            raise EbmlError("{} fin de fichero inesperado en {}".format(self.file, pos))
+        first = self._mmap[pos]
+        length = 1
+        while length <= 8 and not (first & (0x80 >> (length - 1))):
+            length = length + 1
+        if length > 8 or pos + length > self.size:
+            raise EbmlError("{} vint no válido en {}".format(self.file, pos))
+        value = int.from_bytes(self._mmap[pos:pos + length], 'big')
+        ones = (1 << (7 * length)) - 1
+        if mask:
+            value = value & ones
+        return value, length, value == ones
+
+    def element(self, pos: int) -> Tuple[int, int, int]:
+        """
+        Cabecera del elemento en pos: (id, inicio de los datos, tamaño)
+        El tamaño es None si es desconocido
+        """
+        id_, ln, _ = self.vint(pos, mask=False)
+        size, sln, unknown = self.vint(pos + ln)
+        return id_, pos + ln + sln, (None if unknown else size)
+
+    def children(self, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+        pos = start
+        while pos < end:
+            id_, data, size = self.element(pos)
+            if size is None:
+                size = end - data
+            yield id_, data, size
+            pos = data + size
+
+    def advise_random(self):
+        """
+        Evita la lectura anticipada del kernel: al saltar el contenido de los
+        bloques de vídeo y audio solo se deben leer las páginas de las cabeceras
+        """
+        if hasattr(mmap, "MADV_RANDOM"):
+            self._mmap.madvise(mmap.MADV_RANDOM)
+
+    def uint(self, pos: int, size: int) -> int:
+        return int.from_bytes(self._mmap[pos:pos + size], 'big')
+
+    def double(self, pos: int, size: int) -> float:
+        if size == 4:
+            return struct.unpack_from(">f", self._mmap, pos)[0]
+        if size == 8:
+            return struct.unpack_from(">d", self._mmap, pos)[0]
+        return 0.0
+
+    def string(self, pos: int, size: int) -> str:
+        return bytes(self._mmap[pos:pos + size]).rstrip(b'\x00').decode('utf-8', errors='replace')
+
+    def binary(self, pos: int, size: int) -> bytes:
+        return bytes(self._mmap[pos:pos + size])
+
+
+class MatroskaInfo:
+    """
+    Identificación de un fichero Matroska sin usar mkvmerge: se recorre la
+    cabecera del Segment siguiendo el SeekHead y nunca se leen los Cluster.
+    to_json devuelve lo mismo (en la parte que usa este proyecto) que mkvmerge -J
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.reader = EbmlReader(file)
+        self.top: Dict[int, int] = {}
+        self.timestamp_scale = 1000000
+        self.segment_start = None
+        self.segment_end = None
+        self.first_cluster = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reader.close()
+
+    def parse_header(self):
+        rd = self.reader
+        id_, data, size = rd.element(0)
+        if id_ != EBML:
+            raise EbmlError("{} no es un fichero EBML".format(self.file))
+        doctype = None
+        for cid, cdata, csize in rd.children(data, data + size):
+            if cid == DOCTYPE:
+                doctype = rd.string(cdata, csize)
+        if doctype not in ("matroska", "webm"):
+            raise EbmlError("{} DocType no soportado: {}".format(self.file, doctype))
+        id_, data, size = rd.element(data + size)
+        if id_ != SEGMENT:
+            raise EbmlError("{} no se encuentra el Segment".format(self.file))
+        self.segment_start = data
+        self.segment_end = rd.size if size is None else min(rd.size, data + size)
+        # Elementos de primer nivel anteriores al primer Cluster
+        pos = data
+        while pos < self.segment_end:
+            cid, cdata, csize = rd.element(pos)
+            if cid == CLUSTER:
+                self.first_cluster = pos
+                if SEEKHEAD not in self.top:
+                    # Lo que haya detrás de los Cluster solo se encuentra con el SeekHead
+                    raise EbmlError("{} sin SeekHead".format(self.file))
+                break
+            if csize is None:
+                raise EbmlError("{} elemento {:X} de tamaño desconocido".format(self.file, cid))
+            if cid not in self.top:
+                self.top[cid] = pos
+            if cid == SEEKHEAD:
+                self.parse_seekhead(cdata, csize)
+            pos = cdata + csize
+
+    def parse_seekhead(self, data: int, size: int):
+        rd = self.reader
+        for cid, cdata, csize in rd.children(data, data + size):
+            if cid != SEEK:
+                continue
+            seek_id = seek_pos = None
+            for sid, sdata, ssize in rd.children(cdata, cdata + csize):
+                if sid == SEEKID:
+                    seek_id = rd.uint(sdata, ssize)
+                if sid == SEEKPOSITION:
+                    seek_pos = self.segment_start + rd.uint(sdata, ssize)
+            if seek_id is None or seek_pos is None or seek_id in self.top:
+                continue
+            self.top[seek_id] = seek_pos
+            if seek_id == SEEKHEAD:
+                eid, edata, esize = rd.element(seek_pos)
+                if eid == SEEKHEAD and esize is not None:
+                    self.parse_seekhead(edata, esize)
+
+    def get(self, id_: int) -> Tuple[int, int]:
+        pos = self.top.get(id_)
+        if pos is None:
+            return None
+        cid, data, size = self.reader.element(pos)
+        if cid != id_ or size is None:
+            raise EbmlError("{} SeekHead apunta a un elemento incorrecto {:X}".format(self.file, id_))
+        return data, size
+
+    def parse_info(self) -> dict:
+        rd = self.reader
+        prop = {}
+        info = self.get(INFO)
+        if info is None:
+            raise EbmlError("{} sin Info".format(self.file))
+        duration = None
+        for cid, data, size in rd.children(info[0], info[0] + info[1]):
+            if cid == TIMESTAMPSCALE:
+                self.timestamp_scale = rd.uint(data, size)
+            elif cid == DURATION:
+                duration = rd.double(data, size)
+            elif cid == TITLE:
+                prop['title'] = rd.string(data, size)
+            elif cid == SEGMENTUID:
+                prop['segment_uid'] = rd.binary(data, size).hex()
+        if duration is not None:
+            prop['duration'] = int(duration * self.timestamp_scale)
+        prop['timestamp_scale'] = self.timestamp_scale
+        return prop
+
+    def parse_track(self, data: int, size: int) -> dict:
+        rd = self.reader
+        prop = dict(
+            default_track=True,
+            forced_track=False,
+            enabled_track=True,
+            language="eng",
+        )
+        ttype = None
+        for cid, cdata, csize in rd.children(data, data + size):
+            if cid == TRACKNUMBER:
+                prop['number'] = rd.uint(cdata, csize)
+            elif cid == TRACKUID:
+                prop['uid'] = rd.uint(cdata, csize)
+            elif cid == TRACKTYPE:
+                ttype = TRACK_TYPE.get(rd.uint(cdata, csize))
+            elif cid == FLAGENABLED:
+                prop['enabled_track'] = bool(rd.uint(cdata, csize))
+            elif cid == FLAGDEFAULT:
+                prop['default_track'] = bool(rd.uint(cdata, csize))
+            elif cid == FLAGFORCED:
+                prop['forced_track'] = bool(rd.uint(cdata, csize))
+            elif cid == DEFAULTDURATION:
+                prop['default_duration'] = rd.uint(cdata, csize)
+            elif cid == NAME:
+                prop['track_name'] = rd.string(cdata, csize)
+            elif cid == LANGUAGE:
+                prop['language'] = rd.string(cdata, csize)
+            elif cid == LANGUAGEIETF:
+                prop['language_ietf'] = rd.string(cdata, csize)
+            elif cid == CODECID:
+                prop['codec_id'] = rd.string(cdata, csize)
+            elif cid == CODECPRIVATE:
+                prop['codec_private_length'] = csize
+                prop['codec_private_data'] = rd.binary(cdata, csize).hex()
+            elif cid == VIDEO:
+                dims = {}
+                for vid, vdata, vsize in rd.children(cdata, cdata + csize):
+                    dims[vid] = rd.uint(vdata, vsize)
+                if PIXELWIDTH in dims and PIXELHEIGHT in dims:
+                    prop['pixel_dimensions'] = "{}x{}".format(dims[PIXELWIDTH], dims[PIXELHEIGHT])
+                    prop['display_dimensions'] = "{}x{}".format(
+                        dims.get(DISPLAYWIDTH, dims[PIXELWIDTH]),
+                        dims.get(DISPLAYHEIGHT, dims[PIXELHEIGHT])
+                    )
+            elif cid == AUDIO:
+                for aid, adata, asize in rd.children(cdata, cdata + csize):
+                    if aid == CHANNELS:
+                        prop['audio_channels'] = rd.uint(adata, asize)
+                    elif aid == SAMPLINGFREQUENCY:
+                        prop['audio_sampling_frequency'] = int(rd.double(adata, asize))
+                    elif aid == BITDEPTH:
+                        prop['audio_bits_per_sample'] = rd.uint(adata, asize)
+            elif cid == CONTENTENCODINGS:
+                prop['content_encoding'] = self.parse_encodings(cdata, csize)
+        codec_id = prop.get('codec_id')
+        if ttype is None or codec_id not in CODEC:
+            raise EbmlError("{} pista {} no soportada: {}".format(self.file, prop.get('number'), codec_id))
+        if ttype == "subtitles":
+            prop['text_subtitles'] = codec_id.startswith(("S_TEXT/", "S_ASS", "S_SSA"))
+        return dict(type=ttype, codec=CODEC[codec_id], properties=prop)
+
+    def parse_encodings(self, data: int, size: int) -> List[dict]:
+        rd = self.reader
+        encodings = []
+        for cid, cdata, csize in rd.children(data, data + size):
+            if cid != CONTENTENCODING:
+                continue
+            enc = {}
+            for eid, edata, esize in rd.children(cdata, cdata + csize):
+                if eid == CONTENTENCRYPTION:
+                    enc['encrypted'] = True
+                if eid != CONTENTCOMPRESSION:
+                    continue
+                enc['algo'] = 0
+                for zid, zdata, zsize in rd.children(edata, edata + esize):
+                    if zid == CONTENTCOMPALGO:
+                        enc['algo'] = rd.uint(zdata, zsize)
+                    elif zid == CONTENTCOMPSETTINGS:
+                        enc['settings'] = rd.binary(zdata, zsize).hex()
+            encodings.append(enc)
+        return encodings
+
+    def parse_tracks(self) -> List[dict]:
+        rd = self.reader
+        tracks = self.get(TRACKS)
+        if tracks is None:
+            raise EbmlError("{} sin Tracks".format(self.file))
+        arr = []
+        for cid, data, size in rd.children(tracks[0], tracks[0] + tracks[1]):
+            if cid == TRACKENTRY:
+                track = self.parse_track(data, size)
+                track['id'] = len(arr)
+                arr.append(track)
+        return arr
+
+    def parse_attachments(self) -> List[dict]:
+        rd = self.reader
+        attachments = self.get(ATTACHMENTS)
+        if attachments is None:
+            return []
+        arr = []
+        for cid, data, size in rd.children(attachments[0], attachments[0] + attachments[1]):
+            if cid != ATTACHEDFILE:
+                continue
+            att = dict(id=len(arr) + 1, properties={})
+            for aid, adata, asize in rd.children(data, data + size):
+                if aid == FILENAME:
+                    att['file_name'] = rd.string(adata, asize)
+                elif aid == FILEMIMETYPE:
+                    att['content_type'] = rd.string(adata, asize)
+                elif aid == FILEDESCRIPTION:
+                    att['description'] = rd.string(adata, asize)
+                elif aid == FILEDATA:
+                    att['size'] = asize
+                elif aid == FILEUID:
+                    att['properties']['uid'] = rd.uint(adata, asize)
+            arr.append(att)
+        return arr
+
+    def parse_cues(self) -> List[Tuple[int, int]]:
+        """
+        Índice de Cues como lista ordenada de (tiempo en ns, posición del Cluster)
+        """
+        rd = self.reader
+        cues = self.get(CUES)
+        if cues is None:
+            return []
+        arr = set()
+        for cid, data, size in rd.children(cues[0], cues[0] + cues[1]):
+            if cid != CUEPOINT:
+                continue
+            time = None
+            positions = []
+            for pid, pdata, psize in rd.children(data, data + size):
+                if pid == CUETIME:
+                    time = rd.uint(pdata, psize) * self.timestamp_scale
+                elif pid == CUETRACKPOSITIONS:
+                    for tid, tdata, tsize in rd.children(pdata, pdata + psize):
+                        if tid == CUECLUSTERPOSITION:
+                            positions.append(self.segment_start + rd.uint(tdata, tsize))
+            if time is not None:
+                arr.update((time, p) for p in positions)
+        return sorted(arr)
+
+    def parse_chapters(self) -> List[dict]:
+        rd = self.reader
+        chapters = self.get(CHAPTERS)
+        if chapters is None:
+            return []
+        arr = []
+        for cid, data, size in rd.children(chapters[0], chapters[0] + chapters[1]):
+            if cid == EDITIONENTRY:
+                num = sum(1 for aid, _, _ in rd.children(data, data + size) if aid == CHAPTERATOM)
+                arr.append(dict(num_entries=num))
+        return arr
+
+    def to_json(self) -> dict:
+        self.parse_header()
+        container = dict(
+            type="Matroska",
+            recognized=True,
+            supported=True,
+            properties=self.parse_info()
+        )
+        return dict(
+            container=container,
+            tracks=self.parse_tracks(),
+            attachments=self.parse_attachments(),
+            chapters=self.parse_chapters(),
+            file_name=self.file,
+            errors=[],
+            warnings=[],
+        )
+
+
+def is_matroska(file: str) -> bool:
+    return basename(file).rsplit(".", 1)[-1].lower() in ("mkv", "mka", "mks", "webm")
+
+
+def identify(file: str) -> dict:
+    """
+    Identificación nativa de un Matroska con el formato de mkvmerge -J.
+    Lanza EbmlError si el fichero o alguna de sus pistas no se puede
+    interpretar sin mkvmerge
+    """
+    with MatroskaInfo(file) as info:
+        try:
+            return info.to_json()
+        except (IndexError, ValueError, struct.error) as e:
+            raise EbmlError("{} {}".format(file, e))
@@ -1,19 +1,37 @@
 import re
 import subprocess
 import sys
-from itertools import zip_longest
+from dataclasses import astuple
 from os.path import basename, isfile
 
-from typing import List
+from typing import List, Tuple
 from typing import Union
 from textwrap import dedent
 
 from .shell import Shell, Args
 from .mkvutil import MkvInfo, Duration, Trim
-from .track import Track, SubTrack, Attachment, TrackList, TrackTuple
-from .util import LANG_ES, LANG_SB, LANG_EN, TMP, SetList, get_title, get_encoding_type, BadType
+from .track import Track, SubTrack, Attachment, BannableItem, TrackList, TrackTuple
+from .util import LANG_ES, LANG_SB, LANG_EN, TMP, SetList, get_title, get_encoding_type, BadType, pmap
 from .mkvcore import MkvCore
 from .sub import Sub
+from .trace import TRACE
+from .order import TrackOrder, OrderPlan, track_key
+
+
+def extra_file(file: str) -> Union[Tuple[str, str], None]:
+    """
+    ("chapters", idioma) o ("tags", None) si file es uno de los ficheros
+    de capítulos o tags que acompañan a un video, si no None
+    """
+    name = basename(file)
+    if name in ("chapters.xml", "chapters.txt"):
+        return ("chapters", None)
+    m = re.match(r"^chapters.(\w+).txt$", name)
+    if m:
+        return ("chapters", m.group(1))
+    if name == "tags.xml":
+        return ("tags", None)
+    return None
 
 
 def write_tags(file, **kwargs):
@@ -42,6 +60,9 @@ class Mkv:
         self.file = file
         self.__core: Union[MkvCore, None] = None
         self.__all_tracks: Union[TrackTuple, None] = None
+        self.__tracks: Union[TrackTuple, None] = None
+        self.__attachments: Union[tuple[Attachment], None] = None
+        self.__all_attachments: Union[tuple[Attachment], None] = None
         self.und = und
         self.vo = vo
         self.source = source
@@ -51,8 +72,12 @@ class Mkv:
         self.reset()
 
     def reset(self):
-        self.__core = MkvCore(self.file)
+        self.__core = MkvCore(self.file, trim=self.trim)
         self.__all_tracks = None
+        self.__tracks = None
+        self.__attachments = None
+        self.__all_attachments = None
+        self.__prefetched = False
 
     def mkvextract(self, *args, model="tracks", **kwargs):
         if len(args) > 0:
@@ -61,8 +86,9 @@ class Mkv:
     def mkvpropedit(self, *args, **kwargs):
         if len(args) == 0:
             return
-        Shell.run("mkvpropedit", self.file, *args, **kwargs)
+        cod = Shell.run("mkvpropedit", self.file, *args, **kwargs)
         self.reset()
+        return cod
 
     @property
     def duration(self) -> Duration:
@@ -78,33 +104,47 @@ class Mkv:
 
     @property
     def tags(self):
+        self.prefetch()
         return self.__core.tags
 
     @property
     def attachments(self) -> tuple[Attachment]:
-        txt_sub = [c for c in self.tracks.subtitles if c.text_subtitles and c.file_extension != 'srt']
-        arr = []
-        for a in self.info.attachments:
-            a = Attachment(**a)
-            if not a.isFont:
-                a.ban(f"# RM {self.source}:{a.id}:{a.content_type} {a.file_name} por no ser una fuente")
-                continue
-            elif len(txt_sub) == 0:
-                a.ban(f"# RM {self.source}:{a.id}:{a.content_type} {a.file_name} por falta de subtitulos != srt")
-                continue
-            arr.append(a)
-        return tuple(arr)
+        """
+        :return: Adjuntos no baneados. Se recalculan solo cuando se banea
+        alguna pista de este fichero
+        """
+        if self.__attachments is None:
+            txt_sub = [c for c in self.tracks.subtitles if c.text_subtitles and c.file_extension != 'srt']
+            arr = []
+            if self.__all_attachments is None:
+                self.__all_attachments = tuple(
+                    Attachment(id=a.id, content_type=a.content_type, file_name=a.file_name)
+                    for a in self.info.attachments
+                )
+            for a in self.__all_attachments:
+                if not a.isFont:
+                    a.ban(f"# RM {self.source}:{a.id}:{a.content_type} {a.file_name} por no ser una fuente")
+                    continue
+                elif len(txt_sub) == 0:
+                    a.ban(f"# RM {self.source}:{a.id}:{a.content_type} {a.file_name} por falta de subtitulos != srt")
+                    continue
+                arr.append(a)
+            self.__attachments = tuple(arr)
+        return self.__attachments
 
     @property
     def tracks(self) -> TrackTuple:
         """
         :return: Lista de Tracks no baneadas
         """
-        arr = TrackList()
-        for t in self.all_tracks:
-            if not t.banned:
-                arr.append(t)
-        return TrackTuple(arr)
+        if self.__tracks is None:
+            self.__tracks = self.all_tracks.no_banned
+        return self.__tracks
+
+    def __on_ban(self, track: Track):
+        if self.__tracks is not None and track in self.__tracks:
+            self.__tracks = TrackTuple(t for t in self.__tracks if t is not track)
+        self.__attachments = None
 
     @property
     def all_tracks(self):
@@ -185,6 +225,9 @@ class Mkv:
                     if s.forced_track == 1 and s.lines > (self.duration.minutes * 7):
                         print("# FT=0 {}".format(s))
                         s.forced_track = 0
+                    if not s.forced_track and s.all_forced:
+                        print("# FT=1 {}".format(s))
+                        s.forced_track = 1
                     if s.lang not in sub_langs:
                         sub_langs[s.lang] = []
                     sub_langs[s.lang].append(s)
@@ -230,6 +273,8 @@ class Mkv:
                     track.forced_track = 0
                     print("# FT=0 {}".format(track))
             self.__all_tracks = TrackTuple(arr)
+            for track in self.__all_tracks:
+                track.on_ban(self.__on_ban)
             self.__mark_tracks_ban(self.__all_tracks)
         return self.__all_tracks
 
@@ -292,45 +337,64 @@ class Mkv:
 
     @property
     def main_lang(self) -> tuple:
-        langs = set(LANG_ES)
-        for s in self.tracks.video:
-            if s.language_ietf:
-                langs.add(s.language_ietf)
-            if s.language:
-                langs.add(s.language)
-        return tuple(sorted(langs))
+        return TrackOrder.main_lang(self.tracks)
 
     def extract(self, *tracks, **kwargs) -> tuple:
+        """
+        Extrae las pistas o adjuntos pedidos. En la misma pasada se extraen
+        también los tags y capítulos si aún no se han extraído
+        """
         if len(tracks) == 0:
             return []
+        specs = [self.__extract_spec(t) for t in tracks]
+        outs = self.__core.extract(*specs, *self.__extract_extra(), **kwargs)[:len(specs)]
+        TMP.evict()
+        return outs
+
+    def prefetch(self):
+        """
+        Extrae en una sola llamada a mkvextract los subtítulos, tags y
+        capítulos que se van a necesitar más adelante
+        """
+        if self.__prefetched or self.__core.extension not in ("mkv", ):
+            return
+        self.__prefetched = True
+        specs = []
+        for t in self.info.tracks:
+            if t.type == "subtitles":
+                specs.append(self.__extract_spec(Track.build(self.source, t)))
+        self.__core.extract(*specs, *self.__extract_extra(), stdout=subprocess.DEVNULL)
+        TMP.evict()
+
+    def __extract_spec(self, track: Union[Track, Attachment]) -> tuple:
         name = basename(self.file).rsplit(".", 1)[0]
-        arrg = []
-        outs = []
-        lastModel = None
-        for track in tracks:
-            if isinstance(track, Track):
-                model = "tracks"
-                out = f"{TMP}/{self.source}_{track.id}_{name}.{track.file_extension}"
-            elif isinstance(track, Attachment):
-                model = "attachments"
-                out = f"{TMP}/{self.source}_{track.id}_{name}_{track.file_name}"
-            else:
-                raise BadType(track)
-            if lastModel != model:
-                arrg.append(model)
-                lastModel = model
-            outs.append(out)
-            arrg.append(str(track.id) + ":" + out)
-
-        cod = Shell.run("mkvextract", self.file, *arrg, **kwargs)
-        if cod not in (0, 1):
-            raise Exception("Error al usar mkvextract")
-        return tuple(outs)
-
-    def fix_tracks(self, mini=False, dry=False):
+        if isinstance(track, Track):
+            # Los PGS y VobSub pueden ser grandes para un TMP en tmpfs
+            tmp = TMP.big if track.file_extension in ("pgs", "sub") else TMP.tmp
+            return ("tracks", track.id, f"{tmp}/{self.source}_{track.id}_{name}.{track.file_extension}")
+        if isinstance(track, Attachment):
+            return ("attachments", track.id, f"{TMP}/{self.source}_{track.id}_{name}_{track.file_name}")
+        raise BadType(track)
+
+    def __extract_extra(self) -> list:
+        if self.__core.extension not in ("mkv", ):
+            return []
+        name = basename(self.file).rsplit(".", 1)[0]
+        specs = [("tags", None, f"{TMP}/{self.source}_tags_{name}.xml")]
+        if self.num_chapters > 0:
+            specs.append(("chapters", None, f"{TMP}/{self.source}_chapters_{name}.xml"))
+        return specs
+
+    def fix_args(self, mini=False) -> Tuple[Args, bool]:
+        """
+        Argumentos de mkvpropedit para corregir título y pistas (con mini
+        solo lo que sea distinto a lo actual) y si hay algo distinto a lo
+        actual, que sin mini no se ve en los argumentos
+        """
         arr = Args()
         title = get_title(self.file)
-        if title != self.info.container.properties.title or not mini:
+        changed = title != self.info.container.properties.title
+        if changed or not mini:
             arr.extend("--edit info --set")
             arr.append("title=" + title)
 
@@ -365,6 +429,9 @@ class Mkv:
         for s in self.tracks:
             arr_track = Args()
             chg = s.get_changes(mini=mini)
+            if not changed:
+                diff = chg if mini else s.get_changes(mini=True)
+                changed = any(v is not None for v in astuple(diff))
             if chg.language is not None:
                 arr_track.extend("--set language={}", chg.language)
             if chg.default_track is not None:
@@ -376,8 +443,18 @@ class Mkv:
             if arr_track:
                 arr.extend("--edit track:{}", s.number)
                 arr.extend(arr_track)
+        return arr, changed
 
-        self.mkvpropedit(*arr, dry=dry)
+    @TRACE.stage()
+    def fix_tracks(self, mini=False, dry=False) -> Tuple[Args, bool]:
+        """
+        Aplica fix_args y devuelve lo mismo que fix_args
+        """
+        arr, changed = self.fix_args(mini=mini)
+        cod = self.mkvpropedit(*arr, dry=dry)
+        if cod not in (None, 0, 1):
+            raise Exception("Error al usar mkvpropedit")
+        return arr, changed
 
     def safe_extract(self, id):
         trg: dict[int, Track] = {}
@@ -421,12 +498,28 @@ class Mkv:
 
 
 class MkvMerge:
-    def __init__(self, vo: str = None, und: str = None, dry: bool = False):
+    def __init__(self, vo: str = None, und: str = None, dry: bool = False, jobs: int = 1):
         self.vo = vo
         self.und = und
         self.dry = dry
+        self.jobs = jobs
+        self.__tracks_key = None
+        self.__tracks: Union[TrackTuple, None] = None
         str(TMP)
 
+    @staticmethod
+    @TRACE.stage("MkvMerge.analyze")
+    def analyze(tracks):
+        """
+        Calcula por adelantado lo que luego se consultará de los subtítulos
+        para que se haga en el mismo hilo que analiza cada fuente
+        """
+        for s in tracks:
+            if isinstance(s, SubTrack):
+                s.lines
+                if s.is_srt_candidate():
+                    s.collisions
+
     def mkvmerge(self, output: str, *args) -> Mkv:
         if len(args) == 0 or len(args) == 1 and args[0] == output:
             return
@@ -438,6 +531,13 @@ class MkvMerge:
         return mkv
 
     def get_tracks(self, src: list[Union[Mkv, Track]]) -> TrackTuple:
+        """
+        Pistas no baneadas de todas las fuentes. Se reutiliza el resultado
+        mientras no cambien las fuentes ni se banee nada
+        """
+        key = (tuple(map(id, src)), BannableItem.bans())
+        if self.__tracks_key == key:
+            return self.__tracks
         arr = []
         for s in src:
             if isinstance(s, Mkv):
@@ -446,115 +546,20 @@ class MkvMerge:
                 arr.append(s)
             else:
                 raise BadType(s)
-        return TrackTuple(arr)
+        self.__tracks_key = key
+        self.__tracks = TrackTuple(arr)
+        return self.__tracks
 
-    def make_order(self, src: list, main_order: list = None) -> str:
+    @TRACE.stage()
+    def make_order(self, src: list, main_order: list = None) -> OrderPlan:
         """
-        1. pista de video
-        2. pistas de audio:
-            1. es ac3
-            2. vo ac3
-            3. ** ac3
-            4. es ***
-            5. vo ***
-            6. ** ***
-        3. pistas de subtítulo:
-            1. es completos
-            2. es forzados
-            3. vo completos
-            4. vo forzados
-            5. ** completos
-            6. ** forzados
+        Ordena las pistas según TrackOrder y marca como default_track
+        las que correspondan
         """
-        main_lang = set(LANG_ES)
-        for s in self.get_tracks(src).video:
-            if s.language_ietf:
-                main_lang.add(s.language_ietf)
-            if s.language:
-                main_lang.add(s.language)
-        main_lang = tuple(sorted(main_lang))
-
-        def indx_s(x, *arr):
-            return arr.index(x) if x in arr else len(arr)
-
-        def sort_s(x: Track):
-            return (x.source, x.number)
-
-        orde: list[Track] = sorted(self.get_tracks(src).video, key=sort_s)
-        aux: dict[str, list[Track]] = dict(
-            es=[],
-            mn=[],
-        )
-        for s in self.get_tracks(src).audio:
-            if s.lang in LANG_ES:
-                aux['es'].append(s)
-                continue
-            if s.lang in main_lang:
-                aux['mn'].append(s)
-                continue
-            if s.lang not in aux:
-                aux[s.lang] = []
-            aux[s.lang].append(s)
-        for k in aux.keys():
-            aux[k] = sorted(aux[k], key=lambda s: (indx_s(s.file_extension, "ac3"), s.source, s.number))
-        for ss in zip_longest(aux['es'], aux['mn']):
-            for s in ss:
-                if s is not None:
-                    orde.append(s)
-
-        hasAudEs = bool(len(aux['es']))
-
-        def sort_s(x: SubTrack):
-            return (x.source, -(x.lines or 0), x.number)
-        aux: dict[str, list[Track]] = dict(
-            es_ful=[],
-            es_for=[],
-            mn_ful=[],
-            mn_for=[],
-            ot_ful=[],
-            ot_for=[],
-        )
-        for s in self.get_tracks(src).subtitles:
-            if s.forced_track:
-                if s.lang in LANG_ES:
-                    aux['es_for'].append(s)
-                    continue
-                if s.lang in main_lang:
-                    aux['mn_for'].append(s)
-                    continue
-                aux['ot_for'].append(s)
-                continue
-            if s.lang in LANG_ES:
-                aux['es_ful'].append(s)
-                continue
-            if s.lang in main_lang:
-                aux['mn_ful'].append(s)
-                continue
-            aux['ot_for'].append(s)
-
-        for a in aux.values():
-            orde.extend(sorted(a, key=sort_s))
-
-        if main_order is not None:
-            orde = sorted(orde, key=lambda s: main_order.index(f"{s.source}:{s.id}"))
-
-        defSub = None
-        if hasAudEs and aux['es_for']:
-            defSub = aux['es_for'][0]
-        elif not hasAudEs and aux['es_ful']:
-            defSub = aux['es_ful'][0]
-
-        defTrack = set()
-        newordr = []
-        for o, s in enumerate(orde):
-            if s.type in ("video", "audio"):
-                s.default_track = int(s.type not in defTrack)
-                defTrack.add(s.type)
-            elif s.type == "subtitles":
-                s.default_track = int(s == defSub)
-            newordr.append("{}:{}".format(s.source, s.id))
-
-        return newordr
+        plan = TrackOrder(main_order).plan(self.get_tracks(src))
+        for s in plan.tracks:
+            s.default_track = plan.defaults[track_key(s)]
+        return plan
 
     def merge(self, output: str, *files: str, tracks_selected: list = None, tracks_rm: list = None, do_srt: int = -1, do_trim:str = None, no_chapters:bool = False) -> Mkv:
         src: List[Union[Mkv, Track]] = []
@@ -570,34 +575,45 @@ class MkvMerge:
             start, end = map(to_sec, do_trim.split('-'))
             trim = Trim(start=start, end=end)
 
+        media: List[str] = []
         for f in files:
-            if basename(f) in ("chapters.xml", "chapters.txt"):
-                fl_chapters = f
-                continue
-            m = re.match(r"^chapters.(\w+).txt$", basename(f))
-            if m:
-                fl_chapters = f
-                lg_chapters = m.group(1)
+            extra = extra_file(f)
+            if extra is None:
+                media.append(f)
                 continue
-            if basename(f) == "tags.xml":
+            kind, lang = extra
+            if kind == "tags":
                 fl_tags = f
                 continue
+            fl_chapters = f
+            if lang is not None:
+                lg_chapters = lang
+
+        @TRACE.stage("MkvMerge.probe")
+        def probe(arg: tuple) -> Union[Mkv, Track]:
+            source, f = arg
             ext = f.rsplit(".", 1)[-1].lower()
             if ext in ("mkv", "mp4", "avi"):
                 mkv = Mkv(
                     f,
-                    source=len(src),
+                    source=source,
                     und=self.und,
                     vo=self.vo,
                     tracks_selected=tracks_selected,
                     tracks_rm=tracks_rm,
                     trim=trim
                 )
-                src.append(mkv)
-                cm_tag.extend(mkv.tags.get_tag('COMMENT', split_lines=True))
-            else:
-                track = Track.build(len(src), f, trim=trim)
-                src.append(track)
+                mkv.tags
+                MkvMerge.analyze(mkv.all_tracks)
+                return mkv
+            track = Track.build(source, f, trim=trim)
+            MkvMerge.analyze((track, ))
+            return track
+
+        for s in pmap(probe, enumerate(media), jobs=self.jobs):
+            src.append(s)
+            if isinstance(s, Mkv):
+                cm_tag.extend(s.tags.get_tag('COMMENT', split_lines=True))
 
         videos = self.get_tracks(src).video
         if len(videos) > 1:
@@ -661,64 +677,65 @@ class MkvMerge:
         #        s.ban("# MV {} limpiado SRT".format(s))
         #        continue
 
-        newordr = self.make_order(src, main_order=tracks_selected)
-
-        arr = Args()
-        arr.extend(["--title", get_title(output)])
-        for s in src:
-            if isinstance(s, Mkv):
-                mkv = s
-                if mkv.all_tracks.video.banned:
-                    nop = ",".join(map(str, mkv.all_tracks.video.banned.ids))
-                    arr.extend("-d !{}", nop)
-                if mkv.all_tracks.subtitles.banned:
-                    nop = ",".join(map(str, mkv.all_tracks.subtitles.banned.ids))
-                    arr.extend("-s !{}", nop)
-                if mkv.all_tracks.audio.banned:
-                    nop = ",".join(map(str, mkv.all_tracks.audio.banned.ids))
-                    arr.extend("-a !{}", nop)
-                if len(mkv.attachments) == 0:
-                    arr.append("--no-attachments")
-                elif len(mkv.attachments) < len(mkv.info.attachments):
-                    sip = ",".join(map(str, sorted(a.id for a in mkv.attachments)))
-                    arr.extend("-m {}", sip)
-                if no_chapters or (fl_chapters is not None or mkv.num_chapters == 1 or len(mkv.tracks.video) == 0):
-                    arr.extend("--no-chapters")
-                for t in sorted(mkv.tracks, key=lambda x: newordr.index(f"{x.source}:{x.id}")):
-                    chg = t.get_changes()
-                    arr.extend("--language {}:{}", t.id, chg.language)
-                    arr.extend("--default-track {}:{}", t.id, chg.default_track)
-                    arr.extend("--forced-track {}:{}", t.id, chg.forced_track)
-                    arr.extend(["--track-name", "{}:{}".format(t.id, chg.track_name)])
-                arr.append(mkv.file)
-            else:
-                chg = s.get_changes()
-                arr.extend("--language {}:{}", s.id, chg.language)
-                arr.extend("--default-track {}:{}", s.id, chg.default_track)
-                arr.extend("--forced-track {}:{}", s.id, chg.forced_track)
-                arr.extend(["--track-name", "{}:{}".format(s.id, chg.track_name)])
-                if no_chapters or s.rm_chapters:
-                    arr.extend("--no-chapters")
-                if s.type == 'subtitles':
-                    arr.extend("--sub-charset {}:{}", s.id, get_encoding_type(s.source_file))
-                arr.append(s.source_file)
-
-        if fl_chapters is not None:
-            if lg_chapters is not None:
-                arr.extend(["--chapter-language", lg_chapters])
-            arr.extend(["--chapters", fl_chapters])
-
-        if fl_tags is None:
-            fl_tags = TMP + "/tags.xml"
-            cm_tag.extend((basename(a) for a in arr if isfile(a)))
-            write_tags(fl_tags, COMMENT=cm_tag)
-
-        if do_trim:
-            arr.extend(["--split", "parts:"+do_trim])
-
-        arr.extend(["--global-tags", fl_tags])
-
-        arr.extend("--track-order " + ",".join(newordr))
+        plan = self.make_order(src, main_order=tracks_selected)
+
+        with TRACE.span("MkvMerge.args"):
+            arr = Args()
+            arr.extend(["--title", get_title(output)])
+            for s in src:
+                if isinstance(s, Mkv):
+                    mkv = s
+                    if mkv.all_tracks.video.banned:
+                        nop = ",".join(map(str, mkv.all_tracks.video.banned.ids))
+                        arr.extend("-d !{}", nop)
+                    if mkv.all_tracks.subtitles.banned:
+                        nop = ",".join(map(str, mkv.all_tracks.subtitles.banned.ids))
+                        arr.extend("-s !{}", nop)
+                    if mkv.all_tracks.audio.banned:
+                        nop = ",".join(map(str, mkv.all_tracks.audio.banned.ids))
+                        arr.extend("-a !{}", nop)
+                    if len(mkv.attachments) == 0:
+                        arr.append("--no-attachments")
+                    elif len(mkv.attachments) < len(mkv.info.attachments):
+                        sip = ",".join(map(str, sorted(a.id for a in mkv.attachments)))
+                        arr.extend("-m {}", sip)
+                    if no_chapters or (fl_chapters is not None or mkv.num_chapters == 1 or len(mkv.tracks.video) == 0):
+                        arr.extend("--no-chapters")
+                    for t in plan.sorted(mkv.tracks):
+                        chg = t.get_changes()
+                        arr.extend("--language {}:{}", t.id, chg.language)
+                        arr.extend("--default-track {}:{}", t.id, chg.default_track)
+                        arr.extend("--forced-track {}:{}", t.id, chg.forced_track)
+                        arr.extend(["--track-name", "{}:{}".format(t.id, chg.track_name)])
+                    arr.append(mkv.file)
+                else:
+                    chg = s.get_changes()
+                    arr.extend("--language {}:{}", s.id, chg.language)
+                    arr.extend("--default-track {}:{}", s.id, chg.default_track)
+                    arr.extend("--forced-track {}:{}", s.id, chg.forced_track)
+                    arr.extend(["--track-name", "{}:{}".format(s.id, chg.track_name)])
+                    if no_chapters or s.rm_chapters:
+                        arr.extend("--no-chapters")
+                    if s.type == 'subtitles':
+                        arr.extend("--sub-charset {}:{}", s.id, get_encoding_type(s.source_file))
+                    arr.append(s.source_file)
+
+            if fl_chapters is not None:
+                if lg_chapters is not None:
+                    arr.extend(["--chapter-language", lg_chapters])
+                arr.extend(["--chapters", fl_chapters])
+
+            if fl_tags is None:
+                fl_tags = TMP + "/tags.xml"
+                cm_tag.extend((basename(a) for a in arr if isfile(a)))
+                write_tags(fl_tags, COMMENT=cm_tag)
+
+            if do_trim:
+                arr.extend(["--split", "parts:"+do_trim])
+
+            arr.extend(["--global-tags", fl_tags])
+
+            arr.extend("--track-order " + plan.track_order)
 
         mkv = self.mkvmerge(output, *arr)
         if self.dry or mkv is None:
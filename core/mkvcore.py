@@ -1,12 +1,125 @@
-from typing import List
-from .mkvutil import MkvInfo, MkvChapter, MkvTags
+from typing import List, Dict, Tuple
+from .mkvutil import MkvInfo, MkvChapter, MkvTags, Trim, read_xml
+from .shell import Shell
+from .cache import CACHE
+from .store import STORE, ArtefactStore
+from .ebml import EbmlError, is_matroska
+from .demux import demux
 from functools import cached_property
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass(frozen=True)
 class MkvCore:
     file: str
+    trim: Trim = None
+    extracted: Dict[str, str] = field(default_factory=dict, compare=False, repr=False)
+
+    @staticmethod
+    def _key(model: str, id: int) -> str:
+        return model if id is None else f"{model}:{id}"
+
+    def extract(self, *specs: Tuple[str, int, str], **kwargs) -> Tuple[str]:
+        """
+        Extrae con una sola llamada a mkvextract todo lo que aún no se haya
+        extraído de este fichero.
+        Cada spec es (modelo, id, salida), con id = None para tags y chapters.
+        Lo que ya esté en STORE (o en CACHE para tags y chapters) no se extrae
+        """
+        self.__restore(specs)
+        new = [s for s in specs if MkvCore._key(s[0], s[1]) not in self.extracted]
+        self.__demux(specs)
+        todo: Dict[str, List[str]] = {}
+        for model, id, out in specs:
+            if MkvCore._key(model, id) in self.extracted:
+                continue
+            if model not in todo:
+                todo[model] = []
+            todo[model].append(out if id is None else f"{id}:{out}")
+        if todo:
+            arrg = []
+            for model, outs in todo.items():
+                arrg.append(model)
+                arrg.extend(outs)
+            cod = Shell.run("mkvextract", self.file, *arrg, **kwargs)
+            if cod not in (0, 1):
+                raise Exception("Error al usar mkvextract")
+            for model, id, out in specs:
+                self.extracted.setdefault(MkvCore._key(model, id), out)
+        self.__keep(new)
+        return tuple(self.extracted[MkvCore._key(model, id)] for model, id, _ in specs)
+
+    def store_key(self, id: int) -> str:
+        """
+        Huella del contenido de la pista de subtítulos id, o None si no se
+        puede saber sin leerla. Los recortes nativos solo tienen una parte
+        de la pista, así que el recorte también forma parte de la huella
+        """
+        if not is_matroska(self.file):
+            return None
+        segment_uid = self.info.container.properties.get('segment_uid')
+        track = next((t for t in self.info.tracks if t.id == id), None)
+        if not segment_uid or track is None or track.type != "subtitles":
+            return None
+        prop = track.properties
+        if prop.get('uid') is None:
+            return None
+        return "track-" + ArtefactStore.fingerprint(
+            segment_uid,
+            prop.get('uid'),
+            prop.get('codec_id'),
+            prop.get('codec_private_data'),
+            self.trim if MkvInfo.native else None
+        )
+
+    def __restore(self, specs: Tuple[Tuple[str, int, str]]):
+        for model, id, out in specs:
+            key = MkvCore._key(model, id)
+            if key in self.extracted:
+                continue
+            if model in ("tags", "chapters"):
+                xml = CACHE.get(model, self.file)
+                if xml is None:
+                    continue
+                if xml:
+                    with open(out, "w", encoding="utf-8") as f:
+                        f.write(xml)
+                self.extracted[key] = out
+            elif model == "tracks":
+                skey = self.store_key(id)
+                if skey is not None and STORE.fetch(skey, out):
+                    self.extracted[key] = out
+
+    def __keep(self, specs: Tuple[Tuple[str, int, str]]):
+        for model, id, out in specs:
+            if model in ("tags", "chapters"):
+                CACHE.set(model, self.file, read_xml(out))
+            elif model == "tracks":
+                skey = self.store_key(id)
+                if skey is not None:
+                    STORE.save(skey, out)
+
+    def __demux(self, specs: Tuple[Tuple[str, int, str]]):
+        """
+        Con MkvInfo.native los subtítulos se extraen sin mkvextract
+        siempre que se pueda, el resto se deja para mkvextract.
+        Si hay recorte solo se leen los Cluster que lo cubren
+        """
+        if not MkvInfo.native or not is_matroska(self.file):
+            return
+        outs = {
+            id: out for model, id, out in specs
+            if model == "tracks" and MkvCore._key(model, id) not in self.extracted
+        }
+        if not outs:
+            return
+        try:
+            done = demux(self.file, outs, trim=self.trim)
+        except (EbmlError, OSError) as e:
+            print("# mkvextract por no poder leer los subtítulos:", e)
+            return
+        for id, out in done.items():
+            self.extracted[MkvCore._key("tracks", id)] = out
 
     @cached_property
     def info(self):
@@ -16,6 +129,8 @@ class MkvCore:
     def tags(self):
         if self.extension not in ("mkv",):
             return MkvTags()
+        if "tags" in self.extracted:
+            return MkvTags.load(self.extracted["tags"])
         return MkvTags.build(self.file, do_print=False)
 
     @cached_property
@@ -28,6 +143,8 @@ class MkvCore:
     def chapters(self):
         if self.num_chapters == 0:
             return None
+        if "chapters" in self.extracted:
+            return MkvChapter.load(self.extracted["chapters"])
         return MkvChapter.build(self.file, do_print=False)
 
     @cached_property
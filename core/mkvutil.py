@@ -1,7 +1,15 @@
 from .shell import Shell, Args
+from .cache import CACHE
+from .ebml import identify, is_matroska, EbmlError, IDENTIFY_VERSION
 import json
 import xmltodict
-from typing import Tuple, NamedTuple, List
+from shutil import which
+from os import environ
+from os.path import isfile
+from dataclasses import dataclass, field
+from functools import cache, cached_property
+from types import MappingProxyType
+from typing import ClassVar, Mapping, Tuple, NamedTuple, List
 
 
 class Trim(NamedTuple):
@@ -25,121 +33,186 @@ class Duration:
         return self.nano == other.nano
 
 
-class MkvInfo(dict):
+@cache
+def mkvtoolnix_version() -> str:
+    """
+    Versión de mkvtoolnix, cacheada en disco según la firma del binario
+    para no tener que lanzar mkvmerge --version en cada ejecución
+    """
+    mkvmerge = which("mkvmerge")
+    if mkvmerge is None:
+        return None
+    version = CACHE.get("mkvtoolnix", mkvmerge)
+    if version is None:
+        version = Shell.get("mkvmerge", "--version", do_print=False).strip()
+        CACHE.set("mkvtoolnix", mkvmerge, version)
+    return version
+
+
+def read_xml(file: str) -> str:
+    """
+    Contenido de un xml escrito por mkvextract, que no crea el fichero
+    si no hay nada que extraer
+    """
+    if not isfile(file):
+        return ""
+    with open(file, "r", encoding="utf-8-sig") as f:
+        return f.read()
+
+
+@dataclass(frozen=True, slots=True)
+class MkvInfoTrackProperties:
+    language: str = None
+    track_name: str = None
+    default_track: int = 0
+    forced_track: int = 0
+    # Salida original de mkvmerge -J, para lo que no tiene campo propio
+    raw: Mapping = field(default_factory=dict, repr=False, compare=False)
 
     @staticmethod
-    def build(file, **kwargs):
-        arr = Args()
-        arr.extend("mkvmerge -J")
-        arr.append(file)
-        js = Shell.get(*arr, **kwargs)
-        js = json.loads(js)
-        info = MkvInfo(**js)
-        return info
-
-    @property
-    def tracks(self):
-        return tuple(map(MkvInfoTrack, self['tracks']))
+    def parse(js: dict) -> 'MkvInfoTrackProperties':
+        return MkvInfoTrackProperties(
+            language=js.get('language'),
+            track_name=js.get('track_name'),
+            default_track=int(js.get("default_track", 0)),
+            forced_track=int(js.get("forced_track", 0)),
+            raw=MappingProxyType(js)
+        )
 
-    @property
-    def container(self):
-        return MkvInfoContainer(self['container'])
+    def get(self, key: str, default=None):
+        return self.raw.get(key, default)
 
-    @property
-    def attachments(self):
-        return tuple(map(MkvInfoAttachment, self['attachments']))
+    def to_dict(self) -> dict:
+        return dict(self.raw)
 
-    @property
-    def chapters(self):
-        return tuple(map(MkvInfoChapter, self.get('chapters', [])))
 
-    @property
-    def file_name(self):
-        return self['file_name']
-
-    @property
-    def duration(self) -> Duration:
-        if self.container.properties.duration is not None:
-            return Duration(self.container.properties.duration)
-        arr = "ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1".split()
-        arr.append(self.file_name)
-        d = Shell.get(*arr, do_print=False)
-        d = float(d) * 1000000000
-        return Duration(d)
-
-
-class MkvInfoChapter(dict):
-    @property
-    def num_entries(self) -> int:
-        return self.get("num_entries", 0)
-
-
-class MkvInfoAttachment(dict):
-
-    @property
-    def id(self) -> int:
-        return self['id']
-
-    @property
-    def content_type(self) -> str:
-        return self.get('content_type')
-
-    @property
-    def file_name(self) -> str:
-        return self.get('file_name')
+@dataclass(frozen=True, slots=True)
+class MkvInfoTrack:
+    id: int
+    type: str
+    codec: str
+    properties: MkvInfoTrackProperties
 
+    @staticmethod
+    def parse(js: dict) -> 'MkvInfoTrack':
+        return MkvInfoTrack(
+            id=js['id'],
+            type=js['type'],
+            codec=js['codec'],
+            properties=MkvInfoTrackProperties.parse(js.get('properties', {}))
+        )
 
-class MkvInfoTrack(dict):
-    @property
-    def type(self) -> str:
-        return self['type']
 
-    @property
-    def properties(self):
-        return MkvInfoTrackProperties(self['properties'])
+@dataclass(frozen=True, slots=True)
+class MkvInfoAttachment:
+    id: int
+    content_type: str = None
+    file_name: str = None
 
-    @property
-    def id(self):
-        return self['id']
+    @staticmethod
+    def parse(js: dict) -> 'MkvInfoAttachment':
+        return MkvInfoAttachment(
+            id=js['id'],
+            content_type=js.get('content_type'),
+            file_name=js.get('file_name')
+        )
 
-    @property
-    def codec(self):
-        return self['codec']
 
+@dataclass(frozen=True, slots=True)
+class MkvInfoChapter:
+    num_entries: int = 0
 
-class MkvInfoTrackProperties(dict):
-    @property
-    def language(self) -> str:
-        return self['language']
+    @staticmethod
+    def parse(js: dict) -> 'MkvInfoChapter':
+        return MkvInfoChapter(num_entries=js.get("num_entries", 0))
 
-    @property
-    def track_name(self) -> str:
-        return self['track_name']
 
-    @property
-    def default_track(self):
-        return int(self.get("default_track", 0))
+@dataclass(frozen=True, slots=True)
+class MkvInfoContainerProperties:
+    duration: float = None
+    title: str = None
+    raw: Mapping = field(default_factory=dict, repr=False, compare=False)
 
-    @property
-    def forced_track(self):
-        return int(self.get("forced_track", 0))
+    @staticmethod
+    def parse(js: dict) -> 'MkvInfoContainerProperties':
+        return MkvInfoContainerProperties(
+            duration=js.get('duration'),
+            title=js.get('title'),
+            raw=MappingProxyType(js)
+        )
 
+    def get(self, key: str, default=None):
+        return self.raw.get(key, default)
 
-class MkvInfoContainer(dict):    
-    @property
-    def properties(self):
-        return MkvInfoContainerProperties(self['properties'])
 
+@dataclass(frozen=True, slots=True)
+class MkvInfoContainer:
+    type: str
+    properties: MkvInfoContainerProperties
 
-class MkvInfoContainerProperties(dict):
+    @staticmethod
+    def parse(js: dict) -> 'MkvInfoContainer':
+        return MkvInfoContainer(
+            type=js.get('type'),
+            properties=MkvInfoContainerProperties.parse(js.get('properties', {}))
+        )
+
+
+@dataclass(frozen=True)
+class MkvInfo:
+    """
+    Salida de mkvmerge -J (o de ebml.identify) convertida una sola vez
+    en registros inmutables
+    """
+    file_name: str
+    container: MkvInfoContainer
+    tracks: Tuple[MkvInfoTrack]
+    attachments: Tuple[MkvInfoAttachment]
+    chapters: Tuple[MkvInfoChapter]
+
+    # Identificar los .mkv leyendo directamente su cabecera en vez de con mkvmerge -J
+    native: ClassVar[bool] = environ.get("MKVMRG_NATIVE") is not None
 
-    @property
-    def duration(self) -> float:
-        return self.get('duration')
+    @staticmethod
+    def build(file, **kwargs) -> 'MkvInfo':
+        js = CACHE.get("mkvinfo", file, version=mkvtoolnix_version())
+        if js is None and MkvInfo.native and is_matroska(file):
+            # En su propia tabla: no tiene todo lo que da mkvmerge -J
+            js = CACHE.get("mkvinfo_native", file, version=IDENTIFY_VERSION)
+        if js is None and MkvInfo.native and is_matroska(file):
+            try:
+                js = identify(file)
+                CACHE.set("mkvinfo_native", file, js, version=IDENTIFY_VERSION)
+            except (EbmlError, OSError) as e:
+                print("# mkvmerge -J por no poder leer la cabecera:", e)
+        if js is None:
+            arr = Args()
+            arr.extend("mkvmerge -J")
+            arr.append(file)
+            js = Shell.get(*arr, **kwargs)
+            js = json.loads(js)
+            CACHE.set("mkvinfo", file, js, version=mkvtoolnix_version())
+        return MkvInfo.parse(file, js)
 
-    @property
-    def title(self) -> str:
-        return self.get('title')
+    @staticmethod
+    def parse(file: str, js: dict) -> 'MkvInfo':
+        return MkvInfo(
+            file_name=file,
+            container=MkvInfoContainer.parse(js.get('container', {})),
+            tracks=tuple(map(MkvInfoTrack.parse, js.get('tracks', []))),
+            attachments=tuple(map(MkvInfoAttachment.parse, js.get('attachments', []))),
+            chapters=tuple(map(MkvInfoChapter.parse, js.get('chapters', []))),
+        )
+
+    @cached_property
+    def duration(self) -> Duration:
+        if self.container.properties.duration is not None:
+            return Duration(self.container.properties.duration)
+        arr = "ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1".split()
+        arr.append(self.file_name)
+        d = Shell.get(*arr, do_print=False)
+        d = float(d) * 1000000000
+        return Duration(d)
 
 
 class MkvChapter(dict):
@@ -147,6 +220,14 @@ class MkvChapter(dict):
     @staticmethod
     def build(file, **kwargs):
         out = Shell.get("mkvextract", "chapters", file, **kwargs)
+        return MkvChapter.parse(out)
+
+    @staticmethod
+    def load(file):
+        return MkvChapter.parse(read_xml(file))
+
+    @staticmethod
+    def parse(out: str):
         out = out.strip()
         if len(out) == 0:
             return MkvChapter()
@@ -159,6 +240,14 @@ class MkvTags(dict):
     @staticmethod
     def build(file, **kwargs):
         out = Shell.get("mkvextract", "tags", file, **kwargs)
+        return MkvTags.parse(out)
+
+    @staticmethod
+    def load(file):
+        return MkvTags.parse(read_xml(file))
+
+    @staticmethod
+    def parse(out: str):
         out = out.strip()
         if len(out) == 0:
             return MkvTags()
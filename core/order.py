@@ -0,0 +1,157 @@
+from dataclasses import dataclass
+from functools import cached_property
+from itertools import zip_longest
+from typing import Dict, List, Tuple
+
+from .track import Track, SubTrack, TrackTuple
+from .util import LANG_ES
+
+TrackKey = Tuple[int, int]
+
+
+def track_key(track: Track) -> TrackKey:
+    return (track.source, track.id)
+
+
+def parse_key(srcid: str) -> TrackKey:
+    """
+    source:id (como en --tracks o --track-order) a (source, id)
+    """
+    source, id = srcid.split(":")
+    return (int(source), int(id))
+
+
+@dataclass(frozen=True)
+class OrderPlan:
+    # Pistas en el orden final
+    tracks: Tuple[Track]
+    # Valor de default_track que le corresponde a cada pista
+    defaults: Dict[TrackKey, int]
+
+    @cached_property
+    def rank(self) -> Dict[TrackKey, int]:
+        return {track_key(t): i for i, t in enumerate(self.tracks)}
+
+    def sorted(self, tracks) -> List[Track]:
+        return sorted(tracks, key=lambda t: self.rank[track_key(t)])
+
+    @property
+    def track_order(self) -> str:
+        return ",".join("{}:{}".format(*track_key(t)) for t in self.tracks)
+
+
+class TrackOrder:
+    """
+    Orden de las pistas al mezclar:
+
+    1. pista de video
+    2. pistas de audio:
+        1. es ac3
+        2. vo ac3
+        3. ** ac3
+        4. es ***
+        5. vo ***
+        6. ** ***
+    3. pistas de subtítulo:
+        1. es completos
+        2. es forzados
+        3. vo completos
+        4. vo forzados
+        5. ** completos
+        6. ** forzados
+
+    Si se da main_order (lista de source:id) manda ese orden
+    """
+
+    def __init__(self, main_order: List[str] = None):
+        self.main_order = None
+        if main_order is not None:
+            self.main_order = {parse_key(o): i for i, o in enumerate(main_order)}
+
+    @staticmethod
+    def main_lang(tracks: TrackTuple) -> Tuple[str]:
+        main_lang = set(LANG_ES)
+        for s in tracks.video:
+            if s.language_ietf:
+                main_lang.add(s.language_ietf)
+            if s.language:
+                main_lang.add(s.language)
+        return tuple(sorted(main_lang))
+
+    def plan(self, tracks: TrackTuple) -> OrderPlan:
+        main_lang = TrackOrder.main_lang(tracks)
+
+        orde: List[Track] = sorted(tracks.video, key=lambda x: (x.source, x.number))
+        aux: Dict[str, List[Track]] = dict(
+            es=[],
+            mn=[],
+        )
+        for s in tracks.audio:
+            if s.lang in LANG_ES:
+                aux['es'].append(s)
+                continue
+            if s.lang in main_lang:
+                aux['mn'].append(s)
+                continue
+            if s.lang not in aux:
+                aux[s.lang] = []
+            aux[s.lang].append(s)
+        for k in aux.keys():
+            aux[k] = sorted(aux[k], key=lambda s: (int(s.file_extension != "ac3"), s.source, s.number))
+        for ss in zip_longest(aux['es'], aux['mn']):
+            for s in ss:
+                if s is not None:
+                    orde.append(s)
+
+        hasAudEs = bool(len(aux['es']))
+
+        def sort_s(x: SubTrack):
+            return (x.source, -(x.lines or 0), x.number)
+        aux: Dict[str, List[Track]] = dict(
+            es_ful=[],
+            es_for=[],
+            mn_ful=[],
+            mn_for=[],
+            ot_ful=[],
+            ot_for=[],
+        )
+        for s in tracks.subtitles:
+            if s.forced_track:
+                if s.lang in LANG_ES:
+                    aux['es_for'].append(s)
+                    continue
+                if s.lang in main_lang:
+                    aux['mn_for'].append(s)
+                    continue
+                aux['ot_for'].append(s)
+                continue
+            if s.lang in LANG_ES:
+                aux['es_ful'].append(s)
+                continue
+            if s.lang in main_lang:
+                aux['mn_ful'].append(s)
+                continue
+            aux['ot_for'].append(s)
+
+        for a in aux.values():
+            orde.extend(sorted(a, key=sort_s))
+
+        if self.main_order is not None:
+            orde = sorted(orde, key=lambda s: self.main_order[track_key(s)])
+
+        defSub = None
+        if hasAudEs and aux['es_for']:
+            defSub = aux['es_for'][0]
+        elif not hasAudEs and aux['es_ful']:
+            defSub = aux['es_ful'][0]
+
+        defTrack = set()
+        defaults: Dict[TrackKey, int] = {}
+        for s in orde:
+            if s.type in ("video", "audio"):
+                defaults[track_key(s)] = int(s.type not in defTrack)
+                defTrack.add(s.type)
+            elif s.type == "subtitles":
+                defaults[track_key(s)] = int(s is defSub)
+
+        return OrderPlan(tracks=tuple(orde), defaults=defaults)
@@ -1,6 +1,9 @@
 import logging
+import mmap
+import struct
 from collections import namedtuple
 from math import floor
+from os import fstat
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +22,9 @@ END = int('0x80', 16)
 # Named tuple access for static PDS palettes
 Palette = namedtuple('Palette', "Y Cr Cb Alpha")
 
+# magic, pts, dts, type, size
+HEADER = struct.Struct(">2sIIBH")
+
 
 class InvalidSegmentError(Exception):
     '''Raised when a segment does not match PGS specification'''
@@ -37,25 +43,63 @@ def mseg_srt(msc):
     return stt
 
 class PGSReader:
+    """
+    Lector de ficheros .sup que mapea el fichero en memoria y recorre los
+    segmentos por offset. Los segmentos son memoryview sobre el mapeo, por
+    lo que no se copia ningún byte hasta que se accede a él.
+    """
 
     def __init__(self, filepath):
         self.file = filepath
+        self._mmap = None
+        self._view = memoryview(b'')
         with open(self.file, 'rb') as f:
-            self.bytes = f.read()
+            if fstat(f.fileno()).st_size > 0:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self._view.release()
+        self._view = memoryview(b'')
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Quedan segmentos vivos, el mapeo se liberará con ellos
+            pass
+        self._mmap = None
+
+    @property
+    def bytes(self) -> memoryview:
+        return self._view
 
     def make_segment(self, bytes_):
         try:
             cls = SEGMENT_TYPE[bytes_[10]]
         except KeyError:
             raise InvalidSegmentType("{} {} not in SEGMENT_TYPE".format(self.file, bytes_[10]))
-        return cls(bytes_)
+        try:
+            return cls(bytes_)
+        except (struct.error, IndexError):
+            raise InvalidSegmentError("{} segmento truncado".format(self.file))
 
     def iter_segments(self):
-        bytes_ = self.bytes[:]
-        while bytes_:
-            size = 13 + int(bytes_[11:13].hex(), 16)
-            yield self.make_segment(bytes_[:size])
-            bytes_ = bytes_[size:]
+        bytes_ = self.bytes
+        offset = 0
+        end = len(bytes_)
+        while offset < end:
+            if end - offset < HEADER.size:
+                raise InvalidSegmentError("{} cabecera truncada en {}".format(self.file, offset))
+            size = HEADER.size + int.from_bytes(bytes_[offset + 11:offset + 13], 'big')
+            yield self.make_segment(bytes_[offset:offset + size])
+            offset = offset + size
 
     def iter_displaysets(self):
         ds = []
@@ -77,9 +121,12 @@ class PGSReader:
             self._displaysets = list(self.iter_displaysets())
         return self._displaysets
 
+    def count_images(self) -> int:
+        return sum(1 for ds in self.iter_displaysets() if ds.has_image)
+
     def get_times(self):
         seg = list()
-        for i, ds in enumerate(self.displaysets):
+        for i, ds in enumerate(self.iter_displaysets()):
             sg = ds.segments
             if ds.ods:
                 sg = ds.ods
@@ -116,10 +163,11 @@ class BaseSegment:
         self.bytes = bytes_
         if bytes_[:2] != b'PG':
             raise InvalidSegmentError
-        self.pts = int(bytes_[2:6].hex(), base=16) / 90
-        self.dts = int(bytes_[6:10].hex(), base=16) / 90
-        self.type = self.SEGMENT[bytes_[10]]
-        self.size = int(bytes_[11:13].hex(), base=16)
+        _, pts, dts, type_, size = HEADER.unpack_from(bytes_)
+        self.pts = pts / 90
+        self.dts = dts / 90
+        self.type = self.SEGMENT[type_]
+        self.size = size
         self.data = bytes_[13:]
 
     def __len__(self):
@@ -140,16 +188,21 @@ class PresentationCompositionSegment(BaseSegment):
 
         def __init__(self, bytes_):
             self.bytes = bytes_
-            self.object_id = int(bytes_[0:2].hex(), base=16)
-            self.window_id = bytes_[2]
-            self.cropped = bool(bytes_[3])
-            self.x_offset = int(bytes_[4:6].hex(), base=16)
-            self.y_offset = int(bytes_[6:8].hex(), base=16)
+            (
+                self.object_id,
+                self.window_id,
+                self.cropped,
+                self.x_offset,
+                self.y_offset
+            ) = struct.unpack_from(">HBBHH", bytes_)
+            self.cropped = bool(self.cropped)
             if self.cropped:
-                self.crop_x_offset = int(bytes_[8:10].hex(), base=16)
-                self.crop_y_offset = int(bytes_[10:12].hex(), base=16)
-                self.crop_width = int(bytes_[12:14].hex(), base=16)
-                self.crop_height = int(bytes_[14:16].hex(), base=16)
+                (
+                    self.crop_x_offset,
+                    self.crop_y_offset,
+                    self.crop_width,
+                    self.crop_height
+                ) = struct.unpack_from(">HHHH", bytes_, 8)
 
     STATE = {
         int('0x00', base=16): 'Normal',
@@ -159,14 +212,18 @@ class PresentationCompositionSegment(BaseSegment):
 
     def __init__(self, bytes_):
         BaseSegment.__init__(self, bytes_)
-        self.width = int(self.data[0:2].hex(), base=16)
-        self.height = int(self.data[2:4].hex(), base=16)
-        self.frame_rate = self.data[4]
-        self._num = int(self.data[5:7].hex(), base=16)
-        self._state = self.STATE[self.data[7]]
-        self.palette_update = bool(self.data[8])
-        self.palette_id = self.data[9]
-        self._num_comps = self.data[10]
+        (
+            self.width,
+            self.height,
+            self.frame_rate,
+            self._num,
+            state,
+            palette_update,
+            self.palette_id,
+            self._num_comps
+        ) = struct.unpack_from(">HHBHBBBB", self.data)
+        self._state = self.STATE[state]
+        self.palette_update = bool(palette_update)
 
     @property
     def composition_number(self):
@@ -185,12 +242,13 @@ class PresentationCompositionSegment(BaseSegment):
         return self._composition_objects
 
     def get_composition_objects(self):
-        bytes_ = self.data[11:]
+        bytes_ = self.data
+        offset = 11
         comps = []
-        while bytes_:
-            length = 8 * (1 + bool(bytes_[3]))
-            comps.append(self.CompositionObject(bytes_[:length]))
-            bytes_ = bytes_[length:]
+        while offset < len(bytes_):
+            length = 8 * (1 + bool(bytes_[offset + 3]))
+            comps.append(self.CompositionObject(bytes_[offset:offset + length]))
+            offset = offset + length
         return comps
 
 
@@ -198,12 +256,14 @@ class WindowDefinitionSegment(BaseSegment):
 
     def __init__(self, bytes_):
         BaseSegment.__init__(self, bytes_)
-        self.num_windows = self.data[0]
-        self.window_id = self.data[1]
-        self.x_offset = int(self.data[2:4].hex(), base=16)
-        self.y_offset = int(self.data[4:6].hex(), base=16)
-        self.width = int(self.data[6:8].hex(), base=16)
-        self.height = int(self.data[8:10].hex(), base=16)
+        (
+            self.num_windows,
+            self.window_id,
+            self.x_offset,
+            self.y_offset,
+            self.width,
+            self.height
+        ) = struct.unpack_from(">BBHHHH", self.data)
 
 
 class PaletteDefinitionSegment(BaseSegment):
@@ -229,12 +289,10 @@ class ObjectDefinitionSegment(BaseSegment):
 
     def __init__(self, bytes_):
         BaseSegment.__init__(self, bytes_)
-        self.id = int(self.data[0:2].hex(), base=16)
-        self.version = self.data[2]
-        self.in_sequence = self.SEQUENCE[self.data[3]]
-        self.data_len = int(self.data[4:7].hex(), base=16)
-        self.width = int(self.data[7:9].hex(), base=16)
-        self.height = int(self.data[9:11].hex(), base=16)
+        self.id, self.version, sequence = struct.unpack_from(">HBB", self.data)
+        self.in_sequence = self.SEQUENCE[sequence]
+        self.data_len = int.from_bytes(self.data[4:7], 'big')
+        self.width, self.height = struct.unpack_from(">HH", self.data, 7)
         self.img_data = self.data[11:]
         if len(self.img_data) != self.data_len - 4:
             log.warning('Image data length asserted does not match the length found.')
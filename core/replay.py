@@ -0,0 +1,193 @@
+import json
+import re
+import shutil
+import threading
+from hashlib import sha1
+from os import environ, makedirs
+from os.path import basename, dirname, exists, isfile, join, realpath, relpath
+from typing import Iterator, Tuple
+
+from .shell import Runner, Shell
+from .util import TMP
+
+# Los directorios de TMP cambian en cada ejecución
+re_tmp = re.compile("(?:{})/{}[^/]+".format("|".join(map(re.escape, TMP.roots)), re.escape(TMP.prefix)))
+
+EXTRACT_MODES = ("tracks", "attachments", "tags", "chapters", "timestamps_v2", "cues", "cuesheet")
+
+
+class MissingRecord(Exception):
+    '''Raised when replaying a command that was never recorded'''
+
+
+def relative(file: str, root: str) -> str:
+    return relpath(realpath(file), realpath(root))
+
+
+def normalize(args: tuple, root: str) -> str:
+    """
+    Comando como clave de la grabación: sin el directorio de TMP y con
+    los ficheros existentes por su ruta relativa a la grabación (root),
+    para que no dependa de dónde se grabó o reproduce si se mueven juntos
+    """
+    arr = []
+    for a in map(str, args):
+        a = re_tmp.sub("{TMP}", a)
+        if "/" in a and not a.startswith("{TMP}") and exists(a):
+            a = relative(a, root)
+        arr.append(a)
+    return " ".join(arr)
+
+
+def extract_specs(args: tuple) -> Iterator[Tuple[str, str, int, str]]:
+    """
+    (fichero, modelo, id, salida) de una llamada a mkvextract con la
+    sintaxis de varios modos: mkvextract fichero modo [id:]salida ...
+    """
+    file = args[1]
+    model = None
+    for a in args[2:]:
+        if a in EXTRACT_MODES:
+            model = a
+        elif a.startswith("-") or model is None:
+            continue
+        elif model in ("tracks", "attachments", "timestamps_v2"):
+            id, out = a.split(":", 1)
+            yield file, model, int(id), out
+        else:
+            yield file, model, None, a
+
+
+class Recording:
+    """
+    Grabación de las llamadas a mkvtoolnix (y ffprobe, mediainfo...) en un
+    directorio: commands.json con la salida de cada Shell.get, el código de
+    cada Shell.run y lo que mkvextract no llegó a escribir (tags o capítulos
+    de un fichero que no tiene), y files/ con lo que sí extrajo
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        self.data = dict(get={}, run={}, missing=[])
+        if isfile(self.commands):
+            with open(self.commands, "r") as f:
+                self.data.update(json.load(f))
+
+    @property
+    def commands(self) -> str:
+        return join(self.root, "commands.json")
+
+    def file(self, file: str, model: str, id: int) -> str:
+        # Con un hash del directorio no se pisan dos ficheros con el mismo nombre
+        folder = relative(dirname(file) or ".", self.root)
+        name = "{}.{}.{}".format(sha1(folder.encode()).hexdigest()[:8], basename(file), model)
+        if id is not None:
+            name = name + "." + str(id)
+        return join(self.root, "files", name)
+
+    def key(self, args: tuple) -> str:
+        return normalize(args, self.root)
+
+    def save(self):
+        makedirs(self.root, exist_ok=True)
+        with open(self.commands, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+
+    def set_get(self, args: tuple, output: str):
+        with self.lock:
+            self.data['get'][self.key(args)] = output
+            self.save()
+
+    def set_run(self, args: tuple, code: int):
+        with self.lock:
+            self.data['run'][self.key(args)] = code
+            self.save()
+
+    def set_missing(self, file: str, model: str, id: int):
+        name = basename(self.file(file, model, id))
+        with self.lock:
+            if name not in self.data['missing']:
+                self.data['missing'].append(name)
+                self.data['missing'].sort()
+                self.save()
+
+    def is_missing(self, file: str, model: str, id: int) -> bool:
+        return basename(self.file(file, model, id)) in self.data['missing']
+
+    def set_file(self, file: str, model: str, id: int, src: str):
+        dst = self.file(file, model, id)
+        makedirs(join(self.root, "files"), exist_ok=True)
+        shutil.copyfile(src, dst)
+        with self.lock:
+            if basename(dst) in self.data['missing']:
+                self.data['missing'].remove(basename(dst))
+                self.save()
+
+
+class RecordingRunner(Runner):
+    """
+    Ejecuta los comandos de verdad y graba su resultado
+    """
+
+    def __init__(self, root: str, runner: Runner = None):
+        self.recording = Recording(root)
+        self.runner = runner or Runner()
+
+    def call(self, args: tuple, **kwargs) -> int:
+        code = self.runner.call(args, **kwargs)
+        if args[0] == "mkvextract":
+            for file, model, id, out in extract_specs(args):
+                if isfile(out):
+                    self.recording.set_file(file, model, id, out)
+                else:
+                    self.recording.set_missing(file, model, id)
+        self.recording.set_run(args, code)
+        return code
+
+    def check_output(self, args: tuple, **kwargs) -> bytes:
+        output = self.runner.check_output(args, **kwargs)
+        self.recording.set_get(args, output.decode("utf-8", errors="replace"))
+        return output
+
+
+class ReplayRunner(Runner):
+    """
+    Reproduce una grabación sin lanzar ningún proceso
+    """
+
+    def __init__(self, root: str):
+        self.recording = Recording(root)
+
+    def call(self, args: tuple, **kwargs) -> int:
+        key = self.recording.key(args)
+        if args[0] == "mkvextract":
+            # Lo grabado de mkvextract son los ficheros que extrajo
+            for file, model, id, out in extract_specs(args):
+                src = self.recording.file(file, model, id)
+                if not isfile(src):
+                    if self.recording.is_missing(file, model, id):
+                        continue
+                    raise MissingRecord("No hay grabación de: {} {} {}".format(file, model, id))
+                shutil.copyfile(src, out)
+            return self.recording.data['run'].get(key, 0)
+        if key not in self.recording.data['run']:
+            raise MissingRecord("No hay grabación de: " + key)
+        return self.recording.data['run'][key]
+
+    def check_output(self, args: tuple, **kwargs) -> bytes:
+        key = self.recording.key(args)
+        if key not in self.recording.data['get']:
+            raise MissingRecord("No hay grabación de: " + key)
+        return self.recording.data['get'][key].encode("utf-8")
+
+
+def install_from_env():
+    """
+    MKVMRG_RECORD=dir graba las llamadas en dir y MKVMRG_REPLAY=dir las
+    reproduce desde dir
+    """
+    if environ.get("MKVMRG_REPLAY"):
+        Shell.runner = ReplayRunner(environ["MKVMRG_REPLAY"])
+    elif environ.get("MKVMRG_RECORD"):
+        Shell.runner = RecordingRunner(environ["MKVMRG_RECORD"])
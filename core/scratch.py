@@ -0,0 +1,214 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from glob import glob
+from os import environ, makedirs, walk
+from os.path import getmtime, getsize, isdir, isfile, join, realpath
+from typing import List
+
+# Directorio para los ficheros temporales y otro para los grandes (PGS,
+# VobSub) por si el primero es un tmpfs
+TMP_ROOT = environ.get("MKVMRG_TMP", tempfile.gettempdir())
+TMP_BIG_ROOT = environ.get("MKVMRG_TMP_BIG", TMP_ROOT)
+# Tamaño máximo en MB de los temporales de esta ejecución
+TMP_SIZE = int(environ.get("MKVMRG_TMP_SIZE", 4096))
+# Los directorios sin fichero pid (de versiones anteriores) se borran
+# pasadas estas horas
+ORPHAN_HOURS = 24
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def du(path: str) -> int:
+    size = 0
+    for root, dirs, files in walk(path):
+        for f in files:
+            try:
+                size = size + getsize(join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+class Scratch:
+    """
+    Directorio temporal de la ejecución, que se usa igual que el antiguo
+    MyTMP: str(TMP) y TMP + "/fichero".
+    - Se crea al primer uso en root (y en big_root para los ficheros
+      grandes) con un fichero pid para poder reconocer los huérfanos de
+      ejecuciones que no terminaron bien, que se borran al arrancar
+    - Dentro de job(...) cada hilo usa su propio subdirectorio, que se
+      borra al acabar el trabajo salvo con keep
+    - Al acabar cada trabajo y tras cada extracción se comprueba max_size
+      contando todo lo que hay en TMP. Si se supera se borran los
+      subdirectorios de los trabajos ya terminados que se hayan conservado
+      (keep), empezando por los más antiguos. Lo del trabajo en curso, o
+      de un merge suelto fuera de job(...), no se borra nunca porque lo
+      usa su comando mkvmerge: si solo con eso se supera max_size se avisa
+    - Al salir se borra todo salvo con keep (--dry, para que los comandos
+      impresos sigan siendo válidos)
+    Lo que merece la pena reutilizar entre ejecuciones (subtítulos
+    extraídos, copias en UTF-8...) no se pierde: está en STORE
+    """
+
+    def __init__(self, prefix: str = "mkvmrg.", root: str = TMP_ROOT, big_root: str = TMP_BIG_ROOT, max_size: int = TMP_SIZE):
+        self.prefix = prefix
+        self.root = root
+        self.big_root = big_root
+        self.max_size = max_size
+        self.keep = False
+        self._tmp = None
+        self._big = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._jobs = 0
+        # Subdirectorios de trabajos terminados que se han conservado
+        self._done: List[str] = []
+        self._warned = False
+
+    @property
+    def roots(self) -> tuple:
+        return tuple(dict.fromkeys((self.root, self.big_root)))
+
+    def __mkdtemp(self, root: str) -> str:
+        makedirs(root, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix="{}{}.".format(self.prefix, os.getpid()), dir=root)
+        with open(join(tmp, ".pid"), "w") as f:
+            f.write(str(os.getpid()))
+        print("$ mkdir -p", tmp)
+        return tmp
+
+    def __start(self):
+        if self._tmp is not None:
+            return
+        self.recover()
+        self._tmp = self.__mkdtemp(self.root)
+        if realpath(self.big_root) == realpath(self.root):
+            self._big = self._tmp
+        else:
+            self._big = self.__mkdtemp(self.big_root)
+        atexit.register(self.cleanup)
+
+    def __job_dir(self, base: str) -> str:
+        job = getattr(self._local, "job", None)
+        if job is None:
+            return base
+        path = join(base, job)
+        if not isdir(path):
+            makedirs(path, exist_ok=True)
+        return path
+
+    @property
+    def tmp(self) -> str:
+        with self._lock:
+            self.__start()
+        return self.__job_dir(self._tmp)
+
+    @property
+    def big(self) -> str:
+        """
+        Directorio para ficheros grandes (PGS, VobSub)
+        """
+        with self._lock:
+            self.__start()
+        return self.__job_dir(self._big)
+
+    def __str__(self):
+        return self.tmp
+
+    def __add__(self, o):
+        return self.tmp + o
+
+    @contextmanager
+    def job(self):
+        """
+        Lo que se haga dentro usa un subdirectorio propio de este hilo
+        """
+        with self._lock:
+            self._jobs = self._jobs + 1
+            job = "job-{}".format(self._jobs)
+        self._local.job = job
+        try:
+            yield
+        finally:
+            self._local.job = None
+            self.__end(job)
+
+    def __end(self, job: str):
+        if self._tmp is None:
+            return
+        dirs = [join(d, job) for d in dict.fromkeys((self._tmp, self._big))]
+        dirs = [d for d in dirs if isdir(d)]
+        if not self.keep:
+            for d in dirs:
+                shutil.rmtree(d, ignore_errors=True)
+        else:
+            with self._lock:
+                self._done.extend(dirs)
+        self.evict()
+
+    def size(self) -> int:
+        if self._tmp is None:
+            return 0
+        return sum(du(d) for d in dict.fromkeys((self._tmp, self._big)))
+
+    def evict(self):
+        """
+        Borra los subdirectorios de trabajos terminados, de más antiguo a
+        más nuevo, hasta que lo temporal ocupe menos de max_size
+        """
+        if not self.max_size or self._tmp is None:
+            return
+        limit = self.max_size * 1024 * 1024
+        with self._lock:
+            size = self.size()
+            while size > limit and self._done:
+                d = self._done.pop(0)
+                size = size - du(d)
+                shutil.rmtree(d, ignore_errors=True)
+        if size <= limit:
+            self._warned = False
+        elif not self._warned:
+            # Una vez por cada vez que se supera, no en cada comprobación
+            self._warned = True
+            print("# ¡! los temporales en uso ocupan {:.0f} MB (MKVMRG_TMP_SIZE={})".format(size / 1024 / 1024, self.max_size))
+
+    def recover(self):
+        """
+        Borra los directorios temporales de ejecuciones que ya no existen
+        """
+        for root in self.roots:
+            for d in glob(join(root, self.prefix + "*")):
+                if not isdir(d):
+                    continue
+                pid_file = join(d, ".pid")
+                if isfile(pid_file):
+                    try:
+                        with open(pid_file, "r") as f:
+                            pid = int(f.read().strip())
+                    except (OSError, ValueError):
+                        continue
+                    if pid_alive(pid):
+                        continue
+                elif time.time() - getmtime(d) < ORPHAN_HOURS * 3600:
+                    continue
+                print("$ rm -r", d)
+                shutil.rmtree(d, ignore_errors=True)
+
+    def cleanup(self):
+        if self._tmp is None or self.keep:
+            return
+        for d in dict.fromkeys((self._tmp, self._big)):
+            shutil.rmtree(d, ignore_errors=True)
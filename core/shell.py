@@ -5,6 +5,9 @@ import sys
 from os import getcwd, chdir
 from os.path import isfile, dirname, basename
 
+from .util import ThreadStdout
+from .trace import TRACE
+
 log = logging.getLogger(__name__)
 re_track = re.compile(r"^(\d+):.*")
 
@@ -24,7 +27,28 @@ class Args(list):
         super().extend(s)
 
 
+class Runner:
+    """
+    Lanza los comandos de Shell. Se puede cambiar Shell.runner por otro
+    que los grabe o los reproduzca sin mkvtoolnix (ver core/replay.py)
+    """
+
+    def call(self, args: tuple, **kwargs) -> int:
+        if kwargs.get("stdout") is None and ThreadStdout.is_captured():
+            # La salida del proceso también tiene que quedar en el buffer del hilo
+            kwargs["stdout"] = subprocess.PIPE
+            kwargs["stderr"] = kwargs.get("stderr", subprocess.STDOUT)
+            prc = subprocess.run(args, **kwargs)
+            sys.stdout.write(prc.stdout.decode(sys.stdout.encoding, errors="replace"))
+            return prc.returncode
+        return subprocess.call(args, **kwargs)
+
+    def check_output(self, args: tuple, **kwargs) -> bytes:
+        return subprocess.check_output(args, **kwargs)
+
+
 class Shell:
+    runner: Runner = Runner()
 
     @staticmethod
     def to_str(*args: str):
@@ -62,7 +86,9 @@ class Shell:
             print("$", Shell.to_str(*args))
         if dry is True:
             return
-        out = subprocess.call(args, **kwargs)
+        with TRACE.command(args) as span:
+            out = Shell.runner.call(args, **kwargs)
+            span['code'] = out
         if out != 0:
             if not do_print:
                 print("$", Shell.to_str(*args))
@@ -83,7 +109,9 @@ class Shell:
             print("$", Shell.to_str(*args))
         if dry is True:
             return
-        output = subprocess.check_output(args, **kargv)
+        with TRACE.command(args) as span:
+            output = Shell.runner.check_output(args, **kargv)
+            span['bytes'] = len(output)
         output = output.decode(sys.stdout.encoding)
         return output
 
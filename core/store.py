@@ -0,0 +1,219 @@
+import hashlib
+import json
+import shutil
+import sqlite3
+import threading
+import time
+from os import environ, makedirs, remove, stat
+from os.path import getsize, isfile, join, realpath
+
+from .cache import CACHE, CACHE_DIR
+
+# Tamaño máximo en MB de los ficheros guardados en el almacén
+STORE_SIZE = int(environ.get("MKVMRG_STORE_SIZE", 2048))
+
+
+class ArtefactStore:
+    """
+    Almacén persistente de ficheros derivados (subtítulos extraídos,
+    convertidos o limpiados) y de sus metadatos (lineas, colisiones...)
+    direccionado por contenido: la clave es una huella de lo que identifica
+    el contenido (UID del segmento y de la pista, codec, CodecPrivate...) o
+    el sha1 del propio fichero, nunca su ruta.
+    Cuando se supera max_size se borran los ficheros usados hace más
+    tiempo, nunca los usados en esta ejecución.
+    Se desactiva junto con CACHE (--no-cache)
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.started = time.time()
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        # firma (ruta real, tamaño, mtime, inode) de los ficheros de TMP ->
+        # clave de la que salen. Con la firma, si se reescribe el fichero
+        # deja de valer
+        self.__keys = {}
+
+    @property
+    def enabled(self) -> bool:
+        return CACHE.enabled
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self.__local, "db", None)
+        if db is None:
+            makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(join(self.root, "index.sqlite"), timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS artefact (
+                    key TEXT PRIMARY KEY,
+                    file TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    used REAL NOT NULL
+                )
+            ''')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    used REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (key, name)
+                )
+            ''')
+            try:
+                # Almacenes creados antes de que meta tuviera used
+                db.execute("ALTER TABLE meta ADD COLUMN used REAL NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
+            self.__local.db = db
+        return db
+
+    @staticmethod
+    def fingerprint(*parts) -> str:
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    @staticmethod
+    def file_hash(file: str) -> str:
+        """
+        sha1 del fichero, guardado en CACHE para no releer los que no cambian
+        """
+        sha = CACHE.get("sha1", file)
+        if sha is None:
+            h = hashlib.sha1()
+            with open(file, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            sha = h.hexdigest()
+            CACHE.set("sha1", file, sha)
+        return sha
+
+    @staticmethod
+    def signature(file: str) -> tuple:
+        path = realpath(file)
+        st = stat(path)
+        return (path, st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def key_of(self, file: str) -> str:
+        """
+        Clave del contenido de un fichero: la del almacén si salió de él o
+        se guardó en él en esta ejecución (y no ha cambiado desde entonces)
+        y si no su sha1
+        """
+        sig = ArtefactStore.signature(file)
+        with self.__lock:
+            key = self.__keys.get(sig)
+        if key is None:
+            key = "sha1-" + ArtefactStore.file_hash(sig[0])
+            with self.__lock:
+                self.__keys[sig] = key
+        return key
+
+    def forget(self):
+        """
+        Olvida las claves recordadas de los ficheros de TMP
+        """
+        with self.__lock:
+            self.__keys.clear()
+
+    def __path(self, key: str) -> str:
+        return join(self.root, key[:2], key)
+
+    def fetch(self, key: str, out: str) -> bool:
+        """
+        Si key está en el almacén la deja en out y devuelve True
+        """
+        if not self.enabled:
+            return False
+        try:
+            row = self.db.execute("SELECT file FROM artefact WHERE key = ?", (key, )).fetchone()
+            if row is None or not isfile(row[0]):
+                return False
+            # Copia y no enlace: lo que se haga con out no debe tocar el almacén
+            shutil.copyfile(row[0], out)
+            self.db.execute("UPDATE artefact SET used = ? WHERE key = ?", (time.time(), key))
+            sig = ArtefactStore.signature(out)
+        except (OSError, sqlite3.Error):
+            return False
+        with self.__lock:
+            self.__keys[sig] = key
+        return True
+
+    def save(self, key: str, file: str):
+        """
+        Guarda una copia de file en el almacén con la clave key
+        """
+        if not self.enabled or not isfile(file):
+            return
+        try:
+            path = self.__path(key)
+            makedirs(join(self.root, key[:2]), exist_ok=True)
+            shutil.copyfile(file, path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO artefact (key, file, size, used) VALUES (?, ?, ?, ?)",
+                (key, path, getsize(path), time.time())
+            )
+            self.evict()
+            sig = ArtefactStore.signature(file)
+        except (OSError, sqlite3.Error):
+            return
+        with self.__lock:
+            self.__keys[sig] = key
+
+    def get_meta(self, key: str, name: str) -> dict:
+        if not self.enabled:
+            return {}
+        try:
+            row = self.db.execute("SELECT data, used FROM meta WHERE key = ? AND name = ?", (key, name)).fetchone()
+            if row is not None and row[1] < self.started:
+                self.db.execute("UPDATE meta SET used = ? WHERE key = ? AND name = ?", (time.time(), key, name))
+        except sqlite3.Error:
+            return {}
+        return {} if row is None else json.loads(row[0])
+
+    def set_meta(self, key: str, name: str, data: dict):
+        if not self.enabled:
+            return
+        try:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, name, data, used) VALUES (?, ?, ?, ?)",
+                (key, name, json.dumps(data), time.time())
+            )
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        """
+        Borra los ficheros usados hace más tiempo hasta quedar por debajo
+        de max_size, y con ellos los metadatos de los ficheros sin artefacto
+        (claves sha1-) que llevan sin usarse al menos lo mismo. Los usados
+        en esta ejecución no se tocan
+        """
+        db = self.db
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM artefact").fetchone()[0]
+        limit = self.max_size * 1024 * 1024
+        if total <= limit:
+            return
+        rows = db.execute(
+            "SELECT key, file, size, used FROM artefact WHERE used < ? ORDER BY used",
+            (self.started, )
+        ).fetchall()
+        oldest = None
+        for key, file, size, used in rows:
+            if total <= limit:
+                break
+            if isfile(file):
+                remove(file)
+            db.execute("DELETE FROM artefact WHERE key = ?", (key, ))
+            db.execute("DELETE FROM meta WHERE key = ?", (key, ))
+            total = total - size
+            oldest = used
+        if oldest is not None:
+            db.execute("DELETE FROM meta WHERE key LIKE 'sha1-%' AND used <= ?", (oldest, ))
+
+
+STORE = ArtefactStore(join(CACHE_DIR, "store"), STORE_SIZE)
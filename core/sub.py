@@ -1,10 +1,19 @@
 import re
 
 import pysubs2
-from typing import Tuple, List
-from os.path import splitext
+from bisect import bisect_left, bisect_right
+from functools import cached_property
+from typing import Iterable, Tuple, List, Optional
+from os.path import isfile, splitext
 
-from .util import backtwo, to_utf8
+from .util import to_utf8, read_file, get_printable
+from .pgsreader import PGSReader, InvalidSegmentError
+from .vobsubreader import VobSubReader
+from .store import STORE, ArtefactStore
+
+# Subir cada vez que cambie la limpieza (re_nosub, improve, load...)
+# para que no se reutilice lo guardado en STORE con las reglas anteriores
+CLEAN_VERSION = 2
 
 re_nosub = re.compile("|".join(x.pattern for x in map(re.compile, [
     r"\bnewpct(\d+)?\.com",
@@ -25,35 +34,50 @@ class SSAFile(pysubs2.SSAFile):
     def _enum(self) -> List[Tuple[int, pysubs2.SSAEvent]]:
         return list(enumerate(self))
 
-    def _revenum(self) -> List[Tuple[int, pysubs2.SSAEvent]]:
-        return list(reversed(self._enum()))
-
-    def _backtwo(self) -> List[Tuple[int, pysubs2.SSAEvent, pysubs2.SSAEvent]]:
-        return list(backtwo(self))
-
     def improve(self):
         bk_len = len(self)
         self.sort()
-        for i, s in self._revenum():
-            if re_nosub.search(s.text) or len(s.text.strip()) == 0:
-                del self[i]
+        self.events = [s for s in self if not (re_nosub.search(s.text) or len(s.text.strip()) == 0)]
         flag = len(self) + 1
         while len(self) < flag:
             flag = len(self)
-            for i, s in self._revenum():
-                for o in self[:i]:
-                    if o.text == s.text and o.start <= s.start <= o.end:
-                        if s.end > o.end:
-                            o.end = s.end
-                        del self[i]
-                        break
-            for i, s, prev in self._backtwo():
-                if s.text != prev.text and (s.start, s.end) == (prev.start, s.end):
-                    prev.text = prev.text + "\n" + s.text
-                    del self[i]
+            self.events = self._join_same_text()
+            self.events = self._join_same_start()
             self.sort()
         return (len(self) < bk_len)
 
+    def _join_same_text(self) -> List[pysubs2.SSAEvent]:
+        """
+        Une las lineas con el mismo texto que se solapan o se tocan.
+        Con los eventos ordenados por inicio solo puede solapar con la
+        última linea conservada de ese mismo texto
+        """
+        last: dict[str, pysubs2.SSAEvent] = {}
+        events = []
+        for s in self:
+            o = last.get(s.text)
+            if o is not None and s.start <= o.end:
+                if s.end > o.end:
+                    o.end = s.end
+                continue
+            last[s.text] = s
+            events.append(s)
+        return events
+
+    def _join_same_start(self) -> List[pysubs2.SSAEvent]:
+        """
+        Junta en una sola linea las lineas consecutivas de distinto texto
+        que empiezan a la vez (recorriendo de atrás hacia delante)
+        """
+        events = list(self)
+        keep = [True] * len(events)
+        for i in range(len(events) - 1, 0, -1):
+            s, prev = events[i], events[i - 1]
+            if s.text != prev.text and s.start == prev.start:
+                prev.text = prev.text + "\n" + s.text
+                keep[i] = False
+        return [s for s, k in zip(events, keep) if k]
+
 
 class SubLine:
     def __init__(self, index, line):
@@ -100,8 +124,9 @@ class Sub:
             subs.__class__ = SSAFile
             return subs
 
-    def transform(self, format_: str):
-        subs = self.load()
+    def transform(self, format_: str, subs: SSAFile = None):
+        if subs is None:
+            subs = self.load()
         strng = subs.to_string(format_)
         if strng.strip():
             subs = pysubs2.SSAFile.from_string(strng, format=format_)
@@ -132,7 +157,10 @@ class Sub:
 
     @property
     def fonts(self) -> tuple[str]:
-        subs = Sub.read(self.file)
+        return Sub.get_fonts(Sub.read(self.file))
+
+    @staticmethod
+    def get_fonts(subs: SSAFile) -> tuple[str]:
         fonts = set()
         for f in subs.styles.values():
             fonts.add(f.fontname)
@@ -145,26 +173,43 @@ class Sub:
             out = self.file + "." + out
         if out == self.file:
             out = out + "." + out.rsplit(".", 1)[-1]
+        if not STORE.enabled:
+            self.load().save(out)
+            return out
+        key = "clean-" + ArtefactStore.fingerprint(
+            STORE.key_of(self.file),
+            CLEAN_VERSION,
+            out.rsplit(".", 1)[-1].lower()
+        )
+        if STORE.fetch(key, out):
+            return out
         subs = self.load()
         subs.save(out)
+        STORE.save(key, out)
         return out
 
-    def get_collisions(self):
-        subs = self.transform("srt")
+    def get_collisions(self, subs: SSAFile = None):
+        if subs is None:
+            subs = self.transform("srt")
         subs.sort()
-        times = {}
+        # Barrido por eventos de inicio/fin: entre dos instantes consecutivos
+        # el conjunto de lineas activas no cambia
+        times = []
         for indx, s in subs._enum():
-            for i in range(s.start, s.end):
-                if i not in times:
-                    times[i] = []
-                times[i].append(indx)
+            if s.start < s.end:
+                times.append((s.start, indx))
+                times.append((s.end, -indx - 1))
+        times.sort()
 
         colls = set()
-        for k in sorted(times.keys()):
-            v = times[k]
-            if len(v) < 2:
-                continue
-            colls.add(tuple(v))
+        active = set()
+        for i, (t, indx) in enumerate(times):
+            if indx < 0:
+                active.discard(-indx - 1)
+            else:
+                active.add(indx)
+            if len(active) > 1 and i + 1 < len(times) and times[i + 1][0] > t:
+                colls.add(tuple(sorted(active)))
 
         if len(colls) == 0:
             return
@@ -183,3 +228,177 @@ class Sub:
     def get_format(file: str):
         ext = splitext(file)[1].lower()
         return pysubs2.ssafile.get_format_identifier(ext)
+
+
+class TimeIndex:
+    """
+    Tiempos (inicio, fin) de las lineas de un subtítulo ordenados por separado
+    para contar con dos búsquedas binarias cuantas se solapan con una ventana:
+    las que no empiezan después del final ni terminan antes del principio
+    """
+
+    def __init__(self, times: Iterable[Tuple[float, float]]):
+        self.starts = []
+        self.ends = []
+        # lineas que terminan antes de empezar, no cumplen la cuenta de arriba
+        self.odd = []
+        for start, end in times:
+            if start <= end:
+                self.starts.append(start)
+                self.ends.append(end)
+            else:
+                self.odd.append((start, end))
+        self.starts.sort()
+        self.ends.sort()
+
+    def __len__(self):
+        return len(self.starts) + len(self.odd)
+
+    def count(self, start: float, end: float) -> int:
+        cnt = bisect_right(self.starts, end) - bisect_left(self.ends, start)
+        for s, e in self.odd:
+            if not (e < start or s > end):
+                cnt = cnt + 1
+        return cnt
+
+
+class SubAnalysis:
+    """
+    Análisis de un subtítulo extraído. Cada fichero se lee y parsea una sola
+    vez y el resto de valores (lineas, colisiones, fuentes...) se calculan
+    a partir de ese resultado.
+    Los valores se guardan en STORE por contenido del fichero, de manera que
+    si ya se analizó en otra ejecución no hace falta ni parsearlo
+    """
+
+    def __init__(self, file: str, text_subtitles: bool = True, trim=None):
+        self.file = file
+        self.text_subtitles = text_subtitles
+        self.trim = trim
+
+    @property
+    def key(self):
+        return (self.file, self.trim)
+
+    @cached_property
+    def stored(self) -> dict:
+        return STORE.get_meta(self.artefact, self.meta_name)
+
+    @cached_property
+    def artefact(self) -> Optional[str]:
+        # Sin STORE no hace falta el sha1 del fichero
+        if not STORE.enabled:
+            return None
+        return STORE.key_of(self.file)
+
+    @property
+    def meta_name(self) -> str:
+        return "analysis:{}:{}:{}".format(CLEAN_VERSION, self.text_subtitles, self.trim and tuple(self.trim))
+
+    def _remember(self, name: str, value):
+        self.stored[name] = value
+        STORE.set_meta(self.artefact, self.meta_name, self.stored)
+        return value
+
+    @cached_property
+    def sub(self) -> Sub:
+        return Sub(self.file)
+
+    @cached_property
+    def subs(self) -> SSAFile:
+        return self.sub.load()
+
+    @cached_property
+    def events(self) -> SSAFile:
+        return self.sub.transform("srt", subs=self.subs)
+
+    @cached_property
+    def is_empty(self) -> bool:
+        if not self.text_subtitles:
+            return False
+        if "is_empty" in self.stored:
+            return self.stored["is_empty"]
+        cnt = read_file(self.sub.file)
+        return self._remember("is_empty", len(get_printable(cnt)) == 0)
+
+    @cached_property
+    def lines(self) -> int:
+        if "lines" in self.stored:
+            return self.stored["lines"]
+        return self._remember("lines", self._lines())
+
+    @cached_property
+    def time_index(self) -> TimeIndex:
+        """
+        Tiempos en milisegundos de las lineas, None si no se pueden saber
+        """
+        if self.text_subtitles:
+            if self.is_empty:
+                return TimeIndex([])
+            return TimeIndex((x.start, x.end) for x in self.events)
+        if self.file.endswith(".sub") and isfile(self.file.rsplit(".", 1)[0] + ".idx"):
+            return TimeIndex((s.start, s.end) for s in self.subpictures)
+        return None
+
+    @cached_property
+    def subpictures(self) -> tuple:
+        """
+        Subpictures de un VobSub con su inicio, duración y si son forzados
+        """
+        if not self.file.endswith(".sub"):
+            return tuple()
+        with VobSubReader(self.file) as vob:
+            return tuple(vob.iter_subpictures())
+
+    @cached_property
+    def all_forced(self) -> bool:
+        """
+        True si todas las imágenes de un VobSub se muestran como forzadas,
+        None si no se puede saber (subtítulos que no son VobSub)
+        """
+        if not self.file.endswith(".sub"):
+            return None
+        if "all_forced" in self.stored:
+            return self.stored["all_forced"]
+        subs = self.subpictures
+        return self._remember("all_forced", len(subs) > 0 and all(s.forced for s in subs))
+
+    def count(self, trim=None) -> int:
+        """
+        Lineas que se ven en el recorte trim (o en total si no hay recorte)
+        """
+        if self.file.endswith(".pgs"):
+            with PGSReader(self.file) as pgs:
+                try:
+                    return pgs.count_images()
+                except InvalidSegmentError:
+                    return 0
+        index = self.time_index
+        if index is None:
+            return None
+        if trim is None:
+            return len(index)
+        return index.count(trim.start*1000, trim.end*1000)
+
+    def _lines(self) -> int:
+        return self.count(self.trim)
+
+    @cached_property
+    def fonts(self) -> tuple:
+        if not self.text_subtitles or self.is_empty:
+            return tuple()
+        if "fonts" in self.stored:
+            return tuple(self.stored["fonts"])
+        return tuple(self._remember("fonts", Sub.get_fonts(self.subs)))
+
+    @cached_property
+    def collisions(self) -> tuple:
+        if not self.text_subtitles or self.is_empty or self.lines < 2:
+            return tuple()
+        return tuple(self.sub.get_collisions(subs=self.events))
+
+    @cached_property
+    def num_collisions(self) -> int:
+        if "collisions" in self.stored:
+            return self.stored["collisions"]
+        return self._remember("collisions", len(self.collisions))
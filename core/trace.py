@@ -0,0 +1,163 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from functools import wraps
+from os import environ
+from os.path import isfile
+from typing import Dict, List
+
+# Ficheros cuyos frames no cuentan como origen de una llamada a Shell
+SKIP = ("core/shell.py", "core/trace.py", "contextlib.py")
+
+
+@dataclass
+class Span:
+    name: str
+    cat: str
+    start: float
+    tid: int
+    args: dict = field(default_factory=dict)
+    duration: float = None
+
+    def to_event(self, origin: float) -> dict:
+        return dict(
+            name=self.name,
+            cat=self.cat,
+            ph="X",
+            ts=round((self.start - origin) * 1000000),
+            dur=round((self.duration or 0) * 1000000),
+            pid=os.getpid(),
+            tid=self.tid,
+            args=self.args,
+        )
+
+
+class Tracer:
+    """
+    Perfilado opcional de mkvmrg. Guarda un span por cada comando lanzado
+    con Shell (con su duración, código de salida, bytes de salida y la
+    función que lo pidió) y por cada etapa marcada con stage o span.
+    Al salir se imprime un resumen y se escribe un json con formato
+    Chrome trace (chrome://tracing o https://ui.perfetto.dev)
+    """
+
+    def __init__(self, file: str = None):
+        self.file = None
+        self.origin = time.perf_counter()
+        self.spans: List[Span] = []
+        self.__lock = threading.Lock()
+        if file:
+            self.enable(file)
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def enable(self, file: str):
+        if self.file is None:
+            atexit.register(self.close)
+        self.file = file
+
+    @staticmethod
+    def caller() -> str:
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename.endswith(SKIP):
+            frame = frame.f_back
+        if frame is None:
+            return None
+        code = frame.f_code
+        return getattr(code, "co_qualname", code.co_name)
+
+    def span(self, name: str, cat: str = "stage", **args):
+        """
+        Context manager que mide lo que se ejecuta dentro. Devuelve el dict
+        de args del span para poder añadirle datos que se saben al final
+        """
+        if not self.enabled:
+            return nullcontext({})
+        return self.__span(name, cat, args)
+
+    @contextmanager
+    def __span(self, name: str, cat: str, args: dict):
+        span = Span(name=name, cat=cat, start=time.perf_counter(), tid=threading.get_ident(), args=args)
+        try:
+            yield span.args
+        finally:
+            span.duration = time.perf_counter() - span.start
+            with self.__lock:
+                self.spans.append(span)
+
+    def command(self, args: tuple):
+        """
+        Span de un comando externo, con la función que lo ha lanzado
+        """
+        if not self.enabled:
+            return nullcontext({})
+        # mkvmerge -J, mkvmerge -o, mkvextract, mkvpropedit...
+        name = args[0] if len(args) < 2 or isfile(args[1]) else "{} {}".format(*args[:2])
+        return self.__span(
+            name,
+            "shell",
+            dict(command=" ".join(map(str, args)), caller=Tracer.caller())
+        )
+
+    def stage(self, name: str = None):
+        """
+        Decorador que mide cada llamada a la función como una etapa
+        """
+        def wrapper(func):
+            label = name or func.__qualname__
+
+            @wraps(func)
+            def traced(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.__span(label, "stage", {}):
+                    return func(*args, **kwargs)
+            return traced
+        return wrapper
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Por nombre de span: veces, segundos en total y bytes de salida
+        """
+        total: Dict[str, dict] = {}
+        for s in self.spans:
+            t = total.setdefault(s.name, dict(cat=s.cat, count=0, seconds=0, bytes=0))
+            t['count'] = t['count'] + 1
+            t['seconds'] = t['seconds'] + s.duration
+            t['bytes'] = t['bytes'] + (s.args.get('bytes') or 0)
+        return dict(sorted(total.items(), key=lambda kv: -kv[1]['seconds']))
+
+    def save(self, file: str):
+        with self.__lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        with open(file, "w") as f:
+            json.dump(dict(
+                traceEvents=[s.to_event(self.origin) for s in spans],
+                displayTimeUnit="ms",
+                otherData=dict(
+                    argv=sys.argv,
+                    seconds=time.perf_counter() - self.origin,
+                    summary=self.summary()
+                )
+            ), f, indent=1, default=str)
+
+    def close(self):
+        if not self.enabled:
+            return
+        print("")
+        print("# Perfil ({:.2f}s en total)".format(time.perf_counter() - self.origin))
+        for name, t in self.summary().items():
+            size = " {:.1f} KB".format(t['bytes'] / 1024) if t['bytes'] else ""
+            print("#   {:<40} x{:<4} {:>8.3f}s{}".format(name, t['count'], t['seconds'], size))
+        self.save(self.file)
+        print("# Perfil guardado en", self.file)
+
+
+TRACE = Tracer(environ.get("MKVMRG_PROFILE"))
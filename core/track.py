@@ -1,14 +1,17 @@
 import re
+import threading
 
 from os.path import isfile, getsize, basename
 
-from .mkvutil import MkvInfo, MkvInfoTrack, MkvInfoTrackProperties, Duration, Trim
+from .mkvutil import MkvInfo, MkvInfoTrack, MkvInfoTrackProperties, Duration, Trim, mkvtoolnix_version
+from .cache import CACHE
 from .shell import Shell
-from typing import Union, List, Tuple
-from .util import LANG_ES, trim, read_file, get_printable, to_utf8, BadType
-from .sub import Sub
-from .pgsreader import PGSReader, InvalidSegmentError
+from typing import Callable, Dict, Union, List, Tuple
+from .util import LANG_ES, trim, to_utf8, BadType
+from .sub import Sub, SubAnalysis
 from dataclasses import dataclass
+from functools import cached_property
+from shutil import which
 
 re_doblage = re.compile(r"((?:19|20)\d\d+)", re.IGNORECASE)
 
@@ -22,33 +25,92 @@ class ChangeSet:
 
 
 class MkvLang:
-    def __init__(self):
-        self.code = {}
-        self.description = {}
+    """
+    Tabla de idiomas de mkvmerge --list-languages. Se carga de forma perezosa
+    desde la cache en disco y solo se lanza mkvmerge si no existe o ha
+    cambiado la versión de mkvtoolnix
+    """
+
+    @cached_property
+    def _table(self) -> dict:
+        mkvmerge = which("mkvmerge")
+        version = mkvtoolnix_version()
+        table = None
+        if mkvmerge is not None:
+            table = CACHE.get("mkvlang", mkvmerge, version=version)
+        if table is None:
+            table = MkvLang.build()
+            if mkvmerge is not None:
+                CACHE.set("mkvlang", mkvmerge, table, version=version)
+        return table
+
+    @staticmethod
+    def build() -> dict:
+        code = {}
+        description = {}
         langs = Shell.get("mkvmerge", "--list-languages", do_print=False)
         for l in langs.strip().split("\n")[2:]:
             label, *cods = map(trim, l.split(" |"))
             cods = sorted(set(c for c in cods if c is not None))
             for cod in cods:
-                self.description[cod] = label
+                description[cod] = label
             if len(cods) > 1:
-                self.code[cods[0]] = cods[1]
-                self.code[cods[1]] = cods[0]
+                code[cods[0]] = cods[1]
+                code[cods[1]] = cods[0]
+        return dict(code=code, description=description)
+
+    @property
+    def code(self) -> dict:
+        return self._table['code']
+
+    @property
+    def description(self) -> dict:
+        return self._table['description']
 
 
 MKVLANG = MkvLang()
 
+LANG_LABEL = {
+    **{k: "Español" for k in LANG_ES},
+    "ja": "Japonés", "jpn": "Japonés",
+    "en": "Inglés", "eng": "Inglés",
+    "hi": "Hindi", "hin": "Hindi",
+    "ko": "Coreano", "kor": "Coreano",
+    "fr": "Francés", "fre": "Francés",
+    "zh": "Chino", "chi": "Chino",
+}
+
 
 class BannableItem:
+    # Número de bans hechos hasta ahora, para saber si lo que se calculó
+    # a partir de ellos sigue siendo válido
+    __bans = 0
+    __lock = threading.Lock()
+
     def __init__(self, *args, **kwargs):
         self.__baned = False
+        self.__listeners: List[Callable[['BannableItem'], None]] = []
+
+    @staticmethod
+    def bans() -> int:
+        return BannableItem.__bans
+
+    def on_ban(self, listener: Callable[['BannableItem'], None]):
+        """
+        listener(item) se llamará cuando este item sea baneado
+        """
+        self.__listeners.append(listener)
 
     def ban(self, msg=None):
         if self.__baned:
             return
         if msg:
             print(msg)
-        self.__baned = True
+        with BannableItem.__lock:
+            self.__baned = True
+            BannableItem.__bans = BannableItem.__bans + 1
+        for listener in self.__listeners:
+            listener(self)
 
     @property
     def banned(self):
@@ -146,7 +208,7 @@ class Track(BannableItem):
             if len(tinfo.chapters) == 1 and tinfo.chapters[0].num_entries == 1:
                 rm_chapters = True
 
-        data = dict(track.properties.copy())
+        data = track.properties.to_dict()
         data['id'] = track.id
         data['codec'] = track.codec
         data['type'] = track.type
@@ -186,8 +248,8 @@ class Track(BannableItem):
         if len(lg) == 0:
             return "und"
         lg = lg[0]
-        if len(lg) == 2 and MKVLANG.code.get(lg):
-            lg = MKVLANG.code.get(lg)
+        if len(lg) == 2:
+            lg = MKVLANG.code.get(lg) or lg
         return lg
 
     @property
@@ -196,24 +258,11 @@ class Track(BannableItem):
 
     @property
     def lang_name(self) -> str:
-        if self.lang in LANG_ES:
-            return "Español"
-        if self.lang in ("ja", "jpn"):
-            return "Japonés"
-        if self.lang in ("en", "eng"):
-            return "Inglés"
-        if self.lang in ("hi", "hin"):
-            return "Hindi"
-        if self.lang in ("ko", "kor"):
-            return "Coreano"
-        if self.lang in ("fr", "fre"):
-            return "Francés"
-        if self.lang in ("zh", "chi"):
-            return "Chino"
-        label = MKVLANG.description.get(self.lang)
+        lang = self.lang
+        label = LANG_LABEL.get(lang) or MKVLANG.description.get(lang)
         if label:
             return label
-        return self.lang
+        return lang
 
     @property
     def isLatino(self) -> bool:
@@ -385,6 +434,7 @@ class SubTrack(Track):
         super().__init__(*args, **kwargs)
         self.codec_id = codec_id
         self.text_subtitles = text_subtitles
+        self.__analysis: Union[SubAnalysis, None] = None
         self.fix_text_subtitles()
 
     def fix_text_subtitles(self):
@@ -410,25 +460,29 @@ class SubTrack(Track):
             arr.append("({} línea{})".format(self.lines, "s" if self.lines > 1 else ""))
         return " ".join(arr)
 
+    @property
+    def analysis(self) -> SubAnalysis:
+        if not self.has_file():
+            return None
+        key = (self.source_file, self.trim)
+        if self.__analysis is None or self.__analysis.key != key:
+            self.__analysis = SubAnalysis(self.source_file, text_subtitles=self.text_subtitles, trim=self.trim)
+        return self.__analysis
+
     def is_empty_source(self) -> bool:
         if super().is_empty_source():
             return True
         if self.text_subtitles and self.has_file():
-            cnt = read_file(self.source_file)
-            cnt = get_printable(cnt)
-            if len(cnt) == 0:
-                return True
+            return self.analysis.is_empty
         return False
 
     def to_sub(self) -> Sub:
         if self.text_subtitles:
-            return Sub(self.source_file)
+            return self.analysis.sub
 
     def srt_lines(self) -> list:
         if self.text_subtitles:
-            sb = self.to_sub()
-            lines = list(sb.transform("srt"))
-            return lines
+            return list(self.analysis.events)
 
     @property
     def lines(self) -> int:
@@ -436,36 +490,7 @@ class SubTrack(Track):
             return None
         if self.is_empty_source():
             return 0
-        if self.text_subtitles:
-            sb = self.to_sub()
-            lines = list(sb.transform("srt"))
-            if self.trim:
-                for i, x in reversed(list(enumerate(lines))):
-                    if x.end < (self.trim.start*1000) or x.start > (self.trim.end*1000):
-                        del lines[i]
-            lines = len(lines)
-            return lines
-        if self.source_file.endswith(".pgs"):
-            pgs = PGSReader(self.source_file)
-            try:
-                dss = list(ds for ds in pgs.displaysets if ds.has_image)
-            except InvalidSegmentError:
-                return 0
-            return len(dss)
-        if self.source_file.endswith(".sub"):
-            idx = self.source_file.rsplit(".", 1)[0] + ".idx"
-            txt = read_file(idx)
-            if txt is not None:
-                lines = 0
-                for l in txt.split("\n"):
-                    if l.strip().startswith("timestamp: "):
-                        if self.trim is not None:
-                            h, m, s, ms = map(int, l[11:23].split(":"))
-                            seg = h*60*60 + m*60 + s + (ms/1000)
-                            if seg < self.trim.start or seg > self.trim.end:
-                                continue
-                        lines = lines + 1
-                return lines
+        return self.analysis.lines
 
     @property
     def fonts(self) -> tuple:
@@ -473,8 +498,13 @@ class SubTrack(Track):
             return None
         if not self.text_subtitles or self.is_empty_source():
             return tuple()
-        sb = self.to_sub()
-        return sb.fonts
+        return self.analysis.fonts
+
+    @property
+    def all_forced(self) -> bool:
+        if not self.has_file():
+            return None
+        return self.analysis.all_forced
 
     @property
     def collisions(self) -> int:
@@ -482,9 +512,7 @@ class SubTrack(Track):
             return None
         if self.is_empty_source() or self.lines < 2:
             return 0
-        sb = self.to_sub()
-        colls = list(sb.get_collisions())
-        return len(colls)
+        return self.analysis.num_collisions
 
     def is_srt_candidate(self):
         if self.file_extension == "srt":
@@ -598,4 +626,50 @@ class TrackList(List[Track], TrackIter):
 
 
 class TrackTuple(Tuple[Track], TrackIter):
-    pass
+    """
+    Como es inmutable, el índice por tipo se calcula una sola vez y los
+    baneados se recalculan solo si ha habido algún ban desde la última vez
+    """
+
+    @cached_property
+    def _by_type(self) -> Dict[str, 'TrackTuple']:
+        index: Dict[str, List[Track]] = {}
+        for t in self:
+            if not isinstance(t, Track):
+                raise BadType(t)
+            index.setdefault(t.type, []).append(t)
+        return {k: TrackTuple(v) for k, v in index.items()}
+
+    def get_tracks(self, *typeids) -> Tuple['Track']:
+        if len(typeids) == 1 and isinstance(typeids[0], str):
+            return self._by_type.get(typeids[0], EMPTY)
+        return super().get_tracks(*typeids)
+
+    @cached_property
+    def ids(self) -> Tuple[int]:
+        return tuple(sorted(t.id for t in self))
+
+    def __split_banned(self) -> Tuple['TrackTuple', 'TrackTuple']:
+        bans = BannableItem.bans()
+        split = self.__dict__.get("_split")
+        if split is None or split[0] != bans:
+            banned = []
+            no_banned = []
+            for i in self:
+                if not isinstance(i, BannableItem):
+                    raise BadType(i)
+                (banned if i.banned else no_banned).append(i)
+            split = (bans, TrackTuple(banned), TrackTuple(no_banned))
+            self.__dict__["_split"] = split
+        return split[1:]
+
+    @property
+    def banned(self) -> Tuple['Track']:
+        return self.__split_banned()[0]
+
+    @property
+    def no_banned(self) -> Tuple['Track']:
+        return self.__split_banned()[1]
+
+
+EMPTY = TrackTuple()
@@ -1,10 +1,20 @@
 import re
-import tempfile
+import io
+import sys
+import codecs
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import stat
 from os.path import basename, dirname, realpath, isfile
+from typing import Tuple
 import unicodedata
 import json
 
-from chardet import detect
+from chardet.universaldetector import UniversalDetector
+
+from .store import STORE, ArtefactStore
+from .scratch import Scratch
 
 re_sp = re.compile(r"\s+")
 LANG_ES = ("es", "spa", "es-ES")
@@ -12,61 +22,166 @@ LANG_EN = ("en", "eng", "en-EN")
 LANG_SB = LANG_ES + LANG_EN
 
 
-class MyTMP:
-    def __init__(self, prefix=None):
-        self._tmp = None
-        self.prefix = prefix
+TMP = Scratch(prefix="mkvmrg.")
 
-    @property
-    def tmp(self):
-        if self._tmp is None:
-            self._tmp = tempfile.mkdtemp(prefix=self.prefix)
-            print("$ mkdir -p", self._tmp)
-        return self._tmp
 
-    def __str__(self):
-        return self.tmp
+def backtwo(arr) -> reversed:
+    arr = zip(range(1, len(arr)), arr[1:], arr)
+    return reversed(list(arr))
 
-    def __add__(self, o):
-        return self.tmp + o
 
+# Bytes que se leen de una vez y como mucho se pasan a chardet
+ENCODING_CHUNK = 64 * 1024
+ENCODING_SAMPLE = 64 * 1024
 
-TMP = MyTMP(prefix="mkvmrg.")
+BOMS = (
+    (codecs.BOM_UTF32_LE, "UTF-32"),
+    (codecs.BOM_UTF32_BE, "UTF-32"),
+    (codecs.BOM_UTF8, "UTF-8-SIG"),
+    (codecs.BOM_UTF16_LE, "UTF-16"),
+    (codecs.BOM_UTF16_BE, "UTF-16"),
+)
 
+ENCODINGS = {}
+ENCODINGS_LOCK = threading.Lock()
 
-def backtwo(arr) -> reversed:
-    arr = zip(range(1, len(arr)), arr[1:], arr)
-    return reversed(list(arr))
 
+def _encoding_key(file: str) -> tuple:
+    st = stat(file)
+    return (realpath(file), st.st_size, st.st_mtime_ns)
 
-def get_encoding_type(file):
+
+def _is_valid(file: str, enc: str) -> bool:
+    decoder = codecs.getincrementaldecoder(enc)(errors="strict")
+    try:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(ENCODING_CHUNK), b''):
+                decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
+def _guess_encoding(file: str) -> Tuple[str, bool]:
+    """
+    Orden: BOM, UTF-8 estricto (en la misma lectura se alimenta a chardet
+    con el principio del fichero) y si no es UTF-8 lo que diga chardet, o
+    en último caso iso-8859-1.
+    Devuelve (codificación, verificada): lo de chardet está sin verificar
+    contra todo el fichero
+    """
+    utf8 = codecs.getincrementaldecoder("utf-8")(errors="strict")
+    detector = UniversalDetector()
+    is_utf8 = True
+    is_ascii = True
+    sampled = 0
     with open(file, 'rb') as f:
-        rawdata = f.read()
-    dtc = detect(rawdata)
-    enc = dtc['encoding']
-    for e in (enc, "iso-8859-1"):
+        head = f.read(4)
+        for bom, enc in BOMS:
+            if head.startswith(bom):
+                return enc, True
+        f.seek(0)
+        for chunk in iter(lambda: f.read(ENCODING_CHUNK), b''):
+            if sampled < ENCODING_SAMPLE and not detector.done:
+                detector.feed(chunk[:ENCODING_SAMPLE - sampled])
+                sampled = sampled + len(chunk)
+            is_ascii = is_ascii and chunk.isascii()
+            if is_utf8:
+                try:
+                    utf8.decode(chunk)
+                except UnicodeDecodeError:
+                    is_utf8 = False
+            if not is_utf8 and (detector.done or sampled >= ENCODING_SAMPLE):
+                break
+    if is_utf8:
         try:
-            with open(file, 'r', encoding=e) as s:
-                s.read()
-            return e
+            utf8.decode(b'', final=True)
+            return ("ascii" if is_ascii else "utf-8"), True
         except UnicodeDecodeError:
             pass
-    raise Exception("No se ha detectado la codificación de " + file)
+    enc = detector.close()['encoding']
+    if enc is not None and enc.lower() not in ("ascii", "utf-8"):
+        return enc, False
+    return "iso-8859-1", True
+
+
+def get_encoding_type(file):
+    """
+    Codificación del fichero, calculada una sola vez por (ruta, tamaño, mtime)
+    """
+    key = _encoding_key(file)
+    with ENCODINGS_LOCK:
+        enc = ENCODINGS.get(key)
+    if enc is None:
+        enc, verified = _guess_encoding(file)
+        if not verified and not _is_valid(file, enc):
+            enc = "iso-8859-1"
+        with ENCODINGS_LOCK:
+            ENCODINGS[key] = enc
+    return enc
+
+
+def forget():
+    """
+    Olvida lo que se recuerda durante la ejecución (codificaciones y
+    claves del almacén) para que no crezca sin límite en procesos largos
+    """
+    with ENCODINGS_LOCK:
+        ENCODINGS.clear()
+    STORE.forget()
+
+
+def _convert(file: str, out: str, enc: str) -> str:
+    """
+    Copia file en out como UTF-8 decodificando de forma estricta con enc,
+    que así queda verificada en la misma lectura. Si falla se vuelve a
+    empezar con iso-8859-1. Devuelve la codificación usada
+    """
+    try:
+        with open(file, 'r', encoding=enc, errors='strict') as s:
+            with open(out, 'w', encoding='utf-8-sig') as t:
+                shutil.copyfileobj(s, t, ENCODING_CHUNK)
+        return enc
+    except (UnicodeDecodeError, LookupError):
+        pass
+    with open(file, 'r', encoding='iso-8859-1') as s:
+        with open(out, 'w', encoding='utf-8-sig') as t:
+            shutil.copyfileobj(s, t, ENCODING_CHUNK)
+    return "iso-8859-1"
 
 
 def to_utf8(file: str) -> str:
-    enc = get_encoding_type(file)
+    src = _encoding_key(file)
+    with ENCODINGS_LOCK:
+        enc = ENCODINGS.get(src)
+    verified = enc is not None
+    if enc is None:
+        enc, verified = _guess_encoding(file)
     if enc in ("utf-8", "ascii", "UTF-8-SIG"):
+        with ENCODINGS_LOCK:
+            ENCODINGS[src] = enc
         return file
 
     n_file = TMP + "/" + basename(file)
     while n_file == file:
         n_file = n_file + "." + n_file.split(".")[-1]
-    with open(file, 'r', encoding=enc) as s:
-        with open(n_file, 'w', encoding='utf-8-sig') as t:
-            text = s.read()
-            t.write(text)
-    print("# MV", file, "({}) -> ({})".format(enc, get_encoding_type(n_file)), n_file)
+    # Sin STORE no hace falta el sha1 del fichero
+    key = "utf8-" + ArtefactStore.fingerprint(STORE.key_of(file)) if STORE.enabled else None
+    if key is not None and STORE.fetch(key, n_file):
+        used = STORE.get_meta(key, "encoding").get("encoding")
+        if used is not None:
+            enc, verified = used, True
+    else:
+        enc, verified = _convert(file, n_file, enc), True
+        if key is not None:
+            STORE.save(key, n_file)
+            STORE.set_meta(key, "encoding", dict(encoding=enc))
+    with ENCODINGS_LOCK:
+        if verified:
+            ENCODINGS[src] = enc
+        ENCODINGS[_encoding_key(n_file)] = "UTF-8-SIG"
+    print("# MV", file, "({}) -> ({})".format(enc, "UTF-8-SIG"), n_file)
     return n_file
 
 
@@ -145,3 +260,79 @@ class SetList(list):
 class BadType(ValueError):
     def __init__(self, obj):
         super().__init__("Tipo no reconocido "+str(type(obj)))
+
+
+class ThreadStdout:
+    """
+    Sustituto de sys.stdout que permite que cada hilo escriba en su propio
+    buffer. Los hilos sin buffer escriben directamente en la salida original
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    @staticmethod
+    def install() -> 'ThreadStdout':
+        if not isinstance(sys.stdout, ThreadStdout):
+            sys.stdout = ThreadStdout(sys.stdout)
+        return sys.stdout
+
+    @staticmethod
+    def is_captured() -> bool:
+        if not isinstance(sys.stdout, ThreadStdout):
+            return False
+        return getattr(sys.stdout.local, "buffer", None) is not None
+
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stdout.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+def captured(func, item) -> tuple:
+    """
+    Ejecuta func(item) guardando lo que imprime en un buffer propio del
+    hilo. Devuelve (buffer, excepción, resultado)
+    """
+    out = ThreadStdout.install()
+    out.local.buffer = io.StringIO()
+    try:
+        return out.local.buffer, None, func(item)
+    except BaseException as e:
+        return out.local.buffer, e, None
+    finally:
+        out.local.buffer = None
+
+
+def pmap(func, items, jobs: int = 1) -> list:
+    """
+    Aplica func a cada item usando como mucho jobs hilos.
+    Lo que imprime cada tarea se captura y se muestra agrupado y en el
+    mismo orden que items, por lo que la salida es la misma que en serie
+    """
+    items = list(items)
+    if jobs is None or jobs < 2 or len(items) < 2:
+        return [func(i) for i in items]
+
+    ThreadStdout.install()
+
+    rtn = []
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for buffer, exc, val in pool.map(lambda item: captured(func, item), items):
+            sys.stdout.write(buffer.getvalue())
+            if exc is not None:
+                raise exc
+            rtn.append(val)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return rtn
@@ -0,0 +1,231 @@
+import re
+import struct
+from os.path import isfile
+from typing import Iterator, NamedTuple, Tuple
+
+from .pgsreader import mseg_srt
+
+#########
+### http://dvd.sourceforge.net/dvdinfo/spu.html
+### http://dvd.sourceforge.net/dvdinfo/mpeghdrs.html
+#########
+
+PACK = 0x000001BA
+PRIVATE_STREAM_1 = 0x000001BD
+PROGRAM_END = 0x000001B9
+
+# Comandos de las secuencias de control del SPU y bytes de argumentos
+FSTA_DSP = 0x00
+STA_DSP = 0x01
+STP_DSP = 0x02
+CHG_COLCON = 0x07
+CMD_END = 0xFF
+CMD_ARGS = {
+    FSTA_DSP: 0,
+    STA_DSP: 0,
+    STP_DSP: 0,
+    0x03: 2,
+    0x04: 2,
+    0x05: 6,
+    0x06: 4,
+}
+
+re_timestamp = re.compile(r"^timestamp:\s*(-?)(\d+):(\d+):(\d+):(\d+),\s*filepos:\s*([0-9a-fA-F]+)")
+re_delay = re.compile(r"^delay:\s*(-?)(\d+):(\d+):(\d+):(\d+)")
+re_id = re.compile(r"^id:\s*\w*,\s*index:\s*(\d+)")
+
+
+class InvalidVobSubError(Exception):
+    '''Raised when a packet does not match the VobSub/MPEG-PS layout'''
+
+
+class SubPicture(NamedTuple):
+    index: int
+    start: int
+    duration: int
+    forced: bool
+    filepos: int
+
+    @property
+    def end(self) -> int:
+        return self.start + (self.duration or 0)
+
+
+def to_ms(sign: str, h: str, m: str, s: str, ms: str) -> int:
+    val = ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms)
+    return -val if sign == "-" else val
+
+
+class VobSubReader:
+    """
+    Lector de subtítulos VobSub (.idx + .sub) que recorre las entradas del
+    .idx linea a linea y de cada una lee del .sub solo los paquetes MPEG-PS
+    de su subpicture, saltando a su offset, así que la memoria usada no
+    depende del tamaño de los ficheros
+    """
+
+    def __init__(self, filepath: str):
+        base = filepath.rsplit(".", 1)[0]
+        self.file = base + ".sub"
+        self.idx = base + ".idx"
+        self._sub = open(self.file, 'rb') if isfile(self.file) else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._sub is not None:
+            self._sub.close()
+            self._sub = None
+
+    def iter_idx(self) -> Iterator[Tuple[int, int, int]]:
+        """
+        Genera (índice del stream, inicio en ms, offset en el .sub)
+        """
+        if not isfile(self.idx):
+            return
+        index = 0
+        delay = 0
+        with open(self.idx, 'r', encoding='latin-1') as f:
+            for line in f:
+                line = line.strip()
+                m = re_timestamp.match(line)
+                if m:
+                    yield index, to_ms(*m.groups()[:5]) + delay, int(m.group(6), 16)
+                    continue
+                m = re_id.match(line)
+                if m:
+                    index = int(m.group(1))
+                    delay = 0
+                    continue
+                m = re_delay.match(line)
+                if m:
+                    delay = delay + to_ms(*m.groups())
+
+    def read_packet(self) -> Tuple[int, bytes]:
+        """
+        Lee el siguiente pack MPEG-PS del .sub y devuelve (substream, datos)
+        con substream = None si no es un paquete de subtítulos
+        """
+        f = self._sub
+        code = f.read(4)
+        if len(code) < 4 or int.from_bytes(code, 'big') == PROGRAM_END:
+            return None
+        if int.from_bytes(code, 'big') == PACK:
+            head = f.read(10)
+            if len(head) < 10:
+                return None
+            if head[0] & 0xC0 == 0x40:
+                # MPEG-2: 10 bytes más relleno
+                f.seek(head[9] & 0x07, 1)
+            else:
+                # MPEG-1: 8 bytes
+                f.seek(-2, 1)
+            code = f.read(4)
+        if len(code) < 4 or code[:3] != b'\x00\x00\x01':
+            raise InvalidVobSubError("{} paquete no válido en {}".format(self.file, f.tell() - len(code)))
+        size = f.read(2)
+        if len(size) < 2:
+            return None
+        data = f.read(int.from_bytes(size, 'big'))
+        if int.from_bytes(code, 'big') != PRIVATE_STREAM_1:
+            return None, b''
+        # Cabecera PES de MPEG-2: 2 bytes de flags y la longitud del resto
+        payload = data[3 + data[2]:]
+        if len(payload) == 0:
+            return None, b''
+        return payload[0] & 0x1F, payload[1:]
+
+    def read_spu(self, filepos: int, index: int) -> bytes:
+        """
+        SPU completo que empieza en filepos, que puede estar repartido en
+        varios paquetes del mismo substream
+        """
+        self._sub.seek(filepos)
+        buf = bytearray()
+        size = None
+        while size is None or len(buf) < size:
+            packet = self.read_packet()
+            if packet is None:
+                break
+            substream, data = packet
+            if substream != index:
+                continue
+            buf.extend(data)
+            if size is None and len(buf) >= 2:
+                size = int.from_bytes(buf[:2], 'big')
+        if size is None or len(buf) < size:
+            raise InvalidVobSubError("{} subpicture truncado en {}".format(self.file, filepos))
+        return bytes(buf[:size])
+
+    @staticmethod
+    def parse_control(spu: bytes) -> Tuple[int, bool]:
+        """
+        Recorre las secuencias de control del SPU y devuelve
+        (duración en ms o None, si se muestra forzado)
+        """
+        duration = None
+        forced = False
+        offset = int.from_bytes(spu[2:4], 'big')
+        seen = set()
+        while offset + 4 <= len(spu) and offset not in seen:
+            seen.add(offset)
+            delay, next_ = struct.unpack_from(">HH", spu, offset)
+            pos = offset + 4
+            while pos < len(spu):
+                cmd = spu[pos]
+                pos = pos + 1
+                if cmd == CMD_END:
+                    break
+                if cmd == FSTA_DSP:
+                    forced = True
+                elif cmd == STP_DSP and duration is None:
+                    duration = delay * 1024 // 90
+                elif cmd == CHG_COLCON:
+                    # el tamaño de sus argumentos va en sus dos primeros bytes
+                    pos = pos + int.from_bytes(spu[pos:pos + 2], 'big')
+                    continue
+                if cmd not in CMD_ARGS:
+                    break
+                pos = pos + CMD_ARGS[cmd]
+            if next_ == offset:
+                break
+            offset = next_
+        return duration, forced
+
+    def iter_subpictures(self) -> Iterator[SubPicture]:
+        for index, start, filepos in self.iter_idx():
+            duration = None
+            forced = False
+            if self._sub is not None:
+                try:
+                    duration, forced = VobSubReader.parse_control(self.read_spu(filepos, index))
+                except (InvalidVobSubError, struct.error, IndexError):
+                    duration, forced = None, False
+            yield SubPicture(index, start, duration, forced, filepos)
+
+    def count_images(self) -> int:
+        return sum(1 for _ in self.iter_idx())
+
+    def get_times(self) -> Tuple[Tuple[int, int]]:
+        subs = list(self.iter_subpictures())
+        tms = []
+        for i, s in enumerate(subs):
+            end = s.end
+            if s.duration is None:
+                end = subs[i+1].start - 1 if i + 1 < len(subs) else s.start
+            tms.append((s.start, end))
+        return tuple(sorted(set(tms)))
+
+    def fake_srt(self, file=None):
+        if file is None:
+            file = self.file.rsplit(".", 1)[0]+".srt"
+        with open(file, "w") as f:
+            for (i, (s, e)) in enumerate(self.get_times()):
+                f.write("{}\n".format(i+1))
+                f.write("{} --> {}\n".format(mseg_srt(s), mseg_srt(e)))
+                f.write("Line {}\n\n".format(i))
+        return file
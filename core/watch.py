@@ -0,0 +1,374 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from os import walk
+from os.path import basename, isfile, join, realpath, relpath, sep
+from typing import Callable, Dict, List, Set, Tuple
+
+from .mkv import extra_file
+from .trace import TRACE
+from .util import TMP, ThreadStdout, captured, forget
+
+VIDEO = ("mkv", "mp4", "avi", "m4v")
+SUBS = ("srt", "ssa", "ass", "sup", "pgs", "idx", "sub")
+# Mientras haya alguno de estos en el directorio la descarga no ha terminado
+PARTIAL = (".part", ".partial", ".crdownload", ".!qb", ".!ut", ".tmp")
+
+# Nombre -> (tamaño, mtime)
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+def ext(file: str) -> str:
+    return file.rsplit(".", 1)[-1].lower()
+
+
+def snapshot(path: str) -> Snapshot:
+    """
+    Ficheros (no ocultos) de un directorio con su tamaño y fecha
+    """
+    snap: Snapshot = {}
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                if e.name.startswith("."):
+                    continue
+                try:
+                    if not e.is_file():
+                        continue
+                    st = e.stat()
+                except OSError:
+                    continue
+                snap[e.name] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return snap
+
+
+def ignored(path: str, ignore: Tuple[str, ...]) -> bool:
+    return (realpath(path) + sep).startswith(ignore)
+
+
+def is_partial(snap: Snapshot) -> bool:
+    return any(name.lower().endswith(PARTIAL) for name in snap)
+
+
+@dataclass(frozen=True)
+class Group:
+    """
+    Un video con los ficheros que le acompañan: subtítulos con su mismo
+    nombre (peli.srt, peli.es.srt, peli.en.forced.ass...) y, si es el único
+    video del directorio, chapters*.txt, chapters.xml y tags.xml
+    """
+    video: str
+    extras: Tuple[str, ...] = tuple()
+
+    @property
+    def files(self) -> Tuple[str, ...]:
+        return (self.video, ) + self.extras
+
+    def name(self, root: str) -> str:
+        """
+        Ruta del video relativa a root, sin extensión
+        """
+        return relpath(self.video, root).rsplit(".", 1)[0]
+
+    def key(self, snap: Snapshot) -> tuple:
+        return tuple((f, snap.get(basename(f))) for f in self.files)
+
+
+def group_files(path: str, snap: Snapshot) -> List[Group]:
+    videos = sorted(n for n in snap if ext(n) in VIDEO)
+    if not videos:
+        return []
+    stems = sorted((v.rsplit(".", 1)[0] + "." for v in videos), key=len, reverse=True)
+    extras: Dict[str, List[str]] = {v.rsplit(".", 1)[0] + ".": [] for v in videos}
+    for name in sorted(snap):
+        if ext(name) in SUBS:
+            # Con peli.mkv y peli.parte2.mkv, peli.parte2.es.srt va con el segundo
+            stem = next((s for s in stems if name.startswith(s)), None)
+            if stem is not None:
+                extras[stem].append(name)
+        elif len(videos) == 1 and extra_file(name) is not None:
+            extras[stems[0]].append(name)
+    return [
+        Group(
+            video=join(path, v),
+            extras=tuple(join(path, n) for n in extras[v.rsplit(".", 1)[0] + "."])
+        ) for v in videos
+    ]
+
+
+class Inotify:
+    """
+    Cambios en un árbol de directorios con inotify (solo Linux), sin
+    dependencias: se llama a la libc con ctypes
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, root: str, ignore: Tuple[str, ...] = tuple()):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify solo existe en Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.ignore = ignore
+        self.wds: Dict[int, str] = {}
+        self.add_tree(root)
+
+    def add_tree(self, root: str) -> Set[str]:
+        added = set()
+        for path, dirs, files in walk(root):
+            dirs[:] = [d for d in dirs if not ignored(join(path, d), self.ignore)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), Inotify.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch", path)
+            self.wds[wd] = path
+            added.add(path)
+        return added
+
+    def read(self) -> bytes:
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data = data + chunk
+
+    def wait(self, timeout: float) -> Set[str]:
+        """
+        Directorios en los que ha cambiado algo en los próximos timeout segundos
+        """
+        changed = set()
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return changed
+        data = self.read()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = Inotify.EVENT.unpack_from(data, pos)
+            name = data[pos + Inotify.EVENT.size:pos + Inotify.EVENT.size + size].rstrip(b"\0")
+            pos = pos + Inotify.EVENT.size + size
+            if mask & Inotify.IN_Q_OVERFLOW:
+                changed.update(self.wds.values())
+                continue
+            if mask & Inotify.IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            path = self.wds.get(wd)
+            if path is None:
+                continue
+            if mask & Inotify.IN_ISDIR:
+                full = join(path, os.fsdecode(name))
+                if not ignored(full, self.ignore):
+                    # Lo que ya tenga dentro (si se ha movido) no genera eventos
+                    try:
+                        changed.update(self.add_tree(full))
+                    except OSError:
+                        pass
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """
+    Alternativa a Inotify: recorre el árbol en cada llamada a wait
+    """
+
+    def __init__(self, root: str, ignore: Tuple[str, ...] = tuple()):
+        self.root = root
+        self.ignore = ignore
+        self.snaps = self.scan()
+
+    def scan(self) -> Dict[str, Snapshot]:
+        snaps = {}
+        for path, dirs, files in walk(self.root):
+            dirs[:] = [d for d in dirs if not ignored(join(path, d), self.ignore)]
+            snaps[path] = snapshot(path)
+        return snaps
+
+    def wait(self, timeout: float) -> Set[str]:
+        time.sleep(timeout)
+        snaps = self.scan()
+        changed = set(d for d, s in snaps.items() if self.snaps.get(d) != s)
+        self.snaps = snaps
+        return changed
+
+    def close(self):
+        pass
+
+
+class Watcher:
+    """
+    Vigila root y aplica func a cada grupo (ver Group) nuevo cuando su
+    directorio lleva settle segundos sin cambios y sin descargas a medias.
+    Los grupos se procesan en un pool de jobs hilos dentro del mismo
+    proceso, y la salida de cada uno se imprime junta al terminar.
+    func devuelve una etiqueta con el resultado, como en Batch.
+    Lo que ya había al arrancar se ignora salvo con existing
+    """
+
+    def __init__(self, root: str, func: Callable[[Group], str], jobs: int = 1, settle: float = 10, interval: float = 2, existing: bool = False, ignore: List[str] = None, polling: bool = False):
+        self.root = root
+        self.func = func
+        self.jobs = jobs
+        self.settle = settle
+        self.interval = interval
+        self.existing = existing
+        self.ignore = tuple(realpath(i) + sep for i in (ignore or []))
+        self.polling = polling
+        self.results: Dict[str, str] = {}
+        # Directorio -> (snapshot, momento del último cambio)
+        self.pending: Dict[str, Tuple[Snapshot, float]] = {}
+        # Claves (ficheros, tamaño y fecha) de los grupos ya vistos
+        self.done: Set[tuple] = set()
+        self.running: Dict[Future, Tuple[Group, str]] = {}
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def open(self):
+        if not self.polling:
+            try:
+                source = Inotify(self.root, ignore=self.ignore)
+                print("# Vigilando", self.root, "con inotify")
+                return source
+            except (OSError, AttributeError) as e:
+                print("# inotify no disponible:", e)
+        print("# Vigilando", self.root, "cada {}s".format(self.interval))
+        return Poller(self.root, ignore=self.ignore)
+
+    def touch(self, path: str, since: float):
+        self.pending[path] = (snapshot(path), since)
+
+    def tick(self, changed: Set[str]):
+        now = time.monotonic()
+        for path in changed:
+            self.touch(path, now)
+        for path, (snap, since) in list(self.pending.items()):
+            if now - since < self.settle:
+                continue
+            current = snapshot(path)
+            if current != snap or is_partial(current):
+                self.pending[path] = (current, now)
+                continue
+            del self.pending[path]
+            self.dispatch(path, current)
+
+    def dispatch(self, path: str, snap: Snapshot):
+        self.prune()
+        busy = set(g.video for g, _ in self.running.values())
+        for group in group_files(path, snap):
+            key = group.key(snap)
+            if key in self.done:
+                continue
+            if group.video in busy:
+                # Se vuelve a mirar cuando pase otro settle, que puede que
+                # el trabajo en curso no tenga los subtítulos que han llegado
+                self.pending[path] = (snap, time.monotonic())
+                continue
+            self.done.add(key)
+            self.running[self.pool.submit(captured, self.do, group)] = (group, path)
+
+    def prune(self):
+        """
+        Olvida los grupos con algún fichero que ya no existe (movido o
+        borrado), para que done no crezca sin fin
+        """
+        for key in list(self.done):
+            if not all(isfile(f) for f, _ in key):
+                self.done.discard(key)
+
+    def do(self, group: Group) -> str:
+        print("#", group.video)
+        for f in group.extras:
+            print("#   +", basename(f))
+        with self.lock:
+            self.active = self.active + 1
+        try:
+            with TRACE.span("Watcher.do", file=group.video) as span, TMP.job():
+                try:
+                    span['result'] = self.func(group)
+                except (Exception, SystemExit) as e:
+                    print("# ERROR", e)
+                    span['result'] = "error"
+        finally:
+            with self.lock:
+                self.active = self.active - 1
+                # El proceso no termina nunca: lo recordado en memoria se
+                # olvida cuando no queda ningún trabajo en curso
+                if self.active == 0:
+                    forget()
+        return span['result']
+
+    def collect(self, wait: bool = False):
+        for ftr in list(self.running):
+            if not (wait or ftr.done()):
+                continue
+            group, path = self.running.pop(ftr)
+            if ftr.cancelled():
+                continue
+            buffer, exc, val = ftr.result()
+            sys.stdout.write(buffer.getvalue())
+            sys.stdout.flush()
+            if exc is not None:
+                raise exc
+            self.results[group.video] = val
+            # Lo que haya cambiado el propio trabajo (mkvpropedit) no es nuevo
+            self.done.add(group.key(snapshot(path)))
+
+    def run(self):
+        ThreadStdout.install()
+        source = self.open()
+        now = time.monotonic()
+        for path, dirs, files in walk(self.root):
+            dirs[:] = [d for d in dirs if not ignored(join(path, d), self.ignore)]
+            if self.existing:
+                self.touch(path, now - self.settle)
+                continue
+            snap = snapshot(path)
+            for group in group_files(path, snap):
+                self.done.add(group.key(snap))
+        self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            while True:
+                self.tick(source.wait(self.interval))
+                self.collect()
+        except KeyboardInterrupt:
+            print("")
+            print("# Esperando a {} trabajos en curso".format(len(self.running)))
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.collect(wait=True)
+            source.close()
+            self.summary()
+
+    def summary(self):
+        total: Dict[str, int] = {}
+        for r in self.results.values():
+            total[r] = total.get(r, 0) + 1
+        print("")
+        print("# {} videos procesados".format(len(self.results)))
+        for label, count in sorted(total.items()):
+            print("#   {}: {}".format(label, count))
+
@@ -2,13 +2,21 @@
 import argparse
 import sys
 from os import makedirs
-from os.path import isfile, basename, isdir, realpath, dirname
+from os.path import isfile, basename, isdir, realpath, dirname, join
 
 from core.mkv import MkvMerge, Mkv
 from core.shell import Shell
 from core.sub import Sub
 from core.track import MKVLANG
 from core.pgsreader import PGSReader
+from core.vobsubreader import VobSubReader
+from core.cache import CACHE
+from core.mkvutil import MkvInfo
+from core.batch import Batch, expand_files
+from core.replay import install_from_env
+from core.trace import TRACE
+from core.util import TMP
+from core.watch import Watcher, Group
 
 try:
     from core.guess import guess_args
@@ -16,6 +24,18 @@ except ImportError:
     guess_args = lambda *args, **kwargs: None
 
 
+def check_langs(parser: argparse.ArgumentParser, pargs: argparse.Namespace):
+    """
+    Comprueba --vo y --und después de aplicar --no-cache, y solo si se
+    han dado, para no cargar la tabla de idiomas si no hace falta
+    """
+    for name in ("vo", "und"):
+        value = getattr(pargs, name)
+        if value is not None and (len(value) != 2 or value not in MKVLANG.code):
+            langs = sorted(k for k in MKVLANG.code.keys() if len(k) == 2)
+            parser.error("argument --{}: invalid choice: '{}' (choose from {})".format(name, value, ", ".join(langs)))
+
+
 def parse_track(tracks):
     if isinstance(tracks, str):
         tracks = [tracks]
@@ -32,6 +52,7 @@ def parse_track(tracks):
 
 
 if __name__ == "__main__":
+    install_from_env()
     if len(sys.argv) == 2:
         fln = sys.argv[1]
         ext = fln.rsplit(".", 1)[-1].lower()
@@ -46,9 +67,13 @@ if __name__ == "__main__":
                         print("")
                         print(cls)
                 sys.exit()
-            if ext in ("sup", "pgs", "sub"):
+            if ext in ("sup", "pgs"):
                 print("OUT:", PGSReader(fln).fake_srt())
                 sys.exit()
+            if ext in ("sub", "idx"):
+                with VobSubReader(fln) as vob:
+                    print("OUT:", vob.fake_srt())
+                sys.exit()
 
     if len(sys.argv) > 2 and sys.argv[1] == "info":
         print("[spoiler=mediainfo][code]", end="")
@@ -62,15 +87,92 @@ if __name__ == "__main__":
         sys.exit()
 
     if len(sys.argv) > 2 and sys.argv[1] == "edit":
-        for f in sys.argv[2:]:
-            f = Mkv(f)
-            f.fix_tracks(dry=True)
+        parser = argparse.ArgumentParser("mkvmrg.py edit", description="Corrige las pistas de ficheros mkv con mkvpropedit")
+        parser.add_argument('--jobs', type=int, help='Número de ficheros a procesar en paralelo', default=1)
+        parser.add_argument('--apply', action="store_true", help='Aplica los cambios (por defecto solo se muestran)')
+        parser.add_argument('--mini', action="store_true", help='Solo cambia lo que sea distinto a lo actual')
+        parser.add_argument('--no-cache', action="store_true", help='No usar la cache de mkvmerge -J')
+        parser.add_argument('--native', action="store_true", help='Leer los mkv (cabecera y subtítulos) sin mkvmerge -J ni mkvextract')
+        parser.add_argument('--profile', help='Guardar en este json (formato Chrome trace) lo que tarda cada comando y etapa')
+        parser.add_argument('files', nargs="+", help='Ficheros, directorios o globs')
+        pargs = parser.parse_args(sys.argv[2:])
+        if pargs.no_cache:
+            CACHE.enabled = False
+        if pargs.native:
+            MkvInfo.native = True
+        if pargs.profile:
+            TRACE.enable(pargs.profile)
+
+        def edit(file: str) -> str:
+            arr, changed = Mkv(file).fix_tracks(mini=pargs.mini, dry=not pargs.apply)
+            return "con cambios" if changed else "sin cambios"
+
+        Batch(edit, jobs=pargs.jobs).run(expand_files(pargs.files))
+        sys.exit()
+
+    if len(sys.argv) > 2 and sys.argv[1] == "watch":
+        parser = argparse.ArgumentParser("mkvmrg.py watch", description="Vigila un directorio y procesa cada video nuevo cuando termina de descargarse")
+        parser.add_argument('--out', help='Directorio donde mezclar cada video con sus subtítulos, capítulos y tags (sin --out se corrigen las pistas de los mkv con mkvpropedit)')
+        parser.add_argument('--jobs', type=int, help='Número de videos a procesar en paralelo', default=1)
+        parser.add_argument('--settle', type=float, help='Segundos sin cambios en el directorio para darlo por terminado', default=10)
+        parser.add_argument('--interval', type=float, help='Segundos entre revisiones', default=2)
+        parser.add_argument('--polling', action="store_true", help='Revisar el directorio cada --interval segundos en vez de usar inotify')
+        parser.add_argument('--existing', action="store_true", help='Procesar también lo que ya hay en el directorio')
+        parser.add_argument('--und', help='Idioma para pistas und (mkvmerge --list-languages)')
+        parser.add_argument('--vo', help='Idioma de la versión original (mkvmerge --list-languages)')
+        parser.add_argument('--dry', action="store_true", help='Imprime los comandos mkvmerge sin ejecutarlos')
+        parser.add_argument('--apply', action="store_true", help='Sin --out, aplica los cambios (por defecto solo se muestran)')
+        parser.add_argument('--mini', action="store_true", help='Sin --out, solo cambia lo que sea distinto a lo actual')
+        parser.add_argument('--no-cache', action="store_true", help='No usar la cache de mkvmerge -J')
+        parser.add_argument('--native', action="store_true", help='Leer los mkv (cabecera y subtítulos) sin mkvmerge -J ni mkvextract')
+        parser.add_argument('--profile', help='Guardar en este json (formato Chrome trace) lo que tarda cada comando y etapa')
+        parser.add_argument('dir', help='Directorio a vigilar')
+        pargs = parser.parse_args(sys.argv[2:])
+        if not isdir(pargs.dir):
+            sys.exit("No existe: " + pargs.dir)
+        if pargs.no_cache:
+            CACHE.enabled = False
+        check_langs(parser, pargs)
+        if pargs.native:
+            MkvInfo.native = True
+        if pargs.profile:
+            TRACE.enable(pargs.profile)
+        if pargs.dry:
+            TMP.keep = True
+
+        def merge(group: Group) -> str:
+            out = join(pargs.out, group.name(pargs.dir) + ".mkv")
+            if isfile(out):
+                print("# SKIP ya existe", out)
+                return "ya existe"
+            makedirs(dirname(out), exist_ok=True)
+            mkv = MkvMerge(vo=pargs.vo, und=pargs.und, dry=pargs.dry).merge(out, *group.files)
+            if pargs.dry:
+                return "dry"
+            return "mezclado" if mkv else "error"
+
+        def edit(group: Group) -> str:
+            if group.extras or not group.video.lower().endswith(".mkv"):
+                print("# SKIP hace falta --out para mezclarlo")
+                return "sin --out"
+            arr, changed = Mkv(group.video).fix_tracks(mini=pargs.mini, dry=not pargs.apply)
+            return "con cambios" if changed else "sin cambios"
+
+        Watcher(
+            pargs.dir,
+            merge if pargs.out else edit,
+            jobs=pargs.jobs,
+            settle=pargs.settle,
+            interval=pargs.interval,
+            existing=pargs.existing,
+            ignore=[pargs.out] if pargs.out else None,
+            polling=pargs.polling
+        ).run()
         sys.exit()
 
-    langs = sorted(k for k in MKVLANG.code.keys() if len(k) == 2)
     parser = argparse.ArgumentParser("Remezcla mkv")
-    parser.add_argument('--und', help='Idioma para pistas und (mkvmerge --list-languages)', choices=langs)
-    parser.add_argument('--vo', help='Idioma de la versión original (mkvmerge --list-languages)', choices=langs)
+    parser.add_argument('--und', help='Idioma para pistas und (mkvmerge --list-languages)')
+    parser.add_argument('--vo', help='Idioma de la versión original (mkvmerge --list-languages)')
     parser.add_argument('--tracks', nargs="*", help='tracks a preservar en formato source:id')
     parser.add_argument('--tracks-rm', nargs="*", help='tracks a eliminar en formato source:id')
     parser.add_argument('--out', type=str, help='Fichero salida para mkvmerge', default='.')
@@ -78,9 +180,24 @@ if __name__ == "__main__":
     parser.add_argument('--trim', help='Recortar el video usando --split parts:')
     parser.add_argument('--dry', action="store_true", help='Imprime el comando mkvmerge sin ejecutarlo')
     parser.add_argument('--no-chapters', action="store_true", help='Omitir chapters')
+    parser.add_argument('--no-cache', action="store_true", help='No usar la cache de mkvmerge -J')
+    parser.add_argument('--native', action="store_true", help='Leer los mkv (cabecera y subtítulos) sin mkvmerge -J ni mkvextract')
+    parser.add_argument('--jobs', type=int, help='Número de ficheros de entrada a analizar en paralelo', default=1)
+    parser.add_argument('--profile', help='Guardar en este json (formato Chrome trace) lo que tarda cada comando y etapa')
     parser.add_argument('files', nargs="+", help='Ficheros a mezclar')
     pargs = parser.parse_args()
 
+    if pargs.no_cache:
+        CACHE.enabled = False
+    check_langs(parser, pargs)
+    if pargs.native:
+        MkvInfo.native = True
+    if pargs.profile:
+        TRACE.enable(pargs.profile)
+    if pargs.dry:
+        # Los comandos impresos usan ficheros de TMP
+        TMP.keep = True
+
     for file in pargs.files:
         if not isfile(file):
             sys.exit("No existe: " + file)
@@ -105,7 +222,8 @@ if __name__ == "__main__":
     mrg = MkvMerge(
         vo=pargs.vo,
         und=pargs.und,
-        dry=pargs.dry
+        dry=pargs.dry,
+        jobs=pargs.jobs
     )
     mrg.merge(
         pargs.out,
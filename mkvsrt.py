@@ -1,28 +1,47 @@
 #!/usr/bin/python3
 import argparse
+from os.path import isfile, getmtime
 
 from core.mkv import Mkv
-from core.shell import Shell
-from core.sub import Sub
-from core.track import MKVLANG
-from os.path import basename
-from core.util import TMP
+from core.cache import CACHE
+from core.mkvutil import MkvInfo
+from core.batch import Batch, expand_files
+from core.replay import install_from_env
+from core.trace import TRACE
+
+
+def extract_srt(file: str) -> str:
+    name = file.rsplit(".", 1)[0]
+    out = name + ".srt"
+    if isfile(out) and getmtime(out) >= getmtime(file):
+        print(f"# SKIP '{out}' es más reciente")
+        return "sin cambios"
+    mkv = Mkv(file)
+    track = mkv.get_main_extract()
+    if track is None:
+        return "sin subtítulos"
+    if not track.text_subtitles:
+        print(f"# SKIP {track} no es un subtítulo de texto")
+        return "sin subtítulos"
+    # el subtitulo ya se extrajo y analizó al construir las pistas
+    print(f"# mv '{track.source_file}' '{out}'")
+    track.analysis.subs.save(out, encoding="utf-8-sig")
+    return "extraído"
 
 
 if __name__ == "__main__":
-    langs = sorted(k for k in MKVLANG.code.keys() if len(k) == 2)
+    install_from_env()
     parser = argparse.ArgumentParser("Extrae el subtitulo principal y lo convierte a srt para TV antiguas")
-    parser.add_argument('files', nargs="+", help='Ficheros mkv')
+    parser.add_argument('--jobs', type=int, help='Número de ficheros a procesar en paralelo', default=1)
+    parser.add_argument('--no-cache', action="store_true", help='No usar la cache de mkvmerge -J')
+    parser.add_argument('--native', action="store_true", help='Leer los mkv (cabecera y subtítulos) sin mkvmerge -J ni mkvextract')
+    parser.add_argument('--profile', help='Guardar en este json (formato Chrome trace) lo que tarda cada comando y etapa')
+    parser.add_argument('files', nargs="+", help='Ficheros mkv, directorios o globs')
     pargs = parser.parse_args()
-    for file in pargs.files:
-        mkv = Mkv(file)
-        track = mkv.get_main_extract()
-        if track is None:
-            continue
-        #extraer
-        name = file.rsplit(".", 1)[0]
-        out = f"{TMP}/{basename(name)}.{track.file_extension}"
-        Shell.run("mkvextract", "tracks", file, f"{track.id}:{out}")
-        #limpiar
-        print(f"# mv '{out}' '{name}.srt'")
-        Sub(out).load().save(name+".srt", encoding="utf-8-sig")
+    if pargs.no_cache:
+        CACHE.enabled = False
+    if pargs.native:
+        MkvInfo.native = True
+    if pargs.profile:
+        TRACE.enable(pargs.profile)
+    Batch(extract_srt, jobs=pargs.jobs).run(expand_files(pargs.files))
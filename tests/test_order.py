@@ -0,0 +1,126 @@
+"""
+TrackOrder.plan comparado con lo que hacía MkvMerge.make_order antes de
+pasar a core/order.py. Los órdenes y pistas por defecto esperados se
+obtuvieron con esa implementación, manías incluidas (el audio que no es
+ni es ni vo se queda fuera y el subtítulo por defecto es el primero en
+aparecer, no el primero ordenado)
+"""
+import unittest
+from tempfile import TemporaryDirectory
+
+from core.cache import CACHE
+from core.mkvutil import MkvInfoTrack
+from core.order import TrackOrder
+from core.track import Track, TrackTuple
+
+CODECS = {
+    "video": "AVC/H.264/MPEG-4p10",
+    "ac3": "AC-3",
+    "aac": "AAC",
+    "srt": "SubRip/SRT",
+    "pgs": "HDMV PGS",
+}
+
+
+class TestTrackOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.enabled = CACHE.enabled
+        CACHE.enabled = False
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        CACHE.enabled = self.enabled
+        self.tmp.cleanup()
+
+    def track(self, source: int, id: int, type: str, codec: str, language: str, forced: int = 0, lines: int = None, number: int = None) -> Track:
+        props = dict(
+            number=id + 1 if number is None else number,
+            language=language,
+            forced_track=forced,
+            track_name="pista {}".format(id)
+        )
+        if type == "subtitles":
+            props["text_subtitles"] = codec == "srt"
+            props["codec_id"] = "S_TEXT/UTF8" if codec == "srt" else "S_HDMV/PGS"
+        track = Track.build(source, MkvInfoTrack.parse(dict(id=id, type=type, codec=CODECS[codec], properties=props)))
+        if lines is not None:
+            # Las líneas salen del fichero del subtítulo
+            track.source_file = "{}/{}_{}.srt".format(self.tmp.name, source, id)
+            with open(track.source_file, "w") as f:
+                for i in range(lines):
+                    f.write("{}\n00:00:{:02d},000 --> 00:00:{:02d},500\nlinea {}\n\n".format(i + 1, i, i, i))
+        return track
+
+    def assertPlan(self, tracks, order, defaults, main_order=None):
+        plan = TrackOrder(main_order).plan(TrackTuple(tracks))
+        self.assertEqual(plan.track_order, ",".join(order))
+        self.assertEqual([plan.defaults[tuple(map(int, k.split(":")))] for k in order], defaults)
+        shuffled = [t for t in reversed(tracks) if "{}:{}".format(t.source, t.id) in order]
+        self.assertEqual(["{}:{}".format(t.source, t.id) for t in plan.sorted(shuffled)], order)
+
+    def anime(self):
+        return [
+            self.track(0, 0, "video", "video", "jpn"),
+            self.track(0, 1, "audio", "aac", "jpn"),
+            self.track(0, 2, "audio", "ac3", "spa"),
+            self.track(0, 3, "audio", "ac3", "jpn"),
+            self.track(0, 4, "audio", "aac", "spa"),
+            self.track(0, 5, "audio", "ac3", "eng"),
+            self.track(0, 6, "subtitles", "srt", "eng"),
+            self.track(0, 7, "subtitles", "srt", "spa", forced=1),
+            self.track(0, 8, "subtitles", "srt", "jpn"),
+            self.track(0, 9, "subtitles", "srt", "spa"),
+            self.track(0, 10, "subtitles", "pgs", "jpn", forced=1),
+            self.track(0, 11, "subtitles", "srt", "eng", forced=1),
+        ]
+
+    def test_groups(self):
+        # es y vo alternados con ac3 primero, y con audio es el
+        # subtítulo por defecto es el forzado es
+        self.assertPlan(
+            self.anime(),
+            ["0:0", "0:2", "0:3", "0:4", "0:1", "0:9", "0:7", "0:8", "0:10", "0:6", "0:11"],
+            [1, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0]
+        )
+
+    def test_main_order(self):
+        main_order = ["0:0", "0:4", "0:1", "0:9", "0:7", "0:6"]
+        tracks = [t for t in self.anime() if "{}:{}".format(t.source, t.id) in main_order]
+        self.assertPlan(tracks, main_order, [1, 1, 0, 0, 1, 0], main_order=main_order)
+
+    def test_no_spanish_audio(self):
+        # Sin audio es el subtítulo por defecto es el completo es, y dentro
+        # de cada fuente van antes los que tienen más líneas
+        self.assertPlan(
+            [
+                self.track(0, 0, "video", "video", "eng"),
+                self.track(0, 1, "audio", "ac3", "eng"),
+                self.track(0, 2, "subtitles", "srt", "spa", lines=3),
+                self.track(0, 3, "subtitles", "srt", "spa", lines=10),
+                self.track(0, 4, "subtitles", "srt", "spa", forced=1, lines=2),
+                self.track(1, 0, "subtitles", "srt", "spa", lines=50),
+            ],
+            ["0:0", "0:1", "0:3", "0:2", "1:0", "0:4"],
+            [1, 1, 0, 1, 0, 0]
+        )
+
+    def test_sources(self):
+        # Empates entre fuentes: ac3, luego fuente y luego número de pista
+        self.assertPlan(
+            [
+                self.track(1, 0, "audio", "aac", "spa"),
+                self.track(0, 0, "video", "video", "eng"),
+                self.track(0, 2, "audio", "aac", "eng", number=2),
+                self.track(0, 1, "audio", "aac", "spa", number=3),
+                self.track(2, 0, "audio", "ac3", "spa"),
+                self.track(0, 3, "subtitles", "srt", "spa", forced=1),
+                self.track(3, 0, "subtitles", "srt", "spa", forced=1),
+            ],
+            ["0:0", "2:0", "0:2", "0:1", "1:0", "0:3", "3:0"],
+            [1, 1, 0, 0, 0, 1, 0]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
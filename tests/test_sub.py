@@ -0,0 +1,30 @@
+"""
+SSAFile.improve comparado con lo que hacía la implementación anterior
+(bucle hasta punto fijo). Los *.expected.* de fixtures/sub se generaron
+con esa implementación
+"""
+import unittest
+from glob import glob
+from os.path import basename, dirname, join
+
+from core.sub import Sub
+
+FIXTURES = join(dirname(__file__), "fixtures", "sub")
+
+
+class TestImprove(unittest.TestCase):
+
+    def test_corpus(self):
+        files = [f for f in sorted(glob(join(FIXTURES, "*"))) if ".expected." not in f]
+        self.assertTrue(files)
+        for file in files:
+            name, ext = basename(file).rsplit(".", 1)
+            with self.subTest(basename(file)):
+                subs = Sub.read(file)
+                self.assertTrue(subs.improve())
+                with open(join(FIXTURES, f"{name}.expected.{ext}"), "r") as f:
+                    self.assertEqual(subs.to_string(ext), f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()